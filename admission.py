@@ -0,0 +1,152 @@
+"""Admission control for upstream generations, with a degraded fallback.
+
+Every Claude and DALL-E call is tracked as in flight for its upstream, and
+the app registers its work queues (stage pool, image jobs). When a page would
+have to call an upstream that already has ADMISSION_MAX_<UPSTREAM> calls in
+flight or whose circuit is open (see resilience), or the queues hold more
+than ADMISSION_MAX_QUEUE tasks, the call is shed: the page is served at once
+from what is already on hand instead of queueing behind a slow provider. A
+shed image is replaced by the city's closest image for other weather, ranked
+by ``weather_distance``; a shed theme by the city's last known palette and
+fonts (see ``DesignCache.last_known``). Shed stages are listed in the
+``X-Degraded`` response header and counted in ``degraded_responses_total``.
+"""
+import asyncio
+import functools
+import threading
+from contextlib import contextmanager
+
+import config
+import metrics
+from design_cache import WEATHER_CODE_FAMILIES
+from logs import get_logger
+from resilience import upstreams
+
+log = get_logger('admission')
+
+# Weather families placed on (precipitation, overcast) axes; the distance
+# between two families is how different their images tend to look
+FAMILY_POSITIONS = {
+    'clear': (0, 0),
+    'cloudy': (0, 2),
+    'fog': (0, 3),
+    'drizzle': (1, 2),
+    'rain': (2, 2),
+    'snow': (2, 3),
+    'thunderstorm': (3, 3),
+}
+UNKNOWN_DISTANCE = 10
+
+
+class AdmissionController:
+    def __init__(self, limits, max_queue):
+        self.limits = limits
+        self.max_queue = max_queue
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self._queues = {}
+
+    def watch_queue(self, name, depth):
+        """Count ``depth()`` tasks towards the queue limit"""
+        self._queues[name] = depth
+
+    def queue_depth(self):
+        total = 0
+        for name, depth in list(self._queues.items()):
+            try:
+                total += depth()
+            except Exception as e:
+                log.debug("reading queue depth failed", queue=name, error=str(e))
+        return total
+
+    def in_flight(self, upstream):
+        with self._lock:
+            return self._in_flight.get(upstream, 0)
+
+    @contextmanager
+    def track(self, upstream):
+        """Count the enclosed block as one call in flight to ``upstream``"""
+        with self._lock:
+            self._in_flight[upstream] = self._in_flight.get(upstream, 0) + 1
+        try:
+            yield
+        finally:
+            with self._lock:
+                self._in_flight[upstream] -= 1
+
+    def tracked(self, upstream):
+        """Decorator tracking every call of a function or coroutine function"""
+        def decorator(fn):
+            if asyncio.iscoroutinefunction(fn):
+                @functools.wraps(fn)
+                async def async_wrapper(*args, **kwargs):
+                    with self.track(upstream):
+                        return await fn(*args, **kwargs)
+                return async_wrapper
+
+            @functools.wraps(fn)
+            def wrapper(*args, **kwargs):
+                with self.track(upstream):
+                    return fn(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def admit(self, upstream):
+        """Whether a page may start a new call to ``upstream`` now"""
+        if not config.ADMISSION:
+            return True
+        limit = self.limits.get(upstream)
+        admitted = ((limit is None or self.in_flight(upstream) < limit)
+                    and self.queue_depth() < self.max_queue
+                    and (upstream not in upstreams or upstreams[upstream].breaker.available()))
+        metrics.admission_decisions.inc(upstream=upstream, result='admitted' if admitted else 'shed')
+        return admitted
+
+    def stats(self):
+        with self._lock:
+            in_flight = dict(self._in_flight)
+        return {'in_flight': in_flight, 'limits': self.limits,
+                'queue_depth': self.queue_depth(), 'max_queue': self.max_queue}
+
+
+def description_family(weather_description):
+    """Weather family of a description from ``get_weather_description``"""
+    from notebook_functions import WEATHER_CODES
+    for code, description in WEATHER_CODES.items():
+        if description.lower() == (weather_description or '').lower():
+            return WEATHER_CODE_FAMILIES.get(code, 'unknown')
+    return 'unknown'
+
+
+def weather_distance(description, other):
+    """How far apart two weather descriptions look; 0 for the same weather"""
+    if description.lower() == other.lower():
+        return 0
+    position = FAMILY_POSITIONS.get(description_family(description))
+    other_position = FAMILY_POSITIONS.get(description_family(other))
+    if position is None or other_position is None:
+        return UNKNOWN_DISTANCE
+    # Same family but different intensity still ranks behind an exact match
+    return 0.5 + abs(position[0] - other_position[0]) + abs(position[1] - other_position[1])
+
+
+def nearest_image(city, weather_description):
+    """Served path of the city's image whose weather looks closest, or None"""
+    from image_store import get_image_store
+    candidates = get_image_store().images_for_city(city)
+    if not candidates:
+        return None
+    _weather, image_path = min(candidates,
+                               key=lambda item: weather_distance(weather_description, item[0] or ''))
+    return image_path
+
+
+def degraded(stage):
+    """Count a page served with ``stage`` shed"""
+    metrics.degraded_responses.inc(stage=stage)
+    log.info("serving degraded stage", stage=stage)
+
+
+admission = AdmissionController({'anthropic': config.ADMISSION_MAX_ANTHROPIC,
+                                 'openai': config.ADMISSION_MAX_OPENAI},
+                                max_queue=config.ADMISSION_MAX_QUEUE)
@@ -0,0 +1,110 @@
+"""ASGI entry point for the asyncio serving mode.
+
+    SW_STREAM_PAGES=1 uvicorn asgi:application --workers 2
+
+City pages (POST /) and page streams (GET /stream) run on the event loop
+through async_pipeline, so one process can hold many pages in flight. Every
+other route (static files, the JSON APIs, the GET form) is served by the
+Flask app through a WSGI adapter. The sync ``sentient_weather:create_app()``
+remains the default deployment.
+"""
+import asyncio
+from urllib.parse import parse_qs
+
+from asgiref.wsgi import WsgiToAsgi
+
+import async_pipeline
+import config
+from clients import aclose_async_clients
+from logs import get_logger
+from resilience import deadline
+from sentient_weather import create_app
+
+log = get_logger('asgi')
+
+wsgi_application = WsgiToAsgi(create_app())
+
+
+async def _read_body(receive):
+    body = b''
+    while True:
+        message = await receive()
+        body += message.get('body', b'')
+        if not message.get('more_body'):
+            return body
+
+
+async def _send_response(send, status, body, content_type='text/html; charset=utf-8', shed=()):
+    headers = [(b'content-type', content_type.encode('latin-1'))]
+    if shed:
+        headers.append((b'x-degraded', ','.join(shed).encode('latin-1')))
+    await send({'type': 'http.response.start', 'status': status, 'headers': headers})
+    await send({'type': 'http.response.body', 'body': body.encode('utf-8')})
+
+
+async def _city_page(scope, receive, send):
+    try:
+        form = parse_qs((await _read_body(receive)).decode('utf-8'))
+        city = form.get('city', [''])[0]
+        if not city:
+            await _send_response(send, 400, async_pipeline.render_error("Missing city"))
+            return
+        with deadline(config.PAGE_DEADLINE):
+            body, shed = await async_pipeline.render_city_page(city)
+    except asyncio.CancelledError:
+        if async_pipeline.cancelling():
+            raise
+        log.error("main route handler failed", error="cancelled")
+        body, shed = async_pipeline.render_error("Page generation was cancelled"), []
+    except Exception as e:
+        log.exception("main route handler failed", error=str(e))
+        body, shed = async_pipeline.render_error(str(e)), []
+    await _send_response(send, 200, body, shed=shed)
+
+
+async def _stream(scope, receive, send):
+    if not config.STREAM_PAGES:
+        await _send_response(send, 404, '{"error": "Streaming is disabled"}', 'application/json')
+        return
+    query = parse_qs(scope.get('query_string', b'').decode('utf-8'))
+    city = query.get('city', [''])[0].strip()
+    if not city:
+        await _send_response(send, 400, '{"error": "Missing city"}', 'application/json')
+        return
+
+    await send({'type': 'http.response.start', 'status': 200,
+                'headers': [(b'content-type', b'text/event-stream'),
+                            (b'cache-control', b'no-cache'),
+                            (b'x-accel-buffering', b'no')]})
+    with deadline(config.STREAM_DEADLINE):
+        async for event in async_pipeline.stream_page_async(city):
+            await send({'type': 'http.response.body', 'body': event.encode('utf-8'),
+                        'more_body': True})
+    await send({'type': 'http.response.body', 'body': b''})
+
+
+async def _lifespan(receive, send):
+    while True:
+        message = await receive()
+        if message['type'] == 'lifespan.startup':
+            await send({'type': 'lifespan.startup.complete'})
+        elif message['type'] == 'lifespan.shutdown':
+            await aclose_async_clients()
+            await send({'type': 'lifespan.shutdown.complete'})
+            return
+
+
+async def application(scope, receive, send):
+    if scope['type'] == 'lifespan':
+        await _lifespan(receive, send)
+        return
+
+    if scope['type'] == 'http':
+        if scope['path'] == '/' and scope['method'] == 'POST':
+            await _city_page(scope, receive, send)
+            return
+        if scope['path'] == '/stream' and scope['method'] == 'GET':
+            await _stream(scope, receive, send)
+            return
+
+    await wsgi_application(scope, receive, send)
@@ -0,0 +1,581 @@
+"""Asyncio versions of the page pipeline, used by the ASGI entry point (asgi.py).
+
+Geocoding, the Claude calls and image generation/download all go through
+the async clients on one event loop, so a single process can hold many pages
+in flight while they wait on upstream APIs. Weather goes through the sync
+client's response cache in a worker thread. Prompts, parsing, validation and
+the design cache, image store and job queue are shared with the sync path;
+only the network calls differ.
+"""
+import asyncio
+import json
+import os
+import time
+
+import httpx
+
+import config
+import metrics
+from admission import admission, nearest_image
+from clients import get_async_anthropic, get_async_http_client, get_async_openai
+from design_cache import design_cache
+from gazetteer import get_gazetteer
+from geocode_cache import get_geocode_cache
+from image_derivatives import image_variants, schedule_derivatives
+from image_store import get_image_store
+from page_cache import is_cacheable, page_cache
+from logs import get_logger
+from refresh import refresher
+from resilience import upstreams
+from notebook_functions import (
+    city_image_request,
+    color_palette_request,
+    font_recommendations_request,
+    get_css_variables,
+    get_weather_data,
+    get_weather_description,
+    image_cache_key,
+    parse_theme,
+    theme_request,
+    validate_color_palette,
+    validate_font_recommendations,
+)
+from sentient_weather import (
+    app,
+    get_default_colors,
+    get_default_fonts,
+    image_jobs,
+    last_known_theme,
+    palette_source,
+    prewarmer,
+    process_colors,
+    process_fonts,
+    shed_stages,
+    store_image_palette,
+)
+from singleflight import async_flights
+from sse import section_events, sse_event
+
+log = get_logger('async_pipeline')
+
+
+def cancelling():
+    """Whether the running task has been asked to cancel, as opposed to a
+    CancelledError coming up from work it awaited; assumed so on Pythons
+    before 3.11, which cannot tell the two apart"""
+    task = asyncio.current_task()
+    return not hasattr(task, 'cancelling') or task.cancelling() > 0
+
+
+async def _geocode_nominatim(city):
+    """Look up a city with Nominatim's search API; None if it does not exist."""
+    url = f"{config.NOMINATIM_SCHEME}://{config.NOMINATIM_DOMAIN}/search"
+    nominatim = upstreams['nominatim']
+
+    async def search():
+        response = await get_async_http_client().get(
+            url, params={'q': city, 'format': 'json', 'limit': 1}, timeout=nominatim.timeout())
+        response.raise_for_status()
+        return response
+
+    places = (await nominatim.call_async(search)).json()
+    if not places:
+        return None
+    return (float(places[0]['lat']), float(places[0]['lon']))
+
+@metrics.timed('geocode')
+async def get_city_coordinates_async(city):
+    """Get coordinates for a given city."""
+    try:
+        if config.GEOCODER_BACKEND == 'offline':
+            return get_gazetteer().geocode(city)
+        return await get_geocode_cache().lookup_async(city, _geocode_nominatim)
+    except Exception as e:
+        metrics.upstream_errors.inc(upstream='nominatim')
+        log.error("geocoding failed", city=city, error=str(e))
+        return None
+
+async def get_weather_data_async(latitude, longitude):
+    """Get current weather and forecast data from Open Meteo API.
+
+    Goes through the sync client in a worker thread, so both serving modes
+    share the requests-cache session: its weather cache, stale-while-revalidate
+    refreshes and the resilience layer. Cache hits, most pages under load,
+    never block the event loop; a miss holds the thread for one upstream call.
+    """
+    return await asyncio.to_thread(get_weather_data, latitude, longitude)
+
+@admission.tracked('anthropic')
+async def generate_color_palette_async(city, weather_data, weather_description):
+    """Generate color palette using Anthropic API."""
+    try:
+        upstream = upstreams['anthropic']
+        response = await upstream.call_async(lambda: get_async_anthropic().messages.create(
+            **color_palette_request(city, weather_data, weather_description), timeout=upstream.timeout()))
+        colors = json.loads(response.content[0].text)
+        return validate_color_palette(colors)
+    except Exception as e:
+        metrics.upstream_errors.inc(upstream='anthropic')
+        log.error("palette generation failed", city=city, error=str(e))
+        return None
+
+@admission.tracked('anthropic')
+async def generate_font_recommendations_async(city, weather_data):
+    """Generate font recommendations using Anthropic API."""
+    try:
+        upstream = upstreams['anthropic']
+        response = await upstream.call_async(lambda: get_async_anthropic().messages.create(
+            **font_recommendations_request(city, weather_data), timeout=upstream.timeout()))
+        font_data = json.loads(response.content[0].text)
+        return validate_font_recommendations(font_data)
+    except Exception as e:
+        metrics.upstream_errors.inc(upstream='anthropic')
+        log.error("font recommendation failed", city=city, error=str(e))
+        return None
+
+@admission.tracked('anthropic')
+async def generate_theme_async(city, weather_data, weather_description):
+    """Generate a color palette and font recommendations in a single Anthropic call."""
+    try:
+        upstream = upstreams['anthropic']
+        response = await upstream.call_async(lambda: get_async_anthropic().messages.create(
+            **theme_request(city, weather_data, weather_description), timeout=upstream.timeout()))
+        data = json.loads(response.content[0].text)
+    except Exception as e:
+        metrics.upstream_errors.inc(upstream='anthropic')
+        log.error("theme generation failed", city=city, error=str(e))
+        return {'colors': None, 'fonts': None}
+    return parse_theme(data)
+
+async def _generate_palette(city, weather_data, weather_description):
+    color_response = await generate_color_palette_async(city, weather_data, weather_description)
+    colors = process_colors(color_response)
+    if color_response:
+        await asyncio.to_thread(design_cache.set, 'palette', city, weather_data, colors)
+    return colors
+
+def _refresh_on_loop(cache, key, coro_fn, *args):
+    """Schedule a stale-entry refresh that runs ``coro_fn(*args)`` on this event loop"""
+    loop = asyncio.get_running_loop()
+    refresher.schedule(cache, key,
+                       lambda: asyncio.run_coroutine_threadsafe(coro_fn(*args), loop).result())
+
+@metrics.timed('palette')
+async def build_palette_async(city, weather_data, weather_description):
+    """Generate and process the color palette for a city, using the design cache"""
+    key = design_cache.make_key('palette', city, weather_data)
+    colors, stale = await asyncio.to_thread(design_cache.lookup, 'palette', city, weather_data)
+    if colors is not None:
+        if stale:
+            _refresh_on_loop('design', repr(key), _generate_palette,
+                             city, weather_data, weather_description)
+        return colors
+
+    return await async_flights.do(repr(key),
+                                  lambda: _generate_palette(city, weather_data, weather_description),
+                                  recheck=lambda: design_cache.peek('palette', city, weather_data))
+
+async def _generate_fonts(city, weather_data):
+    raw_fonts = await generate_font_recommendations_async(city, weather_data)
+    if not raw_fonts:
+        return get_default_fonts()
+    fonts = process_fonts(raw_fonts)
+    await asyncio.to_thread(design_cache.set, 'fonts', city, weather_data, fonts)
+    return fonts
+
+@metrics.timed('fonts')
+async def build_fonts_async(city, weather_data):
+    """Generate and process font recommendations for a city, using the design cache"""
+    key = design_cache.make_key('fonts', city, weather_data)
+    fonts, stale = await asyncio.to_thread(design_cache.lookup, 'fonts', city, weather_data)
+    if fonts is not None:
+        if stale:
+            _refresh_on_loop('design', repr(key), _generate_fonts, city, weather_data)
+        return fonts
+
+    return await async_flights.do(repr(key),
+                                  lambda: _generate_fonts(city, weather_data),
+                                  recheck=lambda: design_cache.peek('fonts', city, weather_data))
+
+async def _generate_theme(city, weather_data, weather_description):
+    colors = await asyncio.to_thread(design_cache.peek, 'palette', city, weather_data)
+    fonts = await asyncio.to_thread(design_cache.peek, 'fonts', city, weather_data)
+
+    theme = await generate_theme_async(city, weather_data, weather_description)
+
+    if colors is None:
+        if theme['colors']:
+            colors = process_colors(theme['colors'])
+            await asyncio.to_thread(design_cache.set, 'palette', city, weather_data, colors)
+        else:
+            colors = get_default_colors()
+
+    if fonts is None:
+        if theme['fonts']:
+            fonts = process_fonts(theme['fonts'])
+            await asyncio.to_thread(design_cache.set, 'fonts', city, weather_data, fonts)
+        else:
+            fonts = get_default_fonts()
+
+    return colors, fonts
+
+@metrics.timed('theme')
+async def build_theme_async(city, weather_data, weather_description):
+    """Generate palette and fonts with one combined call, falling back per section"""
+    key = design_cache.make_key('theme', city, weather_data)
+    colors, colors_stale = await asyncio.to_thread(design_cache.lookup, 'palette', city, weather_data)
+    fonts, fonts_stale = await asyncio.to_thread(design_cache.lookup, 'fonts', city, weather_data)
+    if colors is not None and fonts is not None:
+        if colors_stale or fonts_stale:
+            _refresh_on_loop('design', repr(key), _generate_theme,
+                             city, weather_data, weather_description)
+        return colors, fonts
+
+    return await async_flights.do(repr(key),
+                                  lambda: _generate_theme(city, weather_data, weather_description),
+                                  recheck=lambda: design_cache.peek_theme(city, weather_data))
+
+async def _open_image_async(image_url):
+    """Start an image download; 429s and 5xx raise so they can be retried."""
+    upstream = upstreams['image_download']
+    timeout = httpx.Timeout(upstream.timeout(), connect=upstream.timeout(config.DOWNLOAD_CONNECT_TIMEOUT))
+    client = get_async_http_client()
+    response = await client.send(client.build_request('GET', image_url, timeout=timeout), stream=True)
+    if response.status_code == 429 or response.status_code >= 500:
+        await response.aclose()
+        response.raise_for_status()
+    return response
+
+@metrics.timed('image_download')
+async def download_image_async(image_url, cache_key, filename, city=None, weather=None):
+    """Stream an image into the image store without buffering it in memory."""
+    store = get_image_store()
+    started = time.monotonic()
+    img_response = await upstreams['image_download'].call_async(_open_image_async, image_url)
+    try:
+        if img_response.status_code != 200:
+            metrics.upstream_errors.inc(upstream='image_download')
+            log.error("image download failed", status=img_response.status_code)
+            return None
+
+        declared_size = int(img_response.headers.get('Content-Length') or 0)
+        if declared_size > config.DOWNLOAD_MAX_BYTES:
+            raise ValueError(f"Image too large: {declared_size} bytes")
+
+        fd, tmp_path = store.temp_file()
+        try:
+            downloaded = 0
+            with os.fdopen(fd, 'wb') as f:
+                async for chunk in img_response.aiter_bytes(config.DOWNLOAD_CHUNK_SIZE):
+                    downloaded += len(chunk)
+                    if downloaded > config.DOWNLOAD_MAX_BYTES:
+                        raise ValueError(f"Image exceeds {config.DOWNLOAD_MAX_BYTES} bytes")
+                    f.write(chunk)
+                f.flush()
+                await asyncio.to_thread(os.fsync, f.fileno())
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    finally:
+        await img_response.aclose()
+
+    relative_path = await asyncio.to_thread(store.commit, cache_key, tmp_path, filename,
+                                            city=city, weather=weather)
+    elapsed = max(time.monotonic() - started, 1e-6)
+    metrics.image_download_bytes.inc(downloaded)
+    metrics.image_download_throughput.observe(downloaded / elapsed)
+    return relative_path
+
+@metrics.timed('image')
+@admission.tracked('openai')
+async def _generate_city_image(city, weather_description, cache_key):
+    """Generate a new city image with DALL-E and add it to the image store."""
+    try:
+        filename = f"{cache_key}_{int(time.time())}.png"
+        upstream = upstreams['openai']
+        response = await upstream.call_async(lambda: get_async_openai().images.generate(
+            **city_image_request(city, weather_description), timeout=upstream.timeout()))
+        relative_path = await download_image_async(response.data[0].url, cache_key, filename,
+                                                   city=city, weather=weather_description)
+        if relative_path:
+            log.info("generated image", city=city, weather=weather_description)
+            schedule_derivatives(relative_path)
+        return relative_path
+    except Exception as e:
+        metrics.upstream_errors.inc(upstream='openai')
+        log.error("image generation failed", city=city, error=str(e))
+        return None
+
+async def cached_city_image_async(city, weather_description):
+    """Path of the cached, possibly stale, image; a stale one is refreshed on this loop"""
+    cache_key = image_cache_key(city, weather_description)
+    image_path, stale = await asyncio.to_thread(get_image_store().lookup, cache_key)
+    if stale:
+        _refresh_on_loop('image', f"image:{cache_key}", _generate_city_image_once,
+                         city, weather_description, cache_key)
+    return image_path
+
+async def _generate_city_image_once(city, weather_description, cache_key):
+    store = get_image_store()
+    return await async_flights.do(
+        f"image:{cache_key}",
+        lambda: _generate_city_image(city, weather_description, cache_key),
+        recheck=lambda: store.get(cache_key),
+        shared=True,
+    )
+
+async def generate_city_image_async(city, weather_description):
+    """Generate or retrieve a cached city image based on city and weather description."""
+    try:
+        image_path = await cached_city_image_async(city, weather_description)
+        if image_path:
+            return image_path
+
+        cache_key = image_cache_key(city, weather_description)
+        return await _generate_city_image_once(city, weather_description, cache_key)
+    except Exception as e:
+        log.error("city image failed", city=city, error=str(e))
+        return None
+
+async def start_image_job_async(city, weather_description):
+    """Return a cached image path, or start generation on the loop and return its job id"""
+    image_path = await cached_city_image_async(city, weather_description)
+    if image_path:
+        return image_path, None
+    cache_key = image_cache_key(city, weather_description)
+    job = image_jobs.submit_coroutine(cache_key, generate_city_image_async, city, weather_description)
+    return None, job.id
+
+async def build_image_palette_async(city, weather_data, weather_description, wait=True):
+    """Extract the palette from the city image, as ``build_image_palette`` does"""
+    from image_palette import image_palette
+
+    image_path = await cached_city_image_async(city, weather_description)
+    if image_path is None and wait and config.PALETTE_MODE == 'image':
+        image_path = await generate_city_image_async(city, weather_description)
+    # Decoding and clustering are CPU work; keep them off the event loop
+    colors = await asyncio.to_thread(image_palette, image_path) if image_path else None
+    if colors is not None:
+        await asyncio.to_thread(store_image_palette, city, weather_data, colors)
+        return colors
+    if config.PALETTE_MODE == 'hybrid':
+        return await build_palette_async(city, weather_data, weather_description)
+    return get_default_colors()
+
+def _design_stages(city, weather_data, weather_description, source, shed):
+    """Stage coroutines, timeouts and fallbacks, as in ``design_stages``"""
+    stages = {}
+    if source == 'image':
+        stages['palette'] = (build_image_palette_async(city, weather_data, weather_description,
+                                                       'image' not in shed),
+                             config.PALETTE_TIMEOUT, get_default_colors)
+    if 'theme' in shed:
+        return stages
+    if source == 'image':
+        stages['fonts'] = (build_fonts_async(city, weather_data), config.FONTS_TIMEOUT, get_default_fonts)
+    elif config.THEME_MODE == 'combined':
+        stages['theme'] = (build_theme_async(city, weather_data, weather_description),
+                           max(config.PALETTE_TIMEOUT, config.FONTS_TIMEOUT),
+                           lambda: (get_default_colors(), get_default_fonts()))
+    else:
+        stages['palette'] = (build_palette_async(city, weather_data, weather_description),
+                             config.PALETTE_TIMEOUT, get_default_colors)
+        stages['fonts'] = (build_fonts_async(city, weather_data), config.FONTS_TIMEOUT, get_default_fonts)
+    return stages
+
+async def run_design_stages_async(city, weather_data, weather_description):
+    """Run the palette, font and image stages concurrently and return the template variables.
+
+    Same contract as ``run_design_stages``: each stage is bounded by its own
+    timeout and the page deadline and falls back to its default on failure.
+    """
+    source = await asyncio.to_thread(palette_source, city, weather_description)
+    shed = await asyncio.to_thread(shed_stages, city, weather_data, weather_description, source)
+    stages = _design_stages(city, weather_data, weather_description, source, shed)
+    image_job = None
+    if 'image' in shed:
+        image_path = await asyncio.to_thread(nearest_image, city, weather_description)
+    elif config.ASYNC_IMAGES:
+        image_path, image_job = await start_image_job_async(city, weather_description)
+    else:
+        stages['image'] = (generate_city_image_async(city, weather_description),
+                           config.IMAGE_TIMEOUT, lambda: None)
+
+    page_deadline = time.monotonic() + config.PAGE_DEADLINE
+    tasks = {name: asyncio.ensure_future(coro) for name, (coro, _timeout, _fallback) in stages.items()}
+    started = time.monotonic()
+
+    results, fallbacks = {}, []
+    try:
+        for name, task in tasks.items():
+            _coro, timeout, fallback = stages[name]
+            remaining = min(started + timeout, page_deadline) - time.monotonic()
+            # asyncio.wait leaves the stage running on timeout and raises
+            # CancelledError only when this page is cancelled, so a stage that
+            # was cancelled on its own is told apart and falls back like a failure
+            await asyncio.wait({task}, timeout=max(remaining, 0))
+            if not task.done():
+                log.warning("stage timed out, using fallback", stage=name)
+                task.cancel()
+            elif task.cancelled():
+                log.error("stage failed", stage=name, error="cancelled")
+            elif task.exception() is not None:
+                log.error("stage failed", stage=name, error=str(task.exception()))
+            else:
+                results[name] = task.result()
+                continue
+            results[name] = fallback()
+            fallbacks.append(name)
+    finally:
+        for task in tasks.values():
+            task.cancel()
+
+    if 'theme' in shed:
+        colors, processed_fonts = await asyncio.to_thread(last_known_theme, city)
+        colors = results.get('palette', colors)
+    elif 'theme' in results:
+        colors, processed_fonts = results['theme']
+    else:
+        colors, processed_fonts = results['palette'], results['fonts']
+    if 'image' in results:
+        image_path = results['image']
+    return {
+        'colors': colors,
+        'fonts': processed_fonts,
+        'font_css_vars': get_css_variables(processed_fonts),
+        'image_path': image_path,
+        'image_variants': await asyncio.to_thread(image_variants, image_path),
+        'image_job': image_job,
+        'fallbacks': fallbacks,
+        'degraded': shed,
+    }
+
+def render(template, path='/', **context):
+    """Render a Flask template outside a WSGI request"""
+    from flask import render_template
+    with app.test_request_context(path):
+        return render_template(template, **context)
+
+def render_error(error):
+    default_fonts = get_default_fonts()
+    return render('index.html', error=error, fonts=default_fonts,
+                  font_css_vars=get_css_variables(default_fonts),
+                  colors=get_default_colors())
+
+async def render_city_page(city):
+    """Render the full page for a city; the async counterpart of the POST / handler.
+
+    Reuses a cached render for the city's weather bucket, as the sync path
+    does. Returns the page body and the stages shed by admission control.
+    """
+    try:
+        coordinates = await get_city_coordinates_async(city)
+        if not coordinates:
+            return render_error("City not found"), []
+
+        weather_data = await get_weather_data_async(*coordinates)
+        if not weather_data:
+            return render_error("Could not fetch weather data"), []
+
+        weather_description = get_weather_description(weather_data['current']['weather_code'])
+        await asyncio.to_thread(prewarmer.note_request, city, weather_data, weather_description)
+
+        key = page_cache.city_key(city, weather_data)
+        if config.PAGE_CACHE:
+            page = await asyncio.to_thread(page_cache.get, key)
+            if page is not None:
+                return page.body, []
+
+        design = await run_design_stages_async(city, weather_data, weather_description)
+        with metrics.time_stage('render'):
+            body = render('index.html', city=city, weather_data=weather_data,
+                          weather_description=weather_description, **design)
+        if config.PAGE_CACHE and await asyncio.to_thread(is_cacheable, city, weather_data, design):
+            await asyncio.to_thread(page_cache.set, key, body)
+        return body, design['degraded']
+    except asyncio.CancelledError:
+        if cancelling():
+            raise
+        log.error("main route handler failed", error="cancelled")
+        return render_error("Page generation was cancelled"), []
+    except Exception as e:
+        log.exception("main route handler failed", error=str(e))
+        return render_error(str(e)), []
+
+async def stream_page_async(city):
+    """Yield SSE events for a city page, each section as soon as it is ready.
+
+    The async counterpart of ``stream_page``, with the same events, heartbeats
+    and deadline.
+    """
+    coordinates = await get_city_coordinates_async(city)
+    if not coordinates:
+        yield sse_event('error', {'error': "City not found"})
+        return
+
+    weather_data = await get_weather_data_async(*coordinates)
+    if not weather_data:
+        yield sse_event('error', {'error': "Could not fetch weather data"})
+        return
+
+    weather_description = get_weather_description(weather_data['current']['weather_code'])
+    await asyncio.to_thread(prewarmer.note_request, city, weather_data, weather_description)
+    yield sse_event('weather', {
+        'city': city,
+        'weather_description': weather_description,
+        'html': render('_weather.html', city=city, weather_data=weather_data,
+                       weather_description=weather_description, image_pending=True),
+    })
+
+    source = await asyncio.to_thread(palette_source, city, weather_description)
+    shed = await asyncio.to_thread(shed_stages, city, weather_data, weather_description, source)
+    stages = _design_stages(city, weather_data, weather_description, source, shed)
+    fallbacks = {name: fallback for name, (_coro, _timeout, fallback) in stages.items()}
+    fallbacks['image'] = lambda: None
+    tasks = {asyncio.ensure_future(coro): name for name, (coro, _timeout, _fallback) in stages.items()}
+    if 'theme' in shed:
+        # An image palette stage still runs; only the fonts come from the last known theme
+        colors, fonts = await asyncio.to_thread(last_known_theme, city)
+        yield await (_section_events('fonts', fonts) if 'palette' in stages
+                     else _section_events('theme', (colors, fonts)))
+
+    if 'image' in shed:
+        image_path, image_job = await asyncio.to_thread(nearest_image, city, weather_description), None
+    else:
+        image_path, image_job = await start_image_job_async(city, weather_description)
+    if image_job:
+        tasks[image_jobs.get(image_job).wait_async()] = 'image'
+    else:
+        yield await _section_events('image', image_path)
+
+    stream_deadline = time.monotonic() + config.STREAM_DEADLINE
+    while tasks:
+        remaining = stream_deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        done, _pending = await asyncio.wait(tasks, timeout=min(config.STREAM_HEARTBEAT, remaining),
+                                            return_when=asyncio.FIRST_COMPLETED)
+        if not done:
+            yield ": keep-alive\n\n"
+            continue
+
+        for task in done:
+            name = tasks.pop(task)
+            if task.cancelled() or task.exception() is not None:
+                log.error("stage failed", stage=name,
+                          error="cancelled" if task.cancelled() else str(task.exception()))
+                yield await _section_events(name, fallbacks[name]())
+            elif name == 'image':
+                yield await _section_events(name, task.result().result)
+            else:
+                yield await _section_events(name, task.result())
+
+    for name in tasks.values():
+        log.warning("stage timed out, using fallback", stage=name)
+        yield await _section_events(name, fallbacks[name]())
+    yield sse_event('done', {'degraded': shed})
+
+async def _section_events(name, result):
+    """All SSE events for a finished stage, joined into one chunk; built in a
+    worker thread, as the image event reads the image store"""
+    return await asyncio.to_thread(lambda: ''.join(section_events(name, result)))
@@ -0,0 +1,101 @@
+"""Micro-benchmark of the Open-Meteo forecast decode path.
+
+Times ``decode_weather_response`` on a FlatBuffers payload from the fake
+Open-Meteo server, against the old pandas DataFrame decoder when pandas is
+installed. It also measures, in fresh interpreters, how long ``import pandas``
+takes and how much resident memory it adds, which the app no longer pays.
+
+    python bench/decode_bench.py --number 20000
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import timeit
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import fake_upstreams  # noqa: E402
+from notebook_functions import decode_weather_messages, decode_weather_response  # noqa: E402
+
+IMPORT_PROBE = """
+import time
+def rss_kb():
+    with open('/proc/self/status') as f:
+        return next(int(line.split()[1]) for line in f if line.startswith('VmRSS:'))
+before = rss_kb()
+started = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - started
+print(elapsed, rss_kb() - before)
+"""
+
+
+def decode_with_pandas(response):
+    """The previous decoder: a DataFrame and date_range turned into records"""
+    import pandas as pd
+
+    current = response.Current()
+    current_data = {name: current.Variables(i).Value() for i, name in enumerate(
+        ('temperature', 'is_day', 'precipitation', 'weather_code', 'cloud_cover', 'wind_speed'))}
+    daily = response.Daily()
+    forecast_data = pd.DataFrame({
+        "date": pd.date_range(
+            start=pd.to_datetime(daily.Time(), unit="s", utc=True),
+            end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
+            freq=pd.Timedelta(seconds=daily.Interval()),
+            inclusive="left"
+        ),
+        "weather_code": daily.Variables(0).ValuesAsNumpy(),
+        "temperature_max": daily.Variables(1).ValuesAsNumpy(),
+        "temperature_min": daily.Variables(2).ValuesAsNumpy(),
+        "precipitation_sum": daily.Variables(3).ValuesAsNumpy(),
+        "precipitation_hours": daily.Variables(4).ValuesAsNumpy(),
+        "precipitation_probability": daily.Variables(5).ValuesAsNumpy(),
+        "wind_speed_max": daily.Variables(6).ValuesAsNumpy()
+    }).to_dict('records')
+    return {'current': current_data, 'forecast': forecast_data}
+
+
+def per_call_us(fn, number, repeat=5):
+    return min(timeit.repeat(fn, number=number, repeat=repeat)) / number * 1e6
+
+
+def import_cost(module, runs):
+    """Median import time (ms) and RSS growth (MB) of ``module`` in fresh interpreters"""
+    times, rss = [], []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', IMPORT_PROBE.format(module=module)],
+                                capture_output=True, text=True, cwd=REPO_DIR, check=True).stdout
+        elapsed, grown_kb = output.split()
+        times.append(float(elapsed) * 1000)
+        rss.append(int(grown_kb) / 1024)
+    return statistics.median(times), statistics.median(rss)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--number', type=int, default=5000, help="Decodes per timing run")
+    parser.add_argument('--import-runs', type=int, default=5, help="Fresh interpreters per import")
+    args = parser.parse_args()
+
+    response = decode_weather_messages(fake_upstreams.weather_payload(48.85, 2.35))[0]
+    print(f"decode_weather_response: {per_call_us(lambda: decode_weather_response(response), args.number):8.1f} us/call")
+
+    try:
+        import pandas  # noqa: F401
+    except ImportError:
+        print("pandas is not installed; skipping the DataFrame decoder and its import cost")
+        return
+
+    print(f"pandas DataFrame decoder: {per_call_us(lambda: decode_with_pandas(response), args.number // 10):8.1f} us/call")
+    import_ms, import_mb = import_cost('pandas', args.import_runs)
+    print(f"import pandas:           {import_ms:8.1f} ms, +{import_mb:.1f} MB RSS")
+
+
+if __name__ == '__main__':
+    main()
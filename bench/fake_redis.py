@@ -0,0 +1,216 @@
+"""Local stand-in for a Redis server, for running the redis cache backend offline.
+
+A threaded TCP server speaking RESP2 with the commands cache_backends uses:
+PING, AUTH, SELECT, GET, SET (with EX/PX), DEL, EXISTS, DBSIZE, FLUSHDB, ZADD
+(with XX/NX), ZCARD, ZPOPMIN, ZRANGE and ZREM. Keys expire on access, as in
+Redis. Run standalone with
+
+    python bench/fake_redis.py --port 6399
+
+and point the app at it with ``SW_CACHE_BACKEND=redis SW_REDIS_URL=redis://127.0.0.1:6399/0``.
+"""
+import argparse
+import socketserver
+import threading
+import time
+
+
+class Store:
+    """Strings with optional expiry and sorted sets, guarded by one lock"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.strings = {}
+        self.zsets = {}
+        self.commands = 0
+
+    def _live(self, key):
+        entry = self.strings.get(key)
+        if entry is not None and entry[1] is not None and entry[1] <= time.time():
+            del self.strings[key]
+            return None
+        return entry
+
+    def execute(self, args):
+        command, args = args[0].upper(), args[1:]
+        with self.lock:
+            self.commands += 1
+            handler = getattr(self, f"cmd_{command.decode('ascii', 'replace').lower()}", None)
+            if handler is None:
+                return RuntimeError(f"ERR unknown command '{command.decode('ascii', 'replace')}'")
+            try:
+                return handler(*args)
+            except (TypeError, ValueError, IndexError):
+                return RuntimeError(f"ERR wrong arguments for '{command.decode('ascii', 'replace')}'")
+
+    def cmd_ping(self, *args):
+        return args[0] if args else 'PONG'
+
+    def cmd_auth(self, *args):
+        return 'OK'
+
+    def cmd_select(self, db):
+        return 'OK'
+
+    def cmd_get(self, key):
+        entry = self._live(key)
+        return None if entry is None else entry[0]
+
+    def cmd_set(self, key, value, *options):
+        expires_at = None
+        options = [option.upper() for option in options]
+        if b'EX' in options:
+            expires_at = time.time() + int(options[options.index(b'EX') + 1])
+        if b'PX' in options:
+            expires_at = time.time() + int(options[options.index(b'PX') + 1]) / 1000
+        self.strings[key] = (value, expires_at)
+        return 'OK'
+
+    def cmd_del(self, *keys):
+        removed = 0
+        for key in keys:
+            removed += self._live(key) is not None or key in self.zsets
+            self.strings.pop(key, None)
+            self.zsets.pop(key, None)
+        return removed
+
+    def cmd_exists(self, *keys):
+        return sum(self._live(key) is not None or key in self.zsets for key in keys)
+
+    def cmd_dbsize(self):
+        return sum(self._live(key) is not None for key in list(self.strings)) + len(self.zsets)
+
+    def cmd_flushdb(self, *args):
+        self.strings.clear()
+        self.zsets.clear()
+        return 'OK'
+
+    def cmd_zadd(self, key, *args):
+        flags = set()
+        while args and args[0].upper() in (b'XX', b'NX'):
+            flags.add(args[0].upper())
+            args = args[1:]
+        zset = self.zsets.setdefault(key, {})
+        added = 0
+        for score, member in zip(args[::2], args[1::2]):
+            exists = member in zset
+            if (b'XX' in flags and not exists) or (b'NX' in flags and exists):
+                continue
+            added += not exists
+            zset[member] = float(score)
+        if not zset:
+            del self.zsets[key]
+        return added
+
+    def cmd_zcard(self, key):
+        return len(self.zsets.get(key, {}))
+
+    def _ordered(self, key):
+        return sorted(self.zsets.get(key, {}).items(), key=lambda item: (item[1], item[0]))
+
+    def cmd_zpopmin(self, key, count=b'1'):
+        popped = self._ordered(key)[:int(count)]
+        reply = []
+        for member, score in popped:
+            del self.zsets[key][member]
+            reply.extend([member, repr(score).encode('ascii')])
+        if key in self.zsets and not self.zsets[key]:
+            del self.zsets[key]
+        return reply
+
+    def cmd_zrange(self, key, start, stop):
+        members = [member for member, _score in self._ordered(key)]
+        start, stop = int(start), int(stop)
+        stop = len(members) + stop if stop < 0 else stop
+        return members[start:stop + 1]
+
+    def cmd_zrem(self, key, *members):
+        zset = self.zsets.get(key, {})
+        removed = sum(zset.pop(member, None) is not None for member in members)
+        if key in self.zsets and not zset:
+            del self.zsets[key]
+        return removed
+
+
+def encode(reply):
+    if reply is None:
+        return b'$-1\r\n'
+    if isinstance(reply, RuntimeError):
+        return b'-%s\r\n' % str(reply).encode('utf-8')
+    if isinstance(reply, str):
+        return b'+%s\r\n' % reply.encode('utf-8')
+    if isinstance(reply, (bool, int)):
+        return b':%d\r\n' % reply
+    if isinstance(reply, bytes):
+        return b'$%d\r\n%s\r\n' % (len(reply), reply)
+    return b'*%d\r\n' % len(reply) + b''.join(encode(item) for item in reply)
+
+
+class Handler(socketserver.StreamRequestHandler):
+    store = None
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        if not line.startswith(b'*'):
+            # Inline command, as typed into telnet or redis-cli --no-raw
+            return line.split()
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        while True:
+            try:
+                args = self.read_command()
+            except (ConnectionError, ValueError):
+                return
+            if args is None:
+                return
+            if not args:
+                continue
+            self.wfile.write(encode(self.store.execute(args)))
+            self.wfile.flush()
+
+
+class Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+def start(port=0):
+    """Start the fake Redis in a background thread; returns ``(server, store)``"""
+    store = Store()
+    handler = type('BoundHandler', (Handler,), {'store': store})
+    server = Server(('127.0.0.1', port), handler)
+    threading.Thread(target=server.serve_forever, name='fake-redis', daemon=True).start()
+    return server, store
+
+
+def app_env(port):
+    """Environment variables that move every app cache onto the fake Redis"""
+    return {
+        'SW_CACHE_BACKEND': 'redis',
+        'SW_REDIS_URL': f"redis://127.0.0.1:{port}/0",
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=6399)
+    args = parser.parse_args()
+
+    server, _store = start(args.port)
+    for name, value in app_env(server.server_address[1]).items():
+        print(f"export {name}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
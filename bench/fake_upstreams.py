@@ -0,0 +1,359 @@
+"""Local stand-ins for every upstream the app calls, for offline benchmarks.
+
+One threaded HTTP server answers:
+
+- ``GET /search``: Nominatim geocoding (JSON)
+- ``GET /v1/forecast``: Open-Meteo, as a size-prefixed FlatBuffers WeatherApiResponse
+- ``POST /v1/messages``: Anthropic messages (palette, fonts or combined theme)
+- ``POST /v1/images/generations``: OpenAI images, pointing at ``/images/<n>.png``
+- ``GET /images/<n>.png``: the generated image itself
+
+Each upstream gets a log-normal latency (median and spread), an error rate and
+the HTTP status its injected errors use, so slow, flaky, rate-limited (429) or
+down providers can be simulated. Faults can be changed while the server runs,
+with ``Upstreams.set_fault`` in process or ``POST /_faults`` with a JSON body
+such as ``{"anthropic": {"error_rate": 1.0, "status": 503}}``. Run standalone with
+
+    python bench/fake_upstreams.py --port 8900 --latency anthropic=1500 --errors openmeteo=0.05
+
+and point the app at it with the variables printed by ``app_env``.
+"""
+import argparse
+import hashlib
+import json
+import math
+import random
+import struct
+import threading
+import time
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+import flatbuffers
+
+# Median latency (ms), log-normal spread (sigma), error rate and error status per upstream
+DEFAULT_PROFILE = {
+    'nominatim': {'latency_ms': 120, 'sigma': 0.3, 'error_rate': 0.0, 'status': 500},
+    'openmeteo': {'latency_ms': 80, 'sigma': 0.3, 'error_rate': 0.0, 'status': 500},
+    'anthropic': {'latency_ms': 1800, 'sigma': 0.4, 'error_rate': 0.0, 'status': 500},
+    'openai': {'latency_ms': 9000, 'sigma': 0.3, 'error_rate': 0.0, 'status': 500},
+    'image': {'latency_ms': 300, 'sigma': 0.3, 'error_rate': 0.0, 'status': 500},
+}
+
+COLORS = ['color_page_background', 'color_tiles_container', 'color_tiles', 'color_tile_heading',
+          'color_tile_temp_high', 'color_tile_temp_low', 'color_tile_weather_details']
+
+FONTS = {
+    'primary_heading': {'family': 'Playfair Display', 'weight': '700', 'style': 'normal', 'fallback': 'serif'},
+    'secondary_heading': {'family': 'Montserrat', 'weight': '600', 'style': 'normal', 'fallback': 'sans-serif'},
+    'body_text': {'family': 'Open Sans', 'weight': '400', 'style': 'normal', 'fallback': 'sans-serif'},
+    'accent_text': {'family': 'Roboto Condensed', 'weight': '400', 'style': 'normal', 'fallback': 'sans-serif'},
+}
+
+# Current and daily variables in the order the app requests them
+CURRENT_VARIABLES = 6
+DAILY_VARIABLES = 7
+
+
+def _seed(text):
+    return int.from_bytes(hashlib.sha1(text.encode('utf-8')).digest()[:4], 'little')
+
+
+def _variable(builder, value=None, values=None):
+    """Build a VariableWithValues table with a scalar ``value`` or a float ``values`` vector"""
+    vector = None
+    if values is not None:
+        builder.StartVector(4, len(values), 4)
+        for v in reversed(values):
+            builder.PrependFloat32(v)
+        vector = builder.EndVector()
+    builder.StartObject(13)
+    if vector is not None:
+        builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+    if value is not None:
+        builder.PrependFloat32Slot(2, value, 0.0)
+    return builder.EndObject()
+
+
+def _variables_with_time(builder, variables, start, end, interval):
+    builder.StartVector(4, len(variables), 4)
+    for offset in reversed(variables):
+        builder.PrependUOffsetTRelative(offset)
+    vector = builder.EndVector()
+    builder.StartObject(4)
+    builder.PrependInt64Slot(0, start, 0)
+    builder.PrependInt64Slot(1, end, 0)
+    builder.PrependInt32Slot(2, interval, 0)
+    builder.PrependUOffsetTRelativeSlot(3, vector, 0)
+    return builder.EndObject()
+
+
+def weather_payload(latitude, longitude, days=7):
+    """Size-prefixed FlatBuffers WeatherApiResponse like Open-Meteo's ``format=flatbuffers``"""
+    rng = random.Random(_seed(f"{latitude:.2f},{longitude:.2f}"))
+    builder = flatbuffers.Builder(1024)
+
+    weather_code = rng.choice([0, 1, 2, 3, 45, 61, 63, 71, 80, 95])
+    current = [_variable(builder, value=v) for v in (
+        rng.uniform(-10, 35), 1.0, rng.uniform(0, 5), weather_code,
+        rng.uniform(0, 100), rng.uniform(0, 40))]
+    assert len(current) == CURRENT_VARIABLES
+
+    daily = [
+        _variable(builder, values=[rng.choice([0, 2, 3, 61, 80]) for _ in range(days)]),
+        _variable(builder, values=[rng.uniform(10, 35) for _ in range(days)]),
+        _variable(builder, values=[rng.uniform(-10, 10) for _ in range(days)]),
+        _variable(builder, values=[rng.uniform(0, 20) for _ in range(days)]),
+        _variable(builder, values=[rng.uniform(0, 24) for _ in range(days)]),
+        _variable(builder, values=[rng.uniform(0, 100) for _ in range(days)]),
+        _variable(builder, values=[rng.uniform(0, 60) for _ in range(days)]),
+    ]
+    assert len(daily) == DAILY_VARIABLES
+
+    now = int(time.time())
+    midnight = now - now % 86400
+    current_table = _variables_with_time(builder, current, now, now + 900, 900)
+    daily_table = _variables_with_time(builder, daily, midnight, midnight + days * 86400, 86400)
+
+    builder.StartObject(15)
+    builder.PrependFloat32Slot(0, latitude, 0.0)
+    builder.PrependFloat32Slot(1, longitude, 0.0)
+    builder.PrependUOffsetTRelativeSlot(9, current_table, 0)
+    builder.PrependUOffsetTRelativeSlot(10, daily_table, 0)
+    builder.Finish(builder.EndObject())
+    body = bytes(builder.Output())
+    return struct.pack('<I', len(body)) + body
+
+
+def png_bytes(width=1792, height=1024, seed=0):
+    """A valid RGB PNG filled with a vertical gradient"""
+    rng = random.Random(seed)
+    top = [rng.randrange(256) for _ in range(3)]
+    bottom = [rng.randrange(256) for _ in range(3)]
+    rows = []
+    for y in range(height):
+        t = y / max(height - 1, 1)
+        pixel = bytes(int(a + (b - a) * t) for a, b in zip(top, bottom))
+        rows.append(b'\x00' + pixel * width)
+
+    def chunk(kind, data):
+        return (struct.pack('>I', len(data)) + kind + data
+                + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff))
+
+    header = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return (b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', header)
+            + chunk(b'IDAT', zlib.compress(b''.join(rows), 6)) + chunk(b'IEND', b''))
+
+
+def _palette(rng):
+    return {name: '#%02X%02X%02X' % (rng.randrange(256), rng.randrange(256), rng.randrange(256))
+            for name in COLORS}
+
+
+def claude_reply(prompt):
+    """Text of a plausible reply to one of the app's palette, font or theme prompts"""
+    rng = random.Random(_seed(prompt))
+    if 'top-level keys: colors, fonts' in prompt:
+        return json.dumps({'colors': _palette(rng), 'fonts': FONTS})
+    if 'primary_heading' in prompt:
+        return json.dumps(FONTS)
+    return json.dumps(_palette(rng))
+
+
+class Upstreams:
+    """Shared state of the fake server: latency profile, request counts and the image"""
+
+    def __init__(self, profile=None, image_size=(1792, 1024)):
+        self.profile = {name: dict(settings) for name, settings in DEFAULT_PROFILE.items()}
+        for name, settings in (profile or {}).items():
+            self.profile.setdefault(name, {}).update(settings)
+        self.image = png_bytes(*image_size)
+        self.counts = {name: 0 for name in self.profile}
+        self.errors = {name: 0 for name in self.profile}
+        self._lock = threading.Lock()
+
+    def set_fault(self, upstream, **settings):
+        """Change an upstream's latency, error rate or error status while running"""
+        with self._lock:
+            self.profile[upstream] = dict(self.profile[upstream], **settings)
+
+    def delay(self, upstream):
+        """Sleep for a sampled latency; return the error status if this call should fail"""
+        with self._lock:
+            settings = dict(self.profile[upstream])
+        median = settings['latency_ms'] / 1000.0
+        if median > 0:
+            time.sleep(random.lognormvariate(math.log(median), settings['sigma']))
+        failed = random.random() < settings['error_rate']
+        with self._lock:
+            self.counts[upstream] += 1
+            if failed:
+                self.errors[upstream] += 1
+        return settings['status'] if failed else None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    upstreams = None
+
+    def log_message(self, format, *args):
+        pass
+
+    def _send(self, status, body, content_type='application/json'):
+        if isinstance(body, (dict, list)):
+            body = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _fail(self, status):
+        self._send(status, {'error': {'type': 'api_error', 'message': 'Injected failure'}})
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        return json.loads(self.rfile.read(length) or b'{}')
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+
+        if url.path == '/search':
+            status = self.upstreams.delay('nominatim')
+            if status:
+                return self._fail(status)
+            city = query.get('q', [''])[0]
+            rng = random.Random(_seed(city.lower()))
+            return self._send(200, [{
+                'lat': f"{rng.uniform(-60, 70):.5f}",
+                'lon': f"{rng.uniform(-180, 180):.5f}",
+                'display_name': city,
+            }])
+
+        if url.path == '/v1/forecast':
+            status = self.upstreams.delay('openmeteo')
+            if status:
+                return self._fail(status)
+            # Comma-separated lists request several locations, answered in order
+            latitudes = query.get('latitude', ['0'])[0].split(',')
+            longitudes = query.get('longitude', ['0'])[0].split(',')
+            body = b''.join(weather_payload(float(lat), float(lon))
+                            for lat, lon in zip(latitudes, longitudes))
+            return self._send(200, body, 'application/octet-stream')
+
+        if url.path.startswith('/images/'):
+            status = self.upstreams.delay('image')
+            if status:
+                return self._fail(status)
+            return self._send(200, self.upstreams.image, 'image/png')
+
+        self._send(404, {'error': 'not found'})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        request = self._read_json()
+
+        if url.path == '/_faults':
+            for name, settings in request.items():
+                self.upstreams.set_fault(name, **settings)
+            return self._send(200, self.upstreams.profile)
+
+        if url.path == '/v1/messages':
+            status = self.upstreams.delay('anthropic')
+            if status:
+                return self._fail(status)
+            prompt = request['messages'][0]['content']
+            return self._send(200, {
+                'id': 'msg_bench', 'type': 'message', 'role': 'assistant',
+                'model': request.get('model'), 'stop_reason': 'end_turn', 'stop_sequence': None,
+                'content': [{'type': 'text', 'text': claude_reply(prompt)}],
+                'usage': {'input_tokens': len(prompt) // 4, 'output_tokens': 200},
+            })
+
+        if url.path == '/v1/images/generations':
+            status = self.upstreams.delay('openai')
+            if status:
+                return self._fail(status)
+            name = random.getrandbits(32)
+            return self._send(200, {
+                'created': int(time.time()),
+                'data': [{'url': f"http://{self.headers['Host']}/images/{name}.png"}],
+            })
+
+        self._send(404, {'error': 'not found'})
+
+
+def start(port=0, profile=None, image_size=(1792, 1024)):
+    """Start the fake upstreams in a background thread; returns ``(server, upstreams)``"""
+    upstreams = Upstreams(profile, image_size)
+    handler = type('BoundHandler', (Handler,), {'upstreams': upstreams})
+    server = ThreadingHTTPServer(('127.0.0.1', port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='fake-upstreams', daemon=True).start()
+    return server, upstreams
+
+
+def app_env(port):
+    """Environment variables that point the app at the fake upstreams"""
+    base = f"http://127.0.0.1:{port}"
+    return {
+        'SW_NOMINATIM_DOMAIN': f"127.0.0.1:{port}",
+        'SW_NOMINATIM_SCHEME': 'http',
+        'SW_OPEN_METEO_URL': f"{base}/v1/forecast",
+        'ANTHROPIC_BASE_URL': base,
+        'ANTHROPIC_API_KEY': 'bench',
+        'OPENAI_BASE_URL': f"{base}/v1",
+        'OPENAI_API_KEY': 'bench',
+    }
+
+
+def parse_settings(specs, key, convert=float):
+    """Turn ``['anthropic=1500', ...]`` into ``{'anthropic': {key: 1500.0}}``"""
+    profile = {}
+    for spec in specs or []:
+        name, _, value = spec.partition('=')
+        if name not in DEFAULT_PROFILE:
+            raise ValueError(f"Unknown upstream {name!r}; expected one of {', '.join(DEFAULT_PROFILE)}")
+        profile.setdefault(name, {})[key] = convert(value)
+    return profile
+
+
+def add_profile_arguments(parser):
+    parser.add_argument('--latency', action='append', metavar='UPSTREAM=MS',
+                        help="Median latency in ms for an upstream (repeatable)")
+    parser.add_argument('--spread', action='append', metavar='UPSTREAM=SIGMA',
+                        help="Log-normal sigma of an upstream's latency (repeatable)")
+    parser.add_argument('--errors', action='append', metavar='UPSTREAM=RATE',
+                        help="Fraction of an upstream's calls that fail (repeatable)")
+    parser.add_argument('--status', action='append', metavar='UPSTREAM=CODE',
+                        help="HTTP status of an upstream's injected failures, default 500 (repeatable)")
+
+
+def profile_from_args(args):
+    profile = {}
+    for specs, key, convert in ((args.latency, 'latency_ms', float), (args.spread, 'sigma', float),
+                                (args.errors, 'error_rate', float), (args.status, 'status', int)):
+        for name, settings in parse_settings(specs, key, convert).items():
+            profile.setdefault(name, {}).update(settings)
+    return profile
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--port', type=int, default=8900)
+    add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    server, _upstreams = start(args.port, profile_from_args(args))
+    for name, value in app_env(server.server_port).items():
+        print(f"export {name}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""Offline fault-injection run of the resilience layer.
+
+Starts bench/fake_upstreams.py in-process and the app as a separate server,
+as bench/load_test.py does, then drives POST / through three phases:
+
+- ``healthy``: every upstream answers normally;
+- ``outage``: each ``--fail`` upstream fails every call with ``--fault-status``;
+- ``recovery``: faults are cleared after the circuit reset timeout, so the
+  half-open probes go through and the circuits close again.
+
+For each phase it reports the error and degraded (X-Degraded) rates, p50/p99
+latency and how many calls reached each upstream, then the circuit breaker
+transitions and rejected calls from /metrics.
+
+    python bench/fault_bench.py --fail anthropic --fail openai --duration 10
+    python bench/fault_bench.py --fail openmeteo --fault-status 429 --concurrency 16
+
+Caches start cold and ``--cities`` should stay large, so most requests need
+the upstreams.
+"""
+import argparse
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+
+import fake_upstreams  # noqa: E402
+from load_test import (  # noqa: E402
+    ERROR_MARKER,
+    REPO_DIR,
+    app_environment,
+    city_names,
+    free_port,
+    percentile,
+    server_command,
+    wait_until_ready,
+)
+
+METRIC_LINE = re.compile(r'^(circuit_transitions_total|upstream_rejections_total|upstream_retries_total)'
+                         r'\{(.*)\} (\S+)$')
+
+
+def run_phase(base_url, cities, offset, concurrency, duration, timeout):
+    """POST / with ``concurrency`` clients for ``duration`` seconds; returns the results
+    and the next unused city offset"""
+    latencies, errors, degraded = [], 0, 0
+    lock = threading.Lock()
+    counter = iter(range(offset, 10 ** 9))
+    stop_at = time.monotonic() + duration
+
+    def client():
+        nonlocal errors, degraded
+        session = requests.Session()
+        while time.monotonic() < stop_at:
+            with lock:
+                city = cities[next(counter) % len(cities)]
+            started = time.perf_counter()
+            try:
+                response = session.post(base_url, data={'city': city}, timeout=timeout)
+                failed = response.status_code != 200 or ERROR_MARKER in response.text
+                shed = bool(response.headers.get('X-Degraded'))
+            except requests.RequestException:
+                failed, shed = True, False
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                errors += failed
+                degraded += shed
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    count = len(latencies) or 1
+    return {
+        'requests': len(latencies),
+        'error_pct': round(100.0 * errors / count, 1),
+        'degraded_pct': round(100.0 * degraded / count, 1),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+    }, next(counter)
+
+
+def resilience_metrics(base_url):
+    """Circuit transitions, rejections and retries scraped from /metrics"""
+    lines = []
+    for line in requests.get(base_url + 'metrics', timeout=10).text.splitlines():
+        match = METRIC_LINE.match(line)
+        if match:
+            lines.append(f"{match.group(1)}{{{match.group(2)}}} {match.group(3)}")
+    return lines
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--fail', action='append', default=[], metavar='UPSTREAM',
+                        choices=sorted(fake_upstreams.DEFAULT_PROFILE),
+                        help="Upstream to take down during the outage phase (repeatable)")
+    parser.add_argument('--fault-status', type=int, default=503, help="HTTP status of the injected failures")
+    parser.add_argument('--concurrency', type=int, default=8)
+    parser.add_argument('--duration', type=float, default=10.0, help="Seconds per phase")
+    parser.add_argument('--cities', type=int, default=2000, help="Distinct cities to cycle through")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Client timeout per request")
+    parser.add_argument('--reset-timeout', type=float, default=5.0,
+                        help="SW_CIRCUIT_RESET_TIMEOUT for the app")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="Extra environment for the app, e.g. SW_UPSTREAM_RETRIES=0")
+    fake_upstreams.add_profile_arguments(parser)
+    args = parser.parse_args()
+    failing = args.fail or ['anthropic', 'openai']
+
+    upstream_server, upstreams = fake_upstreams.start(0, fake_upstreams.profile_from_args(args))
+    state_dir = tempfile.mkdtemp(prefix='sw-faults-')
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}/"
+    extra_env = {
+        'SW_CIRCUIT_RESET_TIMEOUT': str(args.reset_timeout),
+        'SW_ASYNC_IMAGES': '0',
+        'SW_PAGE_CACHE': '0',
+        **dict(spec.split('=', 1) for spec in args.env),
+    }
+    env = app_environment(upstream_server.server_port, state_dir, extra_env)
+    process = subprocess.Popen(server_command('werkzeug', port, 1, 1), cwd=REPO_DIR, env=env)
+    try:
+        wait_until_ready(base_url, process)
+        cities = city_names(args.cities)
+        print(f"failing={','.join(failing)} status={args.fault_status} concurrency={args.concurrency} "
+              f"duration={args.duration}s reset_timeout={args.reset_timeout}s")
+
+        header = (f"{'phase':<9} {'reqs':>6} {'err%':>6} {'degr%':>6} {'p50 ms':>9} {'p99 ms':>9}  "
+                  "upstream calls")
+        print(header)
+        print('-' * len(header))
+        offset = 0
+        for phase in ('healthy', 'outage', 'recovery'):
+            if phase == 'outage':
+                for name in failing:
+                    upstreams.set_fault(name, error_rate=1.0, status=args.fault_status)
+            elif phase == 'recovery':
+                for name in failing:
+                    upstreams.set_fault(name, error_rate=0.0)
+                time.sleep(args.reset_timeout)
+            before = dict(upstreams.counts)
+            result, offset = run_phase(base_url, cities, offset, args.concurrency,
+                                       args.duration, args.timeout)
+            calls = {name: upstreams.counts[name] - before[name] for name in before}
+            print(f"{phase:<9} {result['requests']:>6} {result['error_pct']:>6} "
+                  f"{result['degraded_pct']:>6} {result['p50_ms'] or '-':>9} "
+                  f"{result['p99_ms'] or '-':>9}  {calls}")
+
+        print()
+        for line in resilience_metrics(base_url):
+            print(line)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        upstream_server.shutdown()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
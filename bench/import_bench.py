@@ -0,0 +1,97 @@
+"""Import-time benchmark: what ``import sentient_weather`` costs a worker.
+
+Runs ``python -X importtime -c "import sentient_weather"`` in fresh
+interpreters and reports the median total and the modules with the largest
+cumulative import time. ``--save`` records the result as a baseline and
+``--compare`` fails (exit 1) when the total regresses past it, so the check
+can run in CI.
+
+    python bench/import_bench.py --top 15
+    python bench/import_bench.py --save import_baseline.json
+    python bench/import_bench.py --compare import_baseline.json --tolerance 0.25
+    python bench/import_bench.py --max-ms 150
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+
+
+def import_times(module):
+    """Cumulative import time in ms of every module ``module`` pulls in"""
+    stderr = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            capture_output=True, text=True, cwd=REPO_DIR, check=True).stderr
+    times = {}
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        name = name.strip()
+        times[name] = max(times.get(name, 0), int(cumulative_us) / 1000)
+    return times
+
+
+def measure(module, runs):
+    """Median total and per-module cumulative times (ms) over ``runs`` interpreters"""
+    samples = [import_times(module) for _ in range(runs)]
+    names = set().union(*samples)
+    modules = {name: statistics.median(s.get(name, 0) for s in samples) for name in names}
+    return {'module': module, 'runs': runs, 'total_ms': round(modules.get(module, 0), 1),
+            'modules': {name: round(ms, 1) for name, ms in modules.items()}}
+
+
+def top_level(modules, count):
+    """The slowest top-level packages, so ``anthropic`` is not listed once per submodule"""
+    packages = {}
+    for name, ms in modules.items():
+        root = name.split('.')[0]
+        packages[root] = max(packages.get(root, 0), ms)
+    return sorted(packages.items(), key=lambda item: item[1], reverse=True)[:count]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--module', default='sentient_weather')
+    parser.add_argument('--runs', type=int, default=5, help="Fresh interpreters to take the median over")
+    parser.add_argument('--top', type=int, default=10, help="Slowest packages to list")
+    parser.add_argument('--save', metavar='PATH', help="Write the result as a baseline")
+    parser.add_argument('--compare', metavar='PATH', help="Fail if slower than this baseline")
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help="Allowed slowdown over the baseline, as a fraction")
+    parser.add_argument('--max-ms', type=float, help="Fail if the total exceeds this")
+    args = parser.parse_args()
+
+    result = measure(args.module, args.runs)
+    print(f"import {args.module}: {result['total_ms']:.1f} ms (median of {args.runs})")
+    for name, ms in top_level(result['modules'], args.top):
+        print(f"  {name:<30} {ms:8.1f} ms")
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+
+    failed = False
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        limit = baseline['total_ms'] * (1 + args.tolerance)
+        print(f"baseline {baseline['total_ms']:.1f} ms, limit {limit:.1f} ms")
+        new = sorted(set(result['modules']) - set(baseline['modules']))
+        if new:
+            print(f"newly imported: {', '.join(new)}")
+        failed = result['total_ms'] > limit
+    if args.max_ms is not None and result['total_ms'] > args.max_ms:
+        print(f"over the {args.max_ms:.1f} ms budget")
+        failed = True
+    if failed:
+        print("import time regressed")
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,288 @@
+"""Offline load test: drive the app against local fake upstreams.
+
+Starts bench/fake_upstreams.py in-process, launches the app as a separate
+server with every upstream pointed at it and all caches in a scratch
+directory, then POSTs city searches to ``/`` at each concurrency level.
+For each level it reports requests/sec, the error rate, p50/p95/p99
+latency and the resident memory of every server worker.
+
+    python bench/load_test.py --concurrency 1,8,32 --duration 20
+    python bench/load_test.py --server uvicorn --workers 2 --latency anthropic=800
+    python bench/load_test.py --server gunicorn --workers 4 --threads 16 --json results.json
+    python bench/load_test.py --workers 4 --cache-backend redis
+
+Every run starts cold. Repeat cities with ``--cities`` (small values mostly hit
+caches, large ones mostly miss). ``--cache-backend`` moves every cache to one
+backend; ``redis`` runs against bench/fake_redis.py.
+"""
+import argparse
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+
+import fake_redis  # noqa: E402
+import fake_upstreams  # noqa: E402
+
+# Rendered only on the error page
+ERROR_MARKER = '<h2>Error</h2>'
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def city_names(count):
+    """The ``count`` most populous cities in the bundled gazetteer"""
+    rows = []
+    with open(os.path.join(REPO_DIR, 'data', 'cities.txt'), encoding='utf-8') as f:
+        for line in f:
+            fields = line.rstrip('\n').split('\t')
+            if len(fields) > 14:
+                rows.append((int(fields[14] or 0), fields[1]))
+    rows.sort(reverse=True)
+    return [name for _population, name in rows[:count]]
+
+
+def server_command(server, port, workers, threads):
+    address = f"127.0.0.1:{port}"
+    if server == 'gunicorn':
+        return [sys.executable, '-m', 'gunicorn', '-w', str(workers), '--threads', str(threads),
+                '-b', address, '--timeout', '120', 'sentient_weather:create_app()']
+    if server == 'uvicorn':
+        return [sys.executable, '-m', 'uvicorn', 'asgi:application', '--host', '127.0.0.1',
+                '--port', str(port), '--workers', str(workers), '--log-level', 'warning']
+    # Werkzeug's threaded server: a single process, for when gunicorn is not installed
+    return [sys.executable, '-c',
+            "from werkzeug.serving import run_simple; from sentient_weather import create_app; "
+            f"run_simple('127.0.0.1', {port}, create_app(), threaded=True)"]
+
+
+def app_environment(upstream_port, state_dir, extra):
+    env = dict(os.environ)
+    env.update(fake_upstreams.app_env(upstream_port))
+    env.update({
+        'SW_WEATHER_CACHE_PATH': os.path.join(state_dir, 'weather_cache'),
+        'SW_GEOCODE_CACHE_PATH': os.path.join(state_dir, 'geocode.sqlite'),
+        'SW_IMAGE_DIR': os.path.join(state_dir, 'images'),
+        'SW_IMAGE_INDEX_PATH': os.path.join(state_dir, 'images.sqlite'),
+        'SW_CACHE_PATH': os.path.join(state_dir, 'cache.sqlite'),
+        'SW_LOCK_DIR': os.path.join(state_dir, 'locks'),
+        # The fake upstreams have no usage policy or quotas to respect
+        'SW_GEOCODE_MIN_INTERVAL': '0',
+        'SW_UPSTREAM_RATE_LIMITS': '',
+        'SW_LOG_LEVEL': 'WARNING',
+    })
+    env.update(extra)
+    os.makedirs(env['SW_IMAGE_DIR'], exist_ok=True)
+    return env
+
+
+def wait_until_ready(base_url, process, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"Server exited with code {process.returncode}")
+        try:
+            if requests.get(base_url, timeout=2).status_code == 200:
+                return
+        except requests.RequestException:
+            pass
+        time.sleep(0.2)
+    raise RuntimeError("Server did not become ready")
+
+
+def process_tree(pid):
+    """``pid`` and all its descendants, from /proc"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+
+    tree, stack = [], [pid]
+    while stack:
+        current = stack.pop()
+        tree.append(current)
+        stack.extend(children.get(current, []))
+    return tree
+
+
+def rss_mb(pid):
+    try:
+        with open(f'/proc/{pid}/status') as f:
+            for line in f:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def worker_rss(pid):
+    """RSS in MB of each worker; the server process itself when it has no children"""
+    pids = process_tree(pid)
+    workers = pids[1:] or pids
+    return [round(rss, 1) for rss in (rss_mb(p) for p in workers) if rss is not None]
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(int(round(fraction * (len(sorted_values) - 1))), len(sorted_values) - 1)
+    return sorted_values[index]
+
+
+def run_level(base_url, cities, concurrency, duration, timeout):
+    """Drive POST / with ``concurrency`` clients for ``duration`` seconds"""
+    latencies, errors = [], []
+    lock = threading.Lock()
+    counter = iter(range(10 ** 9))
+    stop_at = time.monotonic() + duration
+
+    def client():
+        session = requests.Session()
+        while time.monotonic() < stop_at:
+            with lock:
+                city = cities[next(counter) % len(cities)]
+            started = time.perf_counter()
+            try:
+                response = session.post(base_url, data={'city': city}, timeout=timeout)
+                failed = response.status_code != 200 or ERROR_MARKER in response.text
+                error = f"HTTP {response.status_code}" if response.status_code != 200 else 'error page'
+            except requests.RequestException as e:
+                failed, error = True, type(e).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if failed:
+                    errors.append(error)
+
+    started = time.monotonic()
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.monotonic() - started
+
+    latencies.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': len(latencies),
+        'errors': len(errors),
+        'error_rate': round(len(errors) / len(latencies), 4) if latencies else None,
+        'error_kinds': {kind: errors.count(kind) for kind in set(errors)},
+        'rps': round(len(latencies) / wall, 2),
+        'p50_ms': round(percentile(latencies, 0.50) * 1000, 1) if latencies else None,
+        'p95_ms': round(percentile(latencies, 0.95) * 1000, 1) if latencies else None,
+        'p99_ms': round(percentile(latencies, 0.99) * 1000, 1) if latencies else None,
+    }
+
+
+def print_table(results):
+    header = f"{'conc':>5} {'reqs':>7} {'err%':>6} {'rps':>8} {'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}  worker RSS MB"
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        error_pct = f"{r['error_rate'] * 100:.1f}" if r['error_rate'] is not None else '-'
+        print(f"{r['concurrency']:>5} {r['requests']:>7} {error_pct:>6} {r['rps']:>8} "
+              f"{r['p50_ms'] or '-':>9} {r['p95_ms'] or '-':>9} {r['p99_ms'] or '-':>9}  {r['rss_mb']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--server', choices=['gunicorn', 'uvicorn', 'werkzeug'],
+                        help="How to serve the app (default: gunicorn if installed, else werkzeug)")
+    parser.add_argument('--workers', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=8, help="Threads per gunicorn worker")
+    parser.add_argument('--concurrency', default='1,4,16,32',
+                        help="Comma-separated client concurrency levels")
+    parser.add_argument('--duration', type=float, default=15.0, help="Seconds per level")
+    parser.add_argument('--cities', type=int, default=50, help="Distinct cities to cycle through")
+    parser.add_argument('--timeout', type=float, default=120.0, help="Client timeout per request")
+    parser.add_argument('--cache-backend', choices=['memory', 'sqlite', 'redis'],
+                        help="Backend for every app cache (default: each cache's own)")
+    parser.add_argument('--env', action='append', default=[], metavar='NAME=VALUE',
+                        help="Extra environment for the app, e.g. SW_THEME_MODE=split")
+    parser.add_argument('--json', metavar='PATH', help="Also write the results as JSON")
+    fake_upstreams.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    server = args.server
+    if server is None:
+        server = 'gunicorn' if shutil.which('gunicorn') else 'werkzeug'
+    levels = [int(level) for level in args.concurrency.split(',') if level.strip()]
+    extra_env = dict(spec.split('=', 1) for spec in args.env)
+
+    redis_server = None
+    if args.cache_backend == 'redis':
+        redis_server, _store = fake_redis.start(0)
+        extra_env = {**fake_redis.app_env(redis_server.server_address[1]), **extra_env}
+    elif args.cache_backend:
+        extra_env = {'SW_CACHE_BACKEND': args.cache_backend, **extra_env}
+
+    upstream_server, upstreams = fake_upstreams.start(0, fake_upstreams.profile_from_args(args))
+    state_dir = tempfile.mkdtemp(prefix='sw-bench-')
+    port = free_port()
+    base_url = f"http://127.0.0.1:{port}/"
+    env = app_environment(upstream_server.server_port, state_dir, extra_env)
+    process = subprocess.Popen(server_command(server, port, args.workers, args.threads),
+                               cwd=REPO_DIR, env=env)
+    try:
+        wait_until_ready(base_url, process)
+        cities = city_names(args.cities)
+        print(f"server={server} workers={args.workers} threads={args.threads} "
+              f"cities={len(cities)} duration={args.duration}s "
+              f"cache_backend={args.cache_backend or 'default'}")
+
+        results = []
+        for concurrency in levels:
+            result = run_level(base_url, cities, concurrency, args.duration, args.timeout)
+            result['rss_mb'] = worker_rss(process.pid)
+            results.append(result)
+            print(f"concurrency {concurrency}: {result['requests']} requests, "
+                  f"{result['rps']} req/s, p95 {result['p95_ms']} ms")
+
+        print()
+        print_table(results)
+        print(f"upstream calls: {upstreams.counts}")
+        print(f"upstream injected errors: {upstreams.errors}")
+        if args.json:
+            with open(args.json, 'w') as f:
+                json.dump({'server': server, 'workers': args.workers, 'threads': args.threads,
+                           'cache_backend': args.cache_backend,
+                           'profile': upstreams.profile, 'results': results,
+                           'upstream_calls': upstreams.counts}, f, indent=2)
+    finally:
+        process.terminate()
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+        upstream_server.shutdown()
+        if redis_server is not None:
+            redis_server.shutdown()
+        shutil.rmtree(state_dir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+"""Timing of image palette extraction against the LLM palette call.
+
+Times ``image_palette.palette_from_file`` on generated city-like scenes, both
+on the full-size PNG and on a 640px WebP like the one image_derivatives
+writes, split into decode and clustering. It then times
+``generate_color_palette`` against the fake Anthropic upstream (or the real
+API with ``--live``) and reports, for both paths, the lowest WCAG contrast
+between a text color and the tiles.
+
+    python bench/palette_bench.py --number 20
+    python bench/palette_bench.py --images 'static/images/*.png' --llm-calls 0
+    python bench/palette_bench.py --latency anthropic=2500 --llm-calls 10
+"""
+import argparse
+import glob
+import os
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import numpy as np  # noqa: E402
+from PIL import Image  # noqa: E402
+
+import fake_upstreams  # noqa: E402
+
+TEXT_ROLES = ['color_tile_heading', 'color_tile_temp_high', 'color_tile_temp_low',
+              'color_tile_weather_details']
+
+WEATHER_DATA = {'current': {'temperature': 14.0, 'precipitation': 0.4, 'cloud_cover': 80,
+                            'wind_speed': 12.0, 'is_day': 1, 'weather_code': 61}}
+
+
+def scene(seed, width=1792, height=1024):
+    """A noisy sky gradient with a few blocks of color, roughly like a painted city"""
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 1, height)[:, None, None]
+    top, bottom = rng.uniform(0, 255, 3), rng.uniform(0, 255, 3)
+    pixels = (top * (1 - y) + bottom * y) * np.ones((1, width, 1))
+    for _ in range(rng.integers(3, 8)):
+        x0, y0 = rng.integers(0, width - 200), rng.integers(height // 3, height - 100)
+        pixels[y0:y0 + rng.integers(80, 400), x0:x0 + rng.integers(100, 600)] = rng.uniform(0, 255, 3)
+    pixels += rng.normal(0, 10, pixels.shape)
+    return Image.fromarray(np.clip(pixels, 0, 255).astype('uint8'))
+
+
+def write_scenes(directory, count):
+    paths = []
+    for seed in range(count):
+        image = scene(seed)
+        path = os.path.join(directory, f"scene_{seed}.png")
+        image.save(path)
+        image.resize((640, round(image.height * 640 / image.width))).save(
+            os.path.join(directory, f"scene_{seed}.640w.webp"), quality=80)
+        paths.append(path)
+    return paths
+
+
+def to_rgb(hex_color):
+    return np.array([int(hex_color[i:i + 2], 16) for i in (1, 3, 5)])
+
+
+def min_contrast(palette):
+    """Lowest contrast ratio between a text color and the tiles"""
+    from image_palette import contrast_ratio
+    tiles = to_rgb(palette['color_tiles'])
+    return min(float(contrast_ratio(to_rgb(palette[role]), tiles)) for role in TEXT_ROLES)
+
+
+def summarize(samples):
+    samples = sorted(samples)
+    return (f"median {statistics.median(samples) * 1000:8.1f} ms   "
+            f"p95 {samples[int(0.95 * (len(samples) - 1))] * 1000:8.1f} ms")
+
+
+def time_image_path(paths, number):
+    import config
+    from image_palette import assign_roles, kmeans, load_pixels
+
+    decode, cluster, contrasts = [], [], []
+    for path in paths:
+        for _ in range(number):
+            started = time.perf_counter()
+            pixels = load_pixels(path)
+            decoded = time.perf_counter()
+            centers, counts = kmeans(pixels, config.PALETTE_CLUSTERS)
+            palette = assign_roles(centers, counts)
+            decode.append(decoded - started)
+            cluster.append(time.perf_counter() - decoded)
+        contrasts.append(min_contrast(palette))
+    total = [a + b for a, b in zip(decode, cluster)]
+    return total, decode, cluster, contrasts
+
+
+def time_llm_path(calls):
+    from notebook_functions import generate_color_palette, validate_color_palette
+
+    durations, contrasts, errors = [], [], 0
+    for i in range(calls):
+        started = time.perf_counter()
+        try:
+            palette = validate_color_palette(
+                generate_color_palette(f"Bench City {i}", WEATHER_DATA, 'Rain: Slight intensity'))
+        except Exception as e:
+            errors += 1
+            print(f"  LLM call failed: {e}")
+            continue
+        durations.append(time.perf_counter() - started)
+        contrasts.append(min_contrast(palette))
+    return durations, contrasts, errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--images', help="Glob of images to use instead of generated scenes")
+    parser.add_argument('--scenes', type=int, default=8, help="Generated scenes")
+    parser.add_argument('--number', type=int, default=10, help="Extractions per image")
+    parser.add_argument('--llm-calls', type=int, default=5, help="LLM palette calls (0 to skip)")
+    parser.add_argument('--live', action='store_true',
+                        help="Call the real Anthropic API instead of the fake upstream")
+    fake_upstreams.add_profile_arguments(parser)
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='sw-palette-')
+    upstream_server = None
+    if not args.live:
+        upstream_server, _upstreams = fake_upstreams.start(0, fake_upstreams.profile_from_args(args))
+        os.environ.update(fake_upstreams.app_env(upstream_server.server_port))
+    os.environ.setdefault('SW_UPSTREAM_RATE_LIMITS', '')
+    os.environ.setdefault('SW_IMAGE_INDEX_PATH', os.path.join(scratch, 'images.sqlite'))
+    os.environ.setdefault('SW_LOG_LEVEL', 'WARNING')
+    try:
+        if args.images:
+            originals = sorted(glob.glob(args.images))
+            renditions = []
+        else:
+            originals = write_scenes(scratch, args.scenes)
+            renditions = [path.replace('.png', '.640w.webp') for path in originals]
+
+        for label, paths in (('image, original', originals), ('image, 640w WebP', renditions)):
+            if not paths:
+                continue
+            total, decode, cluster, contrasts = time_image_path(paths, args.number)
+            print(f"{label:<18} {summarize(total)}   (decode {summarize(decode)}; "
+                  f"cluster {summarize(cluster)})")
+            print(f"{'':<18} lowest text/tile contrast {min(contrasts):.2f} over {len(paths)} images")
+
+        if args.llm_calls:
+            durations, contrasts, errors = time_llm_path(args.llm_calls)
+            if durations:
+                print(f"{'llm':<18} {summarize(durations)}")
+                print(f"{'':<18} lowest text/tile contrast {min(contrasts):.2f} over {len(durations)} "
+                      f"palettes, {errors} errors")
+            else:
+                print(f"{'llm':<18} every call failed")
+    finally:
+        if upstream_server is not None:
+            upstream_server.shutdown()
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
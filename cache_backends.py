@@ -0,0 +1,436 @@
+"""Pluggable storage for the weather, geocode, design and page caches.
+
+A backend maps string keys to bytes, each entry with its own TTL, and evicts
+the least recently used entries once it holds more than ``max_entries``:
+
+* ``memory``: an in-process LRU; every worker keeps its own copy.
+* ``sqlite``: a table in a WAL-mode SQLite file, shared by every worker
+  process on the host.
+* ``redis``: keys on a Redis-compatible server (spoken to over RESP), shared
+  by every worker on every host. Network errors are logged and treated as
+  misses, so a Redis outage slows pages down instead of failing them.
+
+Each cache opens its backend with ``open_backend``; SW_CACHE_BACKEND moves all
+of them to one kind, otherwise each keeps its default.
+"""
+import os
+import socket
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import unquote, urlparse
+
+import config
+from logs import get_logger
+
+log = get_logger('cache_backends')
+
+
+class MemoryBackend:
+    """Thread-safe TTL + LRU dict, private to the process"""
+
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[1] <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[0]
+
+    def set(self, key, value, ttl):
+        with self._lock:
+            self._entries[key] = (value, time.time() + ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def keys(self):
+        now = time.time()
+        with self._lock:
+            return [key for key, (_value, expires_at) in self._entries.items() if expires_at > now]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class SQLiteBackend:
+    """One table of a WAL-mode SQLite file, safe to share between processes.
+
+    Reads refresh an entry's last access at most every ``touch_interval``
+    seconds, so hot keys do not turn every read into a write. Expired and
+    least recently used rows are trimmed every ``EVICT_EVERY`` writes.
+    """
+
+    EVICT_EVERY = 64
+
+    def __init__(self, path, table, max_entries=1024, touch_interval=60):
+        self.table = table
+        self.max_entries = max_entries
+        self.touch_interval = touch_interval
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                key TEXT PRIMARY KEY,
+                value BLOB NOT NULL,
+                expires_at REAL NOT NULL,
+                last_access REAL NOT NULL
+            )
+        """)
+        self._db.execute(f"CREATE INDEX IF NOT EXISTS {table}_last_access ON {table} (last_access)")
+
+    def get(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                f"SELECT value, expires_at, last_access FROM {self.table} WHERE key = ?",
+                (key,)).fetchone()
+            if row is None or row[1] <= now:
+                return None
+            if now - row[2] >= self.touch_interval:
+                self._db.execute(f"UPDATE {self.table} SET last_access = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def set(self, key, value, ttl):
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                f"INSERT OR REPLACE INTO {self.table} (key, value, expires_at, last_access) "
+                "VALUES (?, ?, ?, ?)", (key, value, now + ttl, now))
+            self._writes += 1
+            if self._writes >= self.EVICT_EVERY:
+                self._writes = 0
+                self._evict(now)
+
+    def _evict(self, now):
+        self._db.execute(f"DELETE FROM {self.table} WHERE expires_at <= ?", (now,))
+        self._db.execute(
+            f"DELETE FROM {self.table} WHERE key IN (SELECT key FROM {self.table} "
+            "ORDER BY last_access DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def delete(self, key):
+        with self._lock:
+            self._db.execute(f"DELETE FROM {self.table} WHERE key = ?", (key,))
+
+    def keys(self):
+        with self._lock:
+            return [key for key, in self._db.execute(
+                f"SELECT key FROM {self.table} WHERE expires_at > ?", (time.time(),))]
+
+    def clear(self):
+        with self._lock:
+            self._db.execute(f"DELETE FROM {self.table}")
+
+    def __len__(self):
+        return len(self.keys())
+
+
+class RedisError(Exception):
+    """An error reply from the Redis server"""
+
+
+class RespClient:
+    """Minimal thread-safe Redis client speaking RESP2 over a small connection pool.
+
+    ``url`` is ``redis://[:password@]host[:port][/db]``. After a failed connect
+    the server is considered down for ``retry_interval`` seconds and commands
+    fail immediately, so an outage does not add a connect timeout to every call.
+    """
+
+    def __init__(self, url, timeout=1.0, max_idle=8, retry_interval=5.0):
+        parsed = urlparse(url)
+        self.host = parsed.hostname or '127.0.0.1'
+        self.port = parsed.port or 6379
+        self.password = unquote(parsed.password) if parsed.password else None
+        self.db = int(parsed.path.lstrip('/') or 0)
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.retry_interval = retry_interval
+        self._lock = threading.Lock()
+        self._idle = []
+        self._down_until = 0.0
+
+    def _connect(self):
+        if time.monotonic() < self._down_until:
+            raise ConnectionError(f"Redis at {self.host}:{self.port} is down")
+        try:
+            sock = socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            self._down_until = time.monotonic() + self.retry_interval
+            log.warning("redis connect failed", host=self.host, port=self.port,
+                        retry_in=self.retry_interval, error=str(e))
+            raise
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        conn = (sock, sock.makefile('rb'))
+        if self.password:
+            self._roundtrip(conn, [('AUTH', self.password)])
+        if self.db:
+            self._roundtrip(conn, [('SELECT', self.db)])
+        return conn
+
+    @staticmethod
+    def _encode(args):
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode('utf-8')
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def _read_reply(self, reader):
+        line = reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError("Connection closed by Redis server")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b'+':
+            return rest.decode('utf-8')
+        if kind == b'-':
+            return RedisError(rest.decode('utf-8'))
+        if kind == b':':
+            return int(rest)
+        if kind == b'$':
+            length = int(rest)
+            if length < 0:
+                return None
+            data = reader.read(length + 2)
+            if len(data) != length + 2:
+                raise ConnectionError("Connection closed by Redis server")
+            return data[:-2]
+        if kind == b'*':
+            count = int(rest)
+            if count < 0:
+                return None
+            return [self._read_reply(reader) for _ in range(count)]
+        raise ConnectionError(f"Unexpected Redis reply: {line[:40]!r}")
+
+    def _roundtrip(self, conn, commands):
+        sock, reader = conn
+        sock.sendall(b''.join(self._encode(args) for args in commands))
+        replies = [self._read_reply(reader) for _ in commands]
+        for reply in replies:
+            if isinstance(reply, RedisError):
+                raise reply
+        return replies
+
+    def pipeline(self, *commands):
+        """Send several commands in one round trip and return their replies"""
+        with self._lock:
+            conn = self._idle.pop() if self._idle else None
+        if conn is None:
+            conn = self._connect()
+        try:
+            replies = self._roundtrip(conn, commands)
+        except BaseException as e:
+            if isinstance(e, RedisError):
+                # The connection is still in sync after an error reply
+                self._release(conn)
+            else:
+                self._close(conn)
+            raise
+        self._release(conn)
+        return replies
+
+    def execute(self, *args):
+        return self.pipeline(args)[0]
+
+    def _release(self, conn):
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(conn)
+                return
+        self._close(conn)
+
+    @staticmethod
+    def _close(conn):
+        sock, reader = conn
+        try:
+            reader.close()
+            sock.close()
+        except OSError:
+            pass
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn in idle:
+            self._close(conn)
+
+
+class RedisBackend:
+    """Keys under ``sw:<namespace>:`` on a Redis server, shared across hosts.
+
+    Redis expires entries itself; a sorted set of last-access times per
+    namespace bounds the entry count, popping the least recently used keys
+    whenever a write takes it past ``max_entries``.
+    """
+
+    def __init__(self, client, namespace, max_entries=1024):
+        self.client = client
+        self.namespace = namespace
+        self.prefix = f"sw:{namespace}:"
+        self.lru_key = f"sw:{namespace}"
+        self.max_entries = max_entries
+
+    def _failed(self, operation, error):
+        log.debug("redis cache operation failed", cache=self.namespace,
+                  operation=operation, error=str(error))
+
+    def get(self, key):
+        try:
+            value, _touched = self.client.pipeline(
+                ('GET', self.prefix + key),
+                ('ZADD', self.lru_key, 'XX', time.time(), self.prefix + key))
+            return value
+        except (OSError, RedisError) as e:
+            self._failed('get', e)
+            return None
+
+    def set(self, key, value, ttl):
+        try:
+            _stored, _added, count = self.client.pipeline(
+                ('SET', self.prefix + key, value, 'PX', max(int(ttl * 1000), 1)),
+                ('ZADD', self.lru_key, time.time(), self.prefix + key),
+                ('ZCARD', self.lru_key))
+            if count > self.max_entries:
+                popped = self.client.execute('ZPOPMIN', self.lru_key, count - self.max_entries)
+                victims = popped[::2]
+                if victims:
+                    self.client.execute('DEL', *victims)
+        except (OSError, RedisError) as e:
+            self._failed('set', e)
+
+    def delete(self, key):
+        try:
+            self.client.pipeline(('DEL', self.prefix + key),
+                                 ('ZREM', self.lru_key, self.prefix + key))
+        except (OSError, RedisError) as e:
+            self._failed('delete', e)
+
+    def keys(self):
+        try:
+            members = self.client.execute('ZRANGE', self.lru_key, 0, -1)
+        except (OSError, RedisError) as e:
+            self._failed('keys', e)
+            return []
+        return [member.decode('utf-8')[len(self.prefix):] for member in members]
+
+    def clear(self):
+        try:
+            members = self.client.execute('ZRANGE', self.lru_key, 0, -1)
+            self.client.execute('DEL', self.lru_key, *members)
+        except (OSError, RedisError) as e:
+            self._failed('clear', e)
+
+    def __len__(self):
+        try:
+            return self.client.execute('ZCARD', self.lru_key)
+        except (OSError, RedisError) as e:
+            self._failed('len', e)
+            return 0
+
+
+def sqlite_path(path):
+    """Add the .sqlite extension requests_cache would, when ``path`` has none"""
+    return path if os.path.splitext(path)[1] else f"{path}.sqlite"
+
+
+def open_backend(name, default, max_entries, path=None):
+    """Open the backend for the cache ``name``.
+
+    The kind is SW_CACHE_BACKEND when set, else ``default``. SQLite backends
+    use the table ``cache_<name>`` in ``path`` (SW_CACHE_PATH by default);
+    Redis backends share the process's 'redis' client.
+    """
+    kind = config.CACHE_BACKEND or default
+    if kind == 'redis':
+        from clients import get_client
+        return RedisBackend(get_client('redis'), name, max_entries=max_entries)
+    if kind == 'sqlite':
+        return SQLiteBackend(sqlite_path(path or config.CACHE_PATH), f"cache_{name}",
+                             max_entries=max_entries)
+    if kind != 'memory':
+        log.warning("unknown cache backend, using memory", cache=name, backend=kind)
+    return MemoryBackend(max_entries=max_entries)
+
+
+class LazyBackend:
+    """Opens its backend on first use, so module-level caches open no files or
+    sockets at import time (or in a parent process before fork)"""
+
+    def __init__(self, name, default, max_entries, path=None):
+        self._args = (name, default, max_entries, path)
+        self._lock = threading.Lock()
+        self._backend = None
+
+    def _open(self):
+        if self._backend is None:
+            with self._lock:
+                if self._backend is None:
+                    self._backend = open_backend(*self._args)
+        return self._backend
+
+    def __getattr__(self, name):
+        return getattr(self._open(), name)
+
+    def __len__(self):
+        return len(self._open())
+
+
+def requests_cache_backend(backend, ttl):
+    """A requests_cache backend storing responses and redirects in ``backend``"""
+    from requests_cache.backends.base import BaseCache, BaseStorage
+
+    class BackendStorage(BaseStorage):
+        def __init__(self, prefix, **kwargs):
+            super().__init__(serializer='pickle', **kwargs)
+            self.prefix = prefix
+
+        def __getitem__(self, key):
+            value = backend.get(self.prefix + key)
+            if value is None:
+                raise KeyError(key)
+            return self.deserialize(key, value)
+
+        def __setitem__(self, key, value):
+            backend.set(self.prefix + key, self.serialize(value), ttl)
+
+        def __delitem__(self, key):
+            backend.delete(self.prefix + key)
+
+        def __iter__(self):
+            return (key[len(self.prefix):] for key in backend.keys() if key.startswith(self.prefix))
+
+        def __len__(self):
+            return sum(1 for _key in self)
+
+        def clear(self):
+            for key in list(self):
+                del self[key]
+
+    class BackendCache(BaseCache):
+        def __init__(self, **kwargs):
+            super().__init__(cache_name='sw', **kwargs)
+            self.responses = BackendStorage('response:')
+            self.redirects = BackendStorage('redirect:')
+
+    return BackendCache()
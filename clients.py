@@ -0,0 +1,255 @@
+"""Process-wide registry of upstream clients.
+
+Each client is built once per worker process on first use and then shared
+by every request and stage thread, so connection pools, TLS sessions and the
+weather cache database are reused instead of rebuilt per call.
+
+The ``async_*`` clients are for the asyncio serving mode and must only be
+used from its event loop.
+
+Tests and benchmarks can swap in local stand-ins with ``override_client`` or
+the ``use_clients`` context manager.
+"""
+import threading
+from contextlib import contextmanager
+
+import config
+import metrics
+from logs import get_logger
+
+log = get_logger('clients')
+
+_lock = threading.Lock()
+_clients = {}
+_factories = {}
+
+
+def register(name):
+    """Register the factory that builds the named client"""
+    def decorator(factory):
+        _factories[name] = factory
+        return factory
+    return decorator
+
+
+def get_client(name):
+    """Return the shared client for ``name``, building it on first use"""
+    client = _clients.get(name)
+    if client is not None:
+        return client
+
+    with _lock:
+        client = _clients.get(name)
+        if client is None:
+            if name not in _factories:
+                raise KeyError(f"Unknown client: {name}")
+            client = _factories[name]()
+            _clients[name] = client
+        return client
+
+
+def override_client(name, client):
+    """Replace the shared client for ``name``, e.g. with a local stub"""
+    with _lock:
+        _clients[name] = client
+
+
+def reset_clients(*names):
+    """Drop shared clients so they are rebuilt on next use (all if no names given)"""
+    with _lock:
+        for name in names or list(_clients):
+            _clients.pop(name, None)
+
+
+async def aclose_async_clients():
+    """Close and drop the ``async_*`` clients; call before their event loop ends"""
+    with _lock:
+        closing = [_clients.pop(name) for name in list(_clients) if name.startswith('async_')]
+    for client in closing:
+        try:
+            await (client.aclose() if hasattr(client, 'aclose') else client.close())
+        except Exception as e:
+            log.error("closing client failed", error=str(e))
+
+
+@contextmanager
+def use_clients(**overrides):
+    """Temporarily swap in the given clients, restoring the originals afterwards"""
+    with _lock:
+        previous = {name: _clients.get(name) for name in overrides}
+        _clients.update(overrides)
+    try:
+        yield
+    finally:
+        with _lock:
+            for name, client in previous.items():
+                if client is None:
+                    _clients.pop(name, None)
+                else:
+                    _clients[name] = client
+
+
+def _mount_pooled_adapters(session, max_retries=0):
+    """Mount keep-alive adapters sized from config on a requests session"""
+    from requests.adapters import HTTPAdapter
+
+    for prefix in ('http://', 'https://'):
+        session.mount(prefix, HTTPAdapter(
+            pool_connections=config.HTTP_POOL_CONNECTIONS,
+            pool_maxsize=config.HTTP_POOL_MAXSIZE,
+            max_retries=max_retries,
+        ))
+    return session
+
+
+def _httpx_limits():
+    """Connection limits shared by the LLM and image SDK clients"""
+    import httpx
+    return httpx.Limits(max_connections=config.LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=config.LLM_MAX_KEEPALIVE)
+
+
+@register('geolocator')
+def _build_geolocator():
+    from geopy.adapters import RequestsAdapter
+    from geopy.geocoders import Nominatim
+
+    def adapter_factory(proxies, ssl_context):
+        return RequestsAdapter(proxies=proxies, ssl_context=ssl_context,
+                               pool_connections=config.HTTP_POOL_CONNECTIONS,
+                               pool_maxsize=config.HTTP_POOL_MAXSIZE)
+
+    return Nominatim(user_agent="sentient-weather-app",
+                     domain=config.NOMINATIM_DOMAIN,
+                     scheme=config.NOMINATIM_SCHEME,
+                     timeout=config.GEOCODE_TIMEOUT,
+                     adapter_factory=adapter_factory)
+
+
+@register('openmeteo')
+def _build_openmeteo():
+    import openmeteo_requests
+    import requests_cache
+
+    from cache_backends import open_backend, requests_cache_backend
+    from refresh import refresher
+    from resilience import upstreams
+
+    class CountingCachedSession(requests_cache.CachedSession):
+        def send(self, request, **kwargs):
+            response = super().send(request, **kwargs)
+            if not getattr(response, 'from_cache', False):
+                result = 'miss'
+            else:
+                result = 'stale' if getattr(response, 'is_expired', False) else 'hit'
+            metrics.cache_requests.inc(cache='weather', result=result)
+            return response
+
+        def _send_and_cache(self, request, actions, cached_response=None, **kwargs):
+            # Only requests that reach Open-Meteo go through its rate limit,
+            # circuit breaker and deadline-aware retries; cache hits do not
+            upstream = upstreams['openmeteo']
+
+            def send():
+                response = super(CountingCachedSession, self)._send_and_cache(
+                    request, actions, cached_response, **dict(kwargs, timeout=upstream.timeout()))
+                if response.status_code == 429 or response.status_code >= 500:
+                    response.raise_for_status()
+                return response
+
+            return upstream.call(send)
+
+        def _resend_async(self, request, actions, cached_response, **kwargs):
+            # Refresh stale responses on the shared refresher pool, once per
+            # cache key, instead of a new thread per request
+            refresher.schedule('weather', f"weather:{actions.cache_key}", self._send_and_cache,
+                               request, actions, cached_response, **kwargs)
+
+    backend = open_backend('weather', 'sqlite', config.WEATHER_CACHE_SIZE,
+                           path=config.WEATHER_CACHE_PATH)
+    cache_session = CountingCachedSession(
+        backend=requests_cache_backend(backend, config.WEATHER_CACHE_TTL + config.WEATHER_STALE_GRACE),
+        expire_after=config.WEATHER_CACHE_TTL,
+        stale_while_revalidate=config.WEATHER_STALE_GRACE or False)
+    # Retries are left to the resilience layer, which keeps them within the page deadline
+    _mount_pooled_adapters(cache_session)
+    return openmeteo_requests.Client(session=cache_session)
+
+
+# The SDKs' own retries are disabled; resilience.Upstream retries within the deadline
+
+@register('anthropic')
+def _build_anthropic():
+    from anthropic import Anthropic, DefaultHttpxClient
+    return Anthropic(max_retries=0, http_client=DefaultHttpxClient(limits=_httpx_limits()))
+
+
+@register('openai')
+def _build_openai():
+    from openai import OpenAI, DefaultHttpxClient
+    return OpenAI(max_retries=0, http_client=DefaultHttpxClient(limits=_httpx_limits()))
+
+
+@register('http')
+def _build_http_session():
+    import requests
+    return _mount_pooled_adapters(requests.Session())
+
+
+@register('redis')
+def _build_redis():
+    from cache_backends import RespClient
+    return RespClient(config.REDIS_URL, timeout=config.REDIS_TIMEOUT)
+
+
+@register('async_http')
+def _build_async_http_client():
+    import httpx
+    return httpx.AsyncClient(limits=_httpx_limits(),
+                             headers={'User-Agent': 'sentient-weather-app'},
+                             timeout=httpx.Timeout(config.DOWNLOAD_TIMEOUT,
+                                                   connect=config.DOWNLOAD_CONNECT_TIMEOUT))
+
+
+@register('async_anthropic')
+def _build_async_anthropic():
+    from anthropic import AsyncAnthropic, DefaultAsyncHttpxClient
+    return AsyncAnthropic(max_retries=0, http_client=DefaultAsyncHttpxClient(limits=_httpx_limits()))
+
+
+@register('async_openai')
+def _build_async_openai():
+    from openai import AsyncOpenAI, DefaultAsyncHttpxClient
+    return AsyncOpenAI(max_retries=0, http_client=DefaultAsyncHttpxClient(limits=_httpx_limits()))
+
+
+def get_geolocator():
+    return get_client('geolocator')
+
+
+def get_openmeteo():
+    return get_client('openmeteo')
+
+
+def get_anthropic():
+    return get_client('anthropic')
+
+
+def get_openai():
+    return get_client('openai')
+
+
+def get_http_session():
+    return get_client('http')
+
+
+def get_async_http_client():
+    return get_client('async_http')
+
+
+def get_async_anthropic():
+    return get_client('async_anthropic')
+
+
+def get_async_openai():
+    return get_client('async_openai')
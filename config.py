@@ -0,0 +1,197 @@
+import os
+import tempfile
+
+
+def _env_bool(name, default):
+    """Read a boolean flag from the environment."""
+    value = os.getenv(name)
+    if value is None:
+        return default
+    return value.strip().lower() in ('1', 'true', 'yes', 'on')
+
+
+def _env_int(name, default):
+    """Read an integer setting from the environment."""
+    try:
+        return int(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def _env_float(name, default):
+    """Read a float setting from the environment."""
+    try:
+        return float(os.getenv(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+# Page generation stages (palette, fonts, image)
+CONCURRENT_STAGES = _env_bool('SW_CONCURRENT_STAGES', True)
+STAGE_WORKERS = _env_int('SW_STAGE_WORKERS', 12)
+PALETTE_TIMEOUT = _env_float('SW_PALETTE_TIMEOUT', 20.0)
+FONTS_TIMEOUT = _env_float('SW_FONTS_TIMEOUT', 20.0)
+IMAGE_TIMEOUT = _env_float('SW_IMAGE_TIMEOUT', 45.0)
+PAGE_DEADLINE = _env_float('SW_PAGE_DEADLINE', 50.0)
+
+# Shared upstream clients and connection pools
+HTTP_POOL_CONNECTIONS = _env_int('SW_HTTP_POOL_CONNECTIONS', 10)
+HTTP_POOL_MAXSIZE = _env_int('SW_HTTP_POOL_MAXSIZE', 20)
+LLM_MAX_CONNECTIONS = _env_int('SW_LLM_MAX_CONNECTIONS', 20)
+LLM_MAX_KEEPALIVE = _env_int('SW_LLM_MAX_KEEPALIVE', 10)
+GEOCODE_TIMEOUT = _env_float('SW_GEOCODE_TIMEOUT', 5.0)
+NOMINATIM_DOMAIN = os.getenv('SW_NOMINATIM_DOMAIN', 'nominatim.openstreetmap.org')
+NOMINATIM_SCHEME = os.getenv('SW_NOMINATIM_SCHEME', 'https')
+OPEN_METEO_URL = os.getenv('SW_OPEN_METEO_URL', 'https://api.open-meteo.com/v1/forecast')
+DOWNLOAD_TIMEOUT = _env_float('SW_DOWNLOAD_TIMEOUT', 30.0)
+WEATHER_CACHE_PATH = os.getenv('SW_WEATHER_CACHE_PATH', '.cache')
+WEATHER_CACHE_TTL = _env_int('SW_WEATHER_CACHE_TTL', 3600)
+WEATHER_CACHE_SIZE = _env_int('SW_WEATHER_CACHE_SIZE', 10000)
+
+# Stale-while-revalidate: for this long past their TTL, cached weather, designs
+# and images are served as-is while one background refresh (on a pool of
+# REFRESH_WORKERS, at most REFRESH_MAX_PENDING queued) replaces them. 0 disables.
+WEATHER_STALE_GRACE = _env_int('SW_WEATHER_STALE_GRACE', 600)
+DESIGN_STALE_GRACE = _env_int('SW_DESIGN_STALE_GRACE', 6 * 3600)
+IMAGE_STALE_GRACE = _env_int('SW_IMAGE_STALE_GRACE', 24 * 3600)
+REFRESH_WORKERS = _env_int('SW_REFRESH_WORKERS', 4)
+REFRESH_MAX_PENDING = _env_int('SW_REFRESH_MAX_PENDING', 64)
+
+# Cache storage (cache_backends.py): 'memory' (per process), 'sqlite' (a WAL
+# file shared by the workers on a host) or 'redis' (shared across hosts).
+# Empty keeps each cache's default: SQLite for weather and geocoding, memory
+# for designs and pages.
+CACHE_BACKEND = os.getenv('SW_CACHE_BACKEND', '').lower()
+CACHE_PATH = os.getenv('SW_CACHE_PATH', '.sw_cache.sqlite')
+REDIS_URL = os.getenv('SW_REDIS_URL', 'redis://127.0.0.1:6379/0')
+REDIS_TIMEOUT = _env_float('SW_REDIS_TIMEOUT', 1.0)
+
+# Geocoding cache
+GEOCODE_CACHE_PATH = os.getenv('SW_GEOCODE_CACHE_PATH', '.geocode_cache.sqlite')
+GEOCODE_CACHE_SIZE = _env_int('SW_GEOCODE_CACHE_SIZE', 2048)
+GEOCODE_STORE_SIZE = _env_int('SW_GEOCODE_STORE_SIZE', 100000)
+GEOCODE_TTL = _env_int('SW_GEOCODE_TTL', 30 * 24 * 3600)
+GEOCODE_NEGATIVE_TTL = _env_int('SW_GEOCODE_NEGATIVE_TTL', 24 * 3600)
+# Spacing of live Nominatim lookups, shared by the worker processes on a host
+GEOCODE_MIN_INTERVAL = _env_float('SW_GEOCODE_MIN_INTERVAL', 1.0)
+
+# Geocoding backend: 'nominatim' (live, cached) or 'offline' (local gazetteer)
+GEOCODER_BACKEND = os.getenv('SW_GEOCODER_BACKEND', 'nominatim').lower()
+GAZETTEER_PATH = os.getenv('SW_GAZETTEER_PATH',
+                           os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                        'data', 'cities.txt'))
+
+# Cache of generated palettes and fonts, keyed on city and quantized weather
+DESIGN_CACHE_SIZE = _env_int('SW_DESIGN_CACHE_SIZE', 1024)
+DESIGN_CACHE_TTL = _env_int('SW_DESIGN_CACHE_TTL', 6 * 3600)
+DESIGN_TEMP_BAND = _env_float('SW_DESIGN_TEMP_BAND', 5.0)
+DESIGN_CLOUD_BUCKET = _env_float('SW_DESIGN_CLOUD_BUCKET', 25.0)
+
+# Theme generation: 'combined' (one LLM call for palette and fonts) or 'split'
+THEME_MODE = os.getenv('SW_THEME_MODE', 'combined').lower()
+
+# Palette source: 'llm' (generated with the theme), 'image' (extracted from the
+# city image, waiting for it if needed) or 'hybrid' (from the image once one is
+# on hand, from the LLM until then). Image palettes need NumPy and Pillow.
+PALETTE_MODE = os.getenv('SW_PALETTE_MODE', 'llm').lower()
+PALETTE_CLUSTERS = _env_int('SW_PALETTE_CLUSTERS', 8)
+PALETTE_SAMPLE_SIZE = _env_int('SW_PALETTE_SAMPLE_SIZE', 96)
+# WCAG contrast ratio every text color keeps against the tiles (4.5 is AA)
+PALETTE_MIN_CONTRAST = _env_float('SW_PALETTE_MIN_CONTRAST', 4.5)
+
+# Request coalescing; lock files here coordinate worker processes on one host
+LOCK_DIR = os.getenv('SW_LOCK_DIR', os.path.join(tempfile.gettempdir(), 'sentient-weather-locks'))
+
+# Generated image store
+IMAGE_DIR = os.getenv('SW_IMAGE_DIR', os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                                    'static', 'images'))
+IMAGE_URL_PREFIX = os.getenv('SW_IMAGE_URL_PREFIX', '/static/images')
+IMAGE_INDEX_PATH = os.getenv('SW_IMAGE_INDEX_PATH', '.image_index.sqlite')
+IMAGE_TTL = _env_int('SW_IMAGE_TTL', 24 * 3600)
+IMAGE_MAX_COUNT = _env_int('SW_IMAGE_MAX_COUNT', 100)
+IMAGE_MAX_BYTES = _env_int('SW_IMAGE_MAX_BYTES', 512 * 1024 * 1024)
+DOWNLOAD_CONNECT_TIMEOUT = _env_float('SW_DOWNLOAD_CONNECT_TIMEOUT', 5.0)
+DOWNLOAD_MAX_BYTES = _env_int('SW_DOWNLOAD_MAX_BYTES', 20 * 1024 * 1024)
+DOWNLOAD_CHUNK_SIZE = _env_int('SW_DOWNLOAD_CHUNK_SIZE', 64 * 1024)
+
+# Responsive image derivatives
+IMAGE_DERIVATIVES = _env_bool('SW_IMAGE_DERIVATIVES', True)
+IMAGE_DERIVATIVE_WIDTHS = [int(w) for w in os.getenv('SW_IMAGE_DERIVATIVE_WIDTHS', '640,1024,1440').split(',') if w.strip()]
+IMAGE_DERIVATIVE_WORKERS = _env_int('SW_IMAGE_DERIVATIVE_WORKERS', 2)
+IMAGE_WEBP_QUALITY = _env_int('SW_IMAGE_WEBP_QUALITY', 80)
+IMAGE_AVIF_QUALITY = _env_int('SW_IMAGE_AVIF_QUALITY', 60)
+
+# Background image generation jobs
+ASYNC_IMAGES = _env_bool('SW_ASYNC_IMAGES', True)
+IMAGE_JOB_WORKERS = _env_int('SW_IMAGE_JOB_WORKERS', 8)
+IMAGE_JOB_TTL = _env_int('SW_IMAGE_JOB_TTL', 600)
+
+# Server-Sent Events page streaming (/stream). Off by default: under a sync
+# WSGI server each open stream holds a worker thread for the whole page, so
+# turn it on with the ASGI mode (asgi.py), where streams run on the event loop.
+STREAM_PAGES = _env_bool('SW_STREAM_PAGES', False)
+STREAM_HEARTBEAT = _env_float('SW_STREAM_HEARTBEAT', 15.0)
+STREAM_DEADLINE = _env_float('SW_STREAM_DEADLINE', 90.0)
+
+# Rendered page cache: the landing page and GET /city/<name> pages, keyed by
+# city and weather signature. PAGE_MAX_AGE is the Cache-Control max-age sent
+# to browsers and proxies.
+PAGE_CACHE = _env_bool('SW_PAGE_CACHE', True)
+PAGE_CACHE_SIZE = _env_int('SW_PAGE_CACHE_SIZE', 512)
+PAGE_CACHE_TTL = _env_int('SW_PAGE_CACHE_TTL', 900)
+PAGE_MAX_AGE = _env_int('SW_PAGE_MAX_AGE', 300)
+
+# Startup: import the SDKs (SW_PRELOAD_MODULES) and build the clients
+# (SW_WARM_UP) in create_app instead of on the first request
+PRELOAD_MODULES = _env_bool('SW_PRELOAD_MODULES', False)
+WARM_UP = _env_bool('SW_WARM_UP', False)
+
+# Upstream resilience (resilience.py). UPSTREAM_RATE_LIMITS holds per-minute
+# quotas with an optional burst, e.g. 'anthropic=50/10'; an upstream not
+# listed is not rate limited (Nominatim is spaced by GEOCODE_MIN_INTERVAL).
+# Failed calls are retried UPSTREAM_RETRIES times with exponential backoff
+# from UPSTREAM_RETRY_BACKOFF seconds, within the page deadline. After
+# CIRCUIT_FAILURE_THRESHOLD consecutive failures an upstream's circuit opens
+# for CIRCUIT_RESET_TIMEOUT seconds before a probe call is let through.
+UPSTREAM_RATE_LIMITS = os.getenv('SW_UPSTREAM_RATE_LIMITS', 'openmeteo=600/20,anthropic=50/10,openai=5/5')
+UPSTREAM_RETRIES = _env_int('SW_UPSTREAM_RETRIES', 2)
+UPSTREAM_RETRY_BACKOFF = _env_float('SW_UPSTREAM_RETRY_BACKOFF', 0.2)
+CIRCUIT_FAILURE_THRESHOLD = _env_int('SW_CIRCUIT_FAILURE_THRESHOLD', 5)
+CIRCUIT_RESET_TIMEOUT = _env_float('SW_CIRCUIT_RESET_TIMEOUT', 30.0)
+WEATHER_TIMEOUT = _env_float('SW_WEATHER_TIMEOUT', 10.0)
+ANTHROPIC_TIMEOUT = _env_float('SW_ANTHROPIC_TIMEOUT', 30.0)
+OPENAI_TIMEOUT = _env_float('SW_OPENAI_TIMEOUT', 60.0)
+
+# Admission control (admission.py): a page that would start a Claude or DALL-E
+# call while that upstream already has ADMISSION_MAX_<UPSTREAM> calls in
+# flight, or while more than ADMISSION_MAX_QUEUE stage and image tasks are
+# queued, is served degraded: with the city's nearest cached image and last
+# known theme. DESIGN_LAST_KNOWN_TTL is how long the last theme is kept.
+ADMISSION = _env_bool('SW_ADMISSION', True)
+ADMISSION_MAX_ANTHROPIC = _env_int('SW_ADMISSION_MAX_ANTHROPIC', 16)
+ADMISSION_MAX_OPENAI = _env_int('SW_ADMISSION_MAX_OPENAI', 8)
+ADMISSION_MAX_QUEUE = _env_int('SW_ADMISSION_MAX_QUEUE', 32)
+DESIGN_LAST_KNOWN_TTL = _env_int('SW_DESIGN_LAST_KNOWN_TTL', 7 * 24 * 3600)
+
+# Pre-warming (prewarm.py): every PREWARM_INTERVAL seconds, refetch the
+# weather of the PREWARM_TOP_N most requested cities (decaying request counts
+# with PREWARM_HALF_LIFE, at least PREWARM_MIN_SCORE) and generate their theme
+# and image ahead of demand, within PREWARM_MAX_GENERATIONS_PER_HOUR upstream
+# generations and PREWARM_CONCURRENCY cities at a time.
+PREWARM = _env_bool('SW_PREWARM', False)
+PREWARM_INTERVAL = _env_float('SW_PREWARM_INTERVAL', 600.0)
+PREWARM_TOP_N = _env_int('SW_PREWARM_TOP_N', 50)
+PREWARM_MIN_SCORE = _env_float('SW_PREWARM_MIN_SCORE', 3.0)
+PREWARM_HALF_LIFE = _env_float('SW_PREWARM_HALF_LIFE', 3600.0)
+PREWARM_MAX_GENERATIONS_PER_HOUR = _env_int('SW_PREWARM_MAX_GENERATIONS_PER_HOUR', 60)
+PREWARM_CONCURRENCY = _env_int('SW_PREWARM_CONCURRENCY', 2)
+PREWARM_TRACK_MAX = _env_int('SW_PREWARM_TRACK_MAX', 5000)
+
+# Multi-city batch endpoint (/api/weather/batch)
+BATCH_MAX_CITIES = _env_int('SW_BATCH_MAX_CITIES', 100)
+WEATHER_BATCH_SIZE = _env_int('SW_WEATHER_BATCH_SIZE', 25)
+BATCH_DESIGN_WORKERS = _env_int('SW_BATCH_DESIGN_WORKERS', 4)
+
+# Logging: records below WARNING are sampled at LOG_SAMPLE_RATE (0.0-1.0)
+LOG_LEVEL = os.getenv('SW_LOG_LEVEL', 'INFO').upper()
+LOG_SAMPLE_RATE = _env_float('SW_LOG_SAMPLE_RATE', 0.1)
@@ -0,0 +1,138 @@
+"""Cache for generated color palettes and font sets.
+
+Entries are keyed on the normalized city name plus a quantized weather
+signature (weather code family, temperature band, cloud-cover bucket and
+day/night), so small weather changes reuse an existing design. Bucket widths
+come from config and trade freshness against hit rate. Values are stored after
+``process_colors``/``process_fonts`` validation, as JSON in a cache backend
+(per-process memory by default, see cache_backends). For ``stale_grace``
+seconds past the TTL an entry is still returned, flagged stale, so callers can
+serve it while they refresh it in the background. The last design stored for
+each city, under any weather, is kept for ``last_known_ttl`` as a fallback
+for pages served degraded (see admission).
+"""
+import json
+import math
+import threading
+import time
+
+import config
+import metrics
+from cache_backends import LazyBackend
+from geocode_cache import normalize_city
+
+# WMO weather code -> family used in cache keys
+WEATHER_CODE_FAMILIES = {
+    0: 'clear', 1: 'clear',
+    2: 'cloudy', 3: 'cloudy',
+    45: 'fog', 48: 'fog',
+    51: 'drizzle', 53: 'drizzle', 55: 'drizzle', 56: 'drizzle', 57: 'drizzle',
+    61: 'rain', 63: 'rain', 65: 'rain', 66: 'rain', 67: 'rain',
+    80: 'rain', 81: 'rain', 82: 'rain',
+    71: 'snow', 73: 'snow', 75: 'snow', 77: 'snow', 85: 'snow', 86: 'snow',
+    95: 'thunderstorm', 96: 'thunderstorm', 99: 'thunderstorm',
+}
+
+
+def weather_family(weather_code):
+    """Map a WMO weather code to its family, e.g. 63 -> 'rain'"""
+    try:
+        return WEATHER_CODE_FAMILIES.get(int(weather_code), 'unknown')
+    except (TypeError, ValueError):
+        return 'unknown'
+
+
+def weather_signature(weather_data, temp_band=None, cloud_bucket=None):
+    """Quantize current weather into a hashable signature"""
+    temp_band = temp_band or config.DESIGN_TEMP_BAND
+    cloud_bucket = cloud_bucket or config.DESIGN_CLOUD_BUCKET
+    current = weather_data['current']
+    return (
+        weather_family(current['weather_code']),
+        math.floor(float(current['temperature']) / temp_band),
+        math.floor(float(current['cloud_cover']) / cloud_bucket),
+        'day' if current['is_day'] else 'night',
+    )
+
+
+class DesignCache:
+    """TTL + LRU cache over a cache backend, with per-kind hit/miss counters"""
+
+    def __init__(self, store, ttl=6 * 3600, stale_grace=0, last_known_ttl=7 * 24 * 3600):
+        self.store = store
+        self.ttl = ttl
+        self.stale_grace = stale_grace
+        self.last_known_ttl = last_known_ttl
+        self._lock = threading.Lock()
+        self._hits = {}
+        self._stale = {}
+        self._misses = {}
+
+    @staticmethod
+    def make_key(kind, city, weather_data):
+        return (kind, normalize_city(city), weather_signature(weather_data))
+
+    def _load(self, kind, city, weather_data):
+        """The cached design and whether it is past its TTL, or ``(None, False)``"""
+        stored = self.store.get(json.dumps(self.make_key(kind, city, weather_data)))
+        if stored is None:
+            return None, False
+        entry = json.loads(stored)
+        return entry['value'], entry['expires_at'] <= time.time()
+
+    def lookup(self, kind, city, weather_data):
+        """Return ``(design, stale)`` for ``kind``, counting the hit, stale hit or miss.
+
+        ``design`` is None on a miss; a stale design is past its TTL but inside
+        the grace window, and should be served while it is refreshed.
+        """
+        value, stale = self._load(kind, city, weather_data)
+        result = 'miss' if value is None else 'stale' if stale else 'hit'
+        counts = {'miss': self._misses, 'stale': self._stale, 'hit': self._hits}[result]
+        with self._lock:
+            counts[kind] = counts.get(kind, 0) + 1
+        metrics.cache_requests.inc(cache=f"design_{kind}", result=result)
+        return value, stale
+
+    def peek(self, kind, city, weather_data, allow_stale=False):
+        """Return the fresh (or, with ``allow_stale``, stale) cached design for
+        ``kind`` or None, without counting"""
+        value, stale = self._load(kind, city, weather_data)
+        return None if stale and not allow_stale else value
+
+    def peek_theme(self, city, weather_data):
+        """The fresh palette and fonts as a pair, or None unless both are cached"""
+        colors = self.peek('palette', city, weather_data)
+        fonts = self.peek('fonts', city, weather_data)
+        if colors is not None and fonts is not None:
+            return colors, fonts
+        return None
+
+    def last_known(self, kind, city):
+        """The design of ``kind`` most recently stored for a city under any weather, or None"""
+        stored = self.store.get(json.dumps(('last', kind, normalize_city(city))))
+        return None if stored is None else json.loads(stored)
+
+    def set(self, kind, city, weather_data, value):
+        key = json.dumps(self.make_key(kind, city, weather_data))
+        entry = {'value': value, 'expires_at': time.time() + self.ttl}
+        self.store.set(key, json.dumps(entry).encode('utf-8'), self.ttl + self.stale_grace)
+        self.store.set(json.dumps(('last', kind, normalize_city(city))),
+                       json.dumps(value).encode('utf-8'), self.last_known_ttl)
+
+    def stats(self):
+        """Hit/stale/miss counters per kind and the current entry count"""
+        with self._lock:
+            kinds = set(self._hits) | set(self._stale) | set(self._misses)
+            return {
+                'entries': len(self.store),
+                'hits': {kind: self._hits.get(kind, 0) for kind in kinds},
+                'stale': {kind: self._stale.get(kind, 0) for kind in kinds},
+                'misses': {kind: self._misses.get(kind, 0) for kind in kinds},
+            }
+
+
+design_cache = DesignCache(LazyBackend('design', 'memory', config.DESIGN_CACHE_SIZE),
+                           ttl=config.DESIGN_CACHE_TTL,
+                           stale_grace=config.DESIGN_STALE_GRACE,
+                           last_known_ttl=config.DESIGN_LAST_KNOWN_TTL)
@@ -0,0 +1,157 @@
+"""Offline geocoder backed by a local gazetteer.
+
+Cities are loaded from a GeoNames-style tab-separated dump (the
+``cities15000.txt`` layout) into flat arrays, with a sorted key list as a
+prefix index over folded names, ASCII names and a few alternate names. Matches
+are ranked by population. The bundled ``data/cities.txt`` is a small sample in
+the same layout; point ``SW_GAZETTEER_PATH`` at a full GeoNames dump for
+complete coverage.
+"""
+import heapq
+import threading
+from array import array
+from bisect import bisect_left
+
+import config
+from geocode_cache import fold_name, normalize_city
+
+# Column positions in the GeoNames cities dump
+_NAME = 1
+_ASCII_NAME = 2
+_ALTERNATE_NAMES = 3
+_LATITUDE = 4
+_LONGITUDE = 5
+_COUNTRY_CODE = 8
+_POPULATION = 14
+
+MAX_ALTERNATE_NAMES = 20
+MAX_SUGGESTIONS = 50
+# Prefixes up to this length have their ranked results precomputed at load
+_SHORT_PREFIX = 2
+
+
+class Gazetteer:
+    """Array-backed city table with a sorted prefix index"""
+
+    def __init__(self):
+        self.names = []
+        self.countries = []
+        self.latitudes = array('d')
+        self.longitudes = array('d')
+        self.populations = array('q')
+        self.keys = []
+        self.key_cities = array('l')
+        self._short_prefixes = {}
+
+    @classmethod
+    def load(cls, path):
+        """Build a gazetteer from a GeoNames-style cities file"""
+        gazetteer = cls()
+        entries = []
+        with open(path, encoding='utf-8') as f:
+            for line in f:
+                fields = line.rstrip('\n').split('\t')
+                if len(fields) <= _POPULATION:
+                    continue
+                try:
+                    latitude = float(fields[_LATITUDE])
+                    longitude = float(fields[_LONGITUDE])
+                    population = int(fields[_POPULATION] or 0)
+                except ValueError:
+                    continue
+
+                index = len(gazetteer.names)
+                gazetteer.names.append(fields[_NAME])
+                gazetteer.countries.append(fields[_COUNTRY_CODE])
+                gazetteer.latitudes.append(latitude)
+                gazetteer.longitudes.append(longitude)
+                gazetteer.populations.append(population)
+
+                keys = {fold_name(fields[_NAME]), fold_name(fields[_ASCII_NAME])}
+                alternates = [fold_name(name) for name in fields[_ALTERNATE_NAMES].split(',')]
+                keys.update([name for name in alternates if name.isascii()][:MAX_ALTERNATE_NAMES])
+                entries.extend((key, index) for key in keys if key)
+
+        entries.sort()
+        gazetteer.keys = [key for key, _ in entries]
+        gazetteer.key_cities = array('l', (index for _, index in entries))
+        gazetteer._build_short_prefixes()
+        return gazetteer
+
+    def _rank(self, cities, limit):
+        """Return up to ``limit`` distinct city indices, most populous first"""
+        return heapq.nlargest(limit, set(cities), key=self.populations.__getitem__)
+
+    def _build_short_prefixes(self):
+        """Precompute ranked results for very short prefixes, whose ranges are large"""
+        for length in range(1, _SHORT_PREFIX + 1):
+            groups = {}
+            for key, index in zip(self.keys, self.key_cities):
+                if len(key) >= length:
+                    groups.setdefault(key[:length], []).append(index)
+            for prefix, cities in groups.items():
+                self._short_prefixes[prefix] = self._rank(cities, MAX_SUGGESTIONS)
+
+    def _range(self, prefix):
+        """Index range of keys starting with ``prefix``"""
+        lo = bisect_left(self.keys, prefix)
+        hi = bisect_left(self.keys, prefix + '\uffff', lo)
+        return lo, hi
+
+    def search(self, prefix, limit=10):
+        """Return indices of cities with a name starting with ``prefix``"""
+        prefix = fold_name(prefix)
+        if not prefix:
+            return []
+        limit = min(limit, MAX_SUGGESTIONS)
+        if prefix in self._short_prefixes:
+            return self._short_prefixes[prefix][:limit]
+        lo, hi = self._range(prefix)
+        return self._rank(self.key_cities[lo:hi], limit)
+
+    def describe(self, index):
+        """Return a JSON-friendly description of a city"""
+        return {
+            'name': self.names[index],
+            'country': self.countries[index],
+            'label': f"{self.names[index]}, {self.countries[index]}",
+            'latitude': self.latitudes[index],
+            'longitude': self.longitudes[index],
+            'population': self.populations[index],
+        }
+
+    def suggest(self, prefix, limit=10):
+        """Autocomplete suggestions for a prefix, most populous first"""
+        return [self.describe(index) for index in self.search(prefix, limit)]
+
+    def geocode(self, query):
+        """Return ``(latitude, longitude)`` for the best exact name match, or None.
+
+        A trailing ``, CC`` country code narrows the match, e.g. ``Paris, US``.
+        """
+        name, _, qualifier = str(query).partition(',')
+        country = qualifier.strip().upper()
+        key = normalize_city(name)
+        lo, hi = self._range(key)
+        matches = [index for index, match in zip(self.key_cities[lo:hi], self.keys[lo:hi])
+                   if match == key]
+        if len(country) == 2:
+            matches = [index for index in matches if self.countries[index] == country] or matches
+        if not matches:
+            return None
+        best = self._rank(matches, 1)[0]
+        return (self.latitudes[best], self.longitudes[best])
+
+
+_gazetteer = None
+_gazetteer_lock = threading.Lock()
+
+
+def get_gazetteer():
+    """Return the process-wide gazetteer, loading it on first use"""
+    global _gazetteer
+    if _gazetteer is None:
+        with _gazetteer_lock:
+            if _gazetteer is None:
+                _gazetteer = Gazetteer.load(config.GAZETTEER_PATH)
+    return _gazetteer
@@ -0,0 +1,265 @@
+"""Cache for city geocoding results.
+
+Lookups go through an in-memory LRU, then a shared cache backend (SQLite by
+default, see cache_backends), and only then to the live geocoder. Cities that
+could not be found are cached too, with a shorter TTL. Live lookups are spaced
+out by a rate limiter so we stay within Nominatim's usage policy (about one
+request per second), shared by the worker processes on a host through a file
+in LOCK_DIR; separate hosts are spaced independently. Callers queue for a slot
+instead of failing, unless it would come after their deadline.
+"""
+import asyncio
+import json
+import os
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; the spacing is then per process
+    fcntl = None
+
+import config
+import metrics
+from cache_backends import open_backend
+from resilience import UpstreamUnavailable, remaining
+
+# Common alternative spellings, keyed by their normalized form
+CITY_ALIASES = {
+    'nyc': 'new york',
+    'new york city': 'new york',
+    'ny': 'new york',
+    'la': 'los angeles',
+    'sf': 'san francisco',
+    'dc': 'washington',
+    'washington dc': 'washington',
+    'washington d c': 'washington',
+    'st petersburg': 'saint petersburg',
+    'sankt petersburg': 'saint petersburg',
+    'bombay': 'mumbai',
+    'calcutta': 'kolkata',
+    'madras': 'chennai',
+    'peking': 'beijing',
+    'saigon': 'ho chi minh city',
+    'kiev': 'kyiv',
+    'munchen': 'munich',
+    'koln': 'cologne',
+    'wien': 'vienna',
+    'praha': 'prague',
+    'roma': 'rome',
+    'lisboa': 'lisbon',
+    'firenze': 'florence',
+    'venezia': 'venice',
+    'warszawa': 'warsaw',
+}
+
+# Marker stored for cities the geocoder could not find
+_NOT_FOUND = object()
+
+
+def fold_name(name):
+    """Fold case, strip diacritics and punctuation, and collapse whitespace"""
+    text = unicodedata.normalize('NFKD', str(name))
+    text = ''.join(ch for ch in text if not unicodedata.combining(ch))
+    text = text.casefold()
+    text = re.sub(r"[^\w\s,]", ' ', text)
+    text = re.sub(r"\s*,\s*", ', ', text)
+    return re.sub(r"\s+", ' ', text).strip(' ,')
+
+
+def normalize_city(city):
+    """Normalize a city name for use as a cache key.
+
+    Folds the name with ``fold_name`` and maps common aliases to a single
+    canonical name.
+    """
+    text = fold_name(city)
+    return CITY_ALIASES.get(text, text)
+
+
+def geocode_query(city):
+    """The name to send the geocoder for ``city``: the canonical name when it
+    is an alias, so the result matches the key it is cached under"""
+    return CITY_ALIASES.get(fold_name(city), city)
+
+
+class RateLimiter:
+    """Spaces calls at least ``min_interval`` seconds apart.
+
+    With ``path`` the time of the next free slot lives in that file, held
+    under an exclusive lock, so the spacing holds across all worker processes
+    on the host; without it (or without fcntl) it holds per process. Callers
+    wait for the slot to come free rather than failing, unless it would come
+    after the current deadline (see resilience).
+    """
+
+    def __init__(self, min_interval, path=None, upstream='nominatim'):
+        self.min_interval = min_interval
+        self.path = path if fcntl is not None else None
+        self.upstream = upstream
+        self._lock = threading.Lock()
+        self._next_slot = 0.0
+
+    def _take(self, next_slot, now):
+        """Seconds to wait (0 if the slot is taken now) and the next free slot"""
+        if now >= next_slot:
+            return 0, now + self.min_interval
+        return next_slot - now, next_slot
+
+    def _take_shared(self):
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            stored = os.pread(fd, 64, 0)
+            wait, next_slot = self._take(float(stored) if stored else 0.0, time.time())
+            if not wait:
+                os.ftruncate(fd, 0)
+                os.pwrite(fd, repr(next_slot).encode('ascii'), 0)
+            return wait
+        finally:
+            # Closing the descriptor releases the lock
+            os.close(fd)
+
+    def wait_time(self):
+        """Take the slot and return 0, or return how long until it comes free
+        without taking it; raises UpstreamUnavailable if that is past the deadline"""
+        with self._lock:
+            if self.path is not None:
+                wait = self._take_shared()
+            else:
+                wait, self._next_slot = self._take(self._next_slot, time.monotonic())
+        left = remaining()
+        if wait and left is not None and wait > left:
+            metrics.upstream_rejections.inc(upstream=self.upstream, reason='rate_limited')
+            raise UpstreamUnavailable(self.upstream, 'rate limited')
+        return wait
+
+
+class GeocodeCache:
+    """In-memory LRU in front of a shared cache backend of coordinates"""
+
+    def __init__(self, store, max_entries=2048, ttl=30 * 24 * 3600,
+                 negative_ttl=24 * 3600, min_interval=1.0, rate_limit_path=None):
+        self.store = store
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.rate_limiter = RateLimiter(min_interval, rate_limit_path)
+        self._lock = threading.Lock()
+        self._memory = OrderedDict()
+
+    def _remember(self, key, value, expires_at):
+        """Store an entry in the in-memory LRU, evicting the oldest if full"""
+        self._memory[key] = (value, expires_at)
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def get(self, key):
+        """Return cached coordinates, ``_NOT_FOUND`` for a cached miss, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    return value
+                del self._memory[key]
+
+        stored = self.store.get(key)
+        if stored is None:
+            return None
+        entry = json.loads(stored)
+        value = _NOT_FOUND if entry['coordinates'] is None else tuple(entry['coordinates'])
+        with self._lock:
+            self._remember(key, value, entry['expires_at'])
+        return value
+
+    def set(self, key, coordinates):
+        """Store coordinates for a key, or a negative entry if they are None"""
+        if coordinates is None:
+            value, ttl = _NOT_FOUND, self.negative_ttl
+        else:
+            value, ttl = tuple(coordinates), self.ttl
+        expires_at = time.time() + ttl
+
+        with self._lock:
+            self._remember(key, value, expires_at)
+        entry = {'coordinates': None if value is _NOT_FOUND else list(value),
+                 'expires_at': expires_at}
+        self.store.set(key, json.dumps(entry).encode('utf-8'), ttl)
+
+    def lookup(self, city, geocode):
+        """Return coordinates for ``city``, calling ``geocode`` on a miss.
+
+        ``geocode`` is given ``geocode_query(city)`` and returns a
+        ``(latitude, longitude)`` tuple or None when the city does not exist;
+        exceptions propagate and are not cached.
+        """
+        key = normalize_city(city)
+        cached = self.get(key)
+        metrics.cache_requests.inc(cache='geocode', result='miss' if cached is None else 'hit')
+        if cached is not None:
+            return None if cached is _NOT_FOUND else cached
+
+        # The slot is only taken once the cache has missed right before it
+        wait = self.rate_limiter.wait_time()
+        while wait:
+            time.sleep(wait)
+            # Another thread or process may have resolved the key meanwhile
+            cached = self.get(key)
+            if cached is not None:
+                return None if cached is _NOT_FOUND else cached
+            wait = self.rate_limiter.wait_time()
+
+        coordinates = geocode(geocode_query(city))
+        self.set(key, coordinates)
+        return coordinates
+
+    async def lookup_async(self, city, geocode):
+        """``lookup`` for coroutines: ``geocode`` is awaited and queueing does
+        not block the event loop"""
+        key = normalize_city(city)
+        cached = self.get(key)
+        metrics.cache_requests.inc(cache='geocode', result='miss' if cached is None else 'hit')
+        if cached is not None:
+            return None if cached is _NOT_FOUND else cached
+
+        wait = await asyncio.to_thread(self.rate_limiter.wait_time)
+        while wait:
+            await asyncio.sleep(wait)
+            cached = await asyncio.to_thread(self.get, key)
+            if cached is not None:
+                return None if cached is _NOT_FOUND else cached
+            wait = await asyncio.to_thread(self.rate_limiter.wait_time)
+
+        coordinates = await geocode(geocode_query(city))
+        self.set(key, coordinates)
+        return coordinates
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_geocode_cache():
+    """Return the process-wide geocode cache, opening it on first use"""
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                store = open_backend('geocode', 'sqlite', config.GEOCODE_STORE_SIZE,
+                                     path=config.GEOCODE_CACHE_PATH)
+                _cache = GeocodeCache(store,
+                                      max_entries=config.GEOCODE_CACHE_SIZE,
+                                      ttl=config.GEOCODE_TTL,
+                                      negative_ttl=config.GEOCODE_NEGATIVE_TTL,
+                                      min_interval=config.GEOCODE_MIN_INTERVAL,
+                                      rate_limit_path=os.path.join(config.LOCK_DIR,
+                                                                   'nominatim.slot'))
+    return _cache
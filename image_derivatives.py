@@ -0,0 +1,138 @@
+"""Responsive, compressed derivatives of generated images.
+
+After an image is stored, a small worker pool encodes WebP (and AVIF when
+Pillow supports it) copies at a few widths next to the original, plus a tiny
+blurred placeholder kept inline as a data URI. The result is recorded in the
+image store so the template can emit ``<picture>``/``srcset`` markup, with the
+original PNG as fallback. Pillow is optional; without it images are served
+as-is.
+"""
+import base64
+import importlib.util
+import io
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# Pillow is imported on first use, in the derivative workers
+HAVE_PILLOW = importlib.util.find_spec('PIL') is not None
+
+import config
+from image_store import get_image_store
+from logs import get_logger
+
+PLACEHOLDER_WIDTH = 32
+
+log = get_logger('derivatives')
+
+_executor = None
+_executor_lock = threading.Lock()
+_pending = set()
+_pending_lock = threading.Lock()
+
+
+def _get_executor():
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(max_workers=config.IMAGE_DERIVATIVE_WORKERS,
+                                               thread_name_prefix='derivatives')
+    return _executor
+
+
+def _formats():
+    """(extension, mime type, save options) for each derivative format we can encode"""
+    from PIL import features
+
+    formats = []
+    if features.check('avif'):
+        formats.append(('avif', 'image/avif', {'quality': config.IMAGE_AVIF_QUALITY}))
+    formats.append(('webp', 'image/webp', {'quality': config.IMAGE_WEBP_QUALITY, 'method': 4}))
+    return formats
+
+
+def _save_atomically(image, path, fmt, options):
+    tmp_path = f"{path}.tmp"
+    image.save(tmp_path, format=fmt, **options)
+    os.replace(tmp_path, path)
+
+
+def create_derivatives(image_path):
+    """Encode the derivatives of a stored image and record them in the store"""
+    from PIL import Image, ImageFilter
+
+    store = get_image_store()
+    source_path = store.path_for(image_path)
+    stem, _ = os.path.splitext(os.path.basename(source_path))
+    image_dir = os.path.dirname(source_path)
+
+    files = []
+    sources = []
+    with Image.open(source_path) as original:
+        original = original.convert('RGB')
+        widths = sorted({w for w in config.IMAGE_DERIVATIVE_WIDTHS if w < original.width} | {original.width})
+
+        for extension, mime_type, options in _formats():
+            srcset = []
+            for width in widths:
+                height = round(original.height * width / original.width)
+                resized = original if width == original.width else original.resize((width, height), Image.LANCZOS)
+                filename = f"{stem}.{width}w.{extension}"
+                _save_atomically(resized, os.path.join(image_dir, filename), extension.upper(), options)
+                files.append({'filename': filename, 'width': width, 'type': mime_type})
+                srcset.append(f"{store.url_for(filename)} {width}w")
+            sources.append({'type': mime_type, 'srcset': ', '.join(srcset)})
+
+        height = max(1, round(original.height * PLACEHOLDER_WIDTH / original.width))
+        tiny = original.resize((PLACEHOLDER_WIDTH, height)).filter(ImageFilter.GaussianBlur(2))
+        buffer = io.BytesIO()
+        tiny.save(buffer, format='WEBP', quality=40)
+        placeholder = 'data:image/webp;base64,' + base64.b64encode(buffer.getvalue()).decode('ascii')
+
+    variants = {'files': files, 'sources': sources, 'placeholder': placeholder}
+    if not store.set_variants(os.path.basename(source_path), variants):
+        # The original was evicted while we were encoding
+        for entry in files:
+            try:
+                os.remove(os.path.join(image_dir, entry['filename']))
+            except OSError:
+                pass
+        return None
+    return variants
+
+
+def _run(image_path):
+    try:
+        create_derivatives(image_path)
+    except Exception as e:
+        log.error("creating derivatives failed", image_path=image_path, error=str(e))
+    finally:
+        with _pending_lock:
+            _pending.discard(image_path)
+
+
+def derivatives_enabled():
+    """Whether stored images get derivatives"""
+    return HAVE_PILLOW and config.IMAGE_DERIVATIVES
+
+
+def schedule_derivatives(image_path):
+    """Queue derivative generation for a stored image, once per image"""
+    if not derivatives_enabled() or not image_path:
+        return
+    with _pending_lock:
+        if image_path in _pending:
+            return
+        _pending.add(image_path)
+    _get_executor().submit(_run, image_path)
+
+
+def image_variants(image_path):
+    """Return recorded derivatives for an image, scheduling them if missing"""
+    if not image_path:
+        return None
+    variants = get_image_store().get_variants(image_path)
+    if variants is None:
+        schedule_derivatives(image_path)
+    return variants
@@ -0,0 +1,220 @@
+"""Color palettes extracted from the generated city image.
+
+The image is downsampled to at most PALETTE_SAMPLE_SIZE pixels a side and its
+pixels quantized into PALETTE_CLUSTERS colors with k-means (k-means++ seeding,
+seeded so an image always gives the same palette). The clusters are then
+assigned to the seven ``color_*`` roles:
+
+- page background and tiles container: the two most common colors;
+- tiles: the remaining color with the most room for contrast, i.e. the one
+  whose luminance is furthest from the point where black and white text
+  contrast equally;
+- heading: the most saturated color; high and low temperatures: the most
+  vivid colors closest to a warm and a cool hue; weather details: the most neutral color.
+
+Each text color is then lightened or darkened just enough to keep a WCAG
+contrast ratio of PALETTE_MIN_CONTRAST against the tiles. Extraction reads
+the smallest WebP/AVIF derivative when one is ready and takes tens of
+milliseconds, against seconds for an LLM palette. NumPy and Pillow are
+optional; without them PALETTE_MODE falls back to 'llm'.
+"""
+import functools
+import importlib.util
+import os
+
+HAVE_NUMPY = importlib.util.find_spec('numpy') is not None
+HAVE_PILLOW = importlib.util.find_spec('PIL') is not None
+
+import config
+import metrics
+from image_store import get_image_store
+from logs import get_logger
+
+if HAVE_NUMPY:
+    import numpy as np
+
+log = get_logger('image_palette')
+
+# Relative luminance at which white and black text have the same contrast
+CONTRAST_PIVOT = 0.179
+WARM_HUE = 20.0
+COOL_HUE = 210.0
+# Colors below this saturation have no meaningful hue
+MIN_HUE_SATURATION = 0.15
+
+
+def image_palettes_available():
+    """Whether NumPy and Pillow are installed for image palettes"""
+    return HAVE_NUMPY and HAVE_PILLOW
+
+
+def load_pixels(path, size=None):
+    """RGB pixels of an image downsampled to at most ``size`` a side, as an (n, 3) float array"""
+    from PIL import Image
+
+    size = size or config.PALETTE_SAMPLE_SIZE
+    with Image.open(path) as image:
+        image.draft('RGB', (size, size))
+        image = image.convert('RGB')
+        image.thumbnail((size, size), Image.BILINEAR)
+        return np.asarray(image, dtype=np.float64).reshape(-1, 3)
+
+
+def _nearest(pixels, norms, centers):
+    """Index of the nearest center for each pixel; |p - c|^2 expanded so it is one matmul"""
+    return (norms[:, None] - 2 * pixels @ centers.T + (centers ** 2).sum(axis=1)).argmin(axis=1)
+
+
+def kmeans(pixels, k, iterations=20, seed=0):
+    """Cluster ``pixels`` into at most ``k`` colors; returns the centers and their pixel counts"""
+    rng = np.random.default_rng(seed)
+    norms = (pixels ** 2).sum(axis=1)
+    centers = [pixels[rng.integers(len(pixels))]]
+    nearest = ((pixels - centers[0]) ** 2).sum(axis=1)
+    while len(centers) < k and nearest.sum() > 0:
+        center = pixels[rng.choice(len(pixels), p=nearest / nearest.sum())]
+        centers.append(center)
+        nearest = np.minimum(nearest, ((pixels - center) ** 2).sum(axis=1))
+    centers = np.array(centers)
+
+    for _ in range(iterations):
+        labels = _nearest(pixels, norms, centers)
+        counts = np.bincount(labels, minlength=len(centers))
+        sums = np.stack([np.bincount(labels, weights=pixels[:, c], minlength=len(centers))
+                         for c in range(3)], axis=1)
+        updated = np.where(counts[:, None] > 0, sums / np.maximum(counts, 1)[:, None], centers)
+        converged = np.abs(updated - centers).max() < 0.5
+        centers = updated
+        if converged:
+            break
+
+    labels = _nearest(pixels, norms, centers)
+    counts = np.bincount(labels, minlength=len(centers))
+    keep = counts > 0
+    return centers[keep], counts[keep]
+
+
+def relative_luminance(rgb):
+    """WCAG relative luminance of colors in 0-255 RGB, along the last axis"""
+    channels = np.asarray(rgb, dtype=np.float64) / 255.0
+    linear = np.where(channels <= 0.03928, channels / 12.92, ((channels + 0.055) / 1.055) ** 2.4)
+    return linear @ np.array([0.2126, 0.7152, 0.0722])
+
+
+def contrast_ratio(rgb, other):
+    """WCAG contrast ratio between colors, from 1 to 21"""
+    lum, other_lum = relative_luminance(rgb), relative_luminance(other)
+    return (np.maximum(lum, other_lum) + 0.05) / (np.minimum(lum, other_lum) + 0.05)
+
+
+def ensure_contrast(rgb, background, minimum, steps=64):
+    """``rgb`` moved towards white or black just enough to reach ``minimum``
+    contrast against ``background``; the most contrasting mix if it cannot"""
+    rgb = np.asarray(rgb, dtype=np.float64)
+    if contrast_ratio(rgb, background) >= minimum:
+        return rgb
+    target = 255.0 if relative_luminance(background) < CONTRAST_PIVOT else 0.0
+    mixes = np.round(rgb + (target - rgb) * np.linspace(0, 1, steps + 1)[:, None])
+    ratios = contrast_ratio(mixes, background)
+    passing = np.flatnonzero(ratios >= minimum)
+    return mixes[passing[0]] if len(passing) else mixes[ratios.argmax()]
+
+
+def hue_and_saturation(rgb):
+    """HSV hue in degrees and saturation of colors in 0-255 RGB"""
+    rgb = np.asarray(rgb, dtype=np.float64) / 255.0
+    high, low = rgb.max(axis=-1), rgb.min(axis=-1)
+    spread = high - low
+    safe = np.where(spread == 0, 1, spread)
+    r, g, b = rgb[..., 0], rgb[..., 1], rgb[..., 2]
+    hue = np.where(high == r, ((g - b) / safe) % 6,
+                   np.where(high == g, (b - r) / safe + 2, (r - g) / safe + 4)) * 60
+    saturation = np.where(high == 0, 0, spread / np.where(high == 0, 1, high))
+    return np.where(spread == 0, 0, hue), saturation
+
+
+def _hue_distance(hue, target):
+    difference = np.abs(hue - target) % 360
+    return np.minimum(difference, 360 - difference)
+
+
+def to_hex(rgb):
+    return '#{:02x}{:02x}{:02x}'.format(*(int(round(min(max(c, 0), 255))) for c in rgb))
+
+
+def assign_roles(centers, counts, min_contrast=None):
+    """Map clustered colors onto the seven ``color_*`` roles"""
+    min_contrast = config.PALETTE_MIN_CONTRAST if min_contrast is None else min_contrast
+    # Contrast is checked on the colors as they will be written in hex
+    centers = np.round(centers)
+    order = np.argsort(-counts, kind='stable')
+    background = centers[order[0]]
+    container = centers[order[1]] if len(order) > 1 else background
+
+    others = order[2:] if len(order) > 2 else order
+    luminance = relative_luminance(centers)
+    tiles_index = others[np.abs(luminance[others] - CONTRAST_PIVOT).argmax()]
+    tiles = centers[tiles_index]
+
+    text = [i for i in order if i != tiles_index] or list(order)
+    hue, saturation = hue_and_saturation(centers)
+    text_saturation = saturation[text]
+
+    def by_hue(target):
+        # Closest hue, favoring vivid colors: a bright red reads warmer than a brown
+        hued = [i for i in text if saturation[i] >= MIN_HUE_SATURATION]
+        if not hued:
+            return text[int(text_saturation.argmax())]
+        return hued[int((_hue_distance(hue[hued], target) / 180 - saturation[hued]).argmin())]
+
+    roles = {
+        'color_tile_heading': centers[text[int(text_saturation.argmax())]],
+        'color_tile_temp_high': centers[by_hue(WARM_HUE)],
+        'color_tile_temp_low': centers[by_hue(COOL_HUE)],
+        'color_tile_weather_details': centers[text[int(text_saturation.argmin())]],
+    }
+    palette = {
+        'color_page_background': to_hex(background),
+        'color_tiles_container': to_hex(container),
+        'color_tiles': to_hex(tiles),
+    }
+    for role, color in roles.items():
+        palette[role] = to_hex(ensure_contrast(color, tiles, min_contrast))
+    return palette
+
+
+@metrics.timed('palette_image')
+def palette_from_file(path):
+    """Palette for the image file at ``path``"""
+    centers, counts = kmeans(load_pixels(path), config.PALETTE_CLUSTERS)
+    return assign_roles(centers, counts)
+
+
+def _smallest_rendition(image_path):
+    """File of the smallest derivative of a stored image if one exists, else
+    the original; decoding dominates extraction time"""
+    store = get_image_store()
+    original = store.path_for(image_path)
+    files = (store.get_variants(image_path) or {}).get('files') or []
+    for entry in sorted(files, key=lambda entry: entry['width']):
+        path = os.path.join(os.path.dirname(original), entry['filename'])
+        if os.path.exists(path):
+            return path
+    return original
+
+
+@functools.lru_cache(maxsize=256)
+def _stored_image_palette(image_path):
+    return palette_from_file(_smallest_rendition(image_path))
+
+
+def image_palette(image_path):
+    """Palette for a stored image, by served path; None if it cannot be read.
+
+    Stored images never change under a path, so palettes are memoized.
+    """
+    try:
+        return dict(_stored_image_palette(image_path))
+    except Exception as e:
+        log.error("image palette failed", image_path=image_path, error=str(e))
+        return None
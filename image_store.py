@@ -0,0 +1,297 @@
+"""Indexed store for generated city images.
+
+A SQLite index maps each cache key to its file, size, creation time and last
+access time, so lookups and eviction never scan the image directory. Files are
+written to a temporary name and renamed into place, and the least recently used
+images are evicted whenever the store exceeds its count or byte budget. On
+startup the index and the directory are reconciled: index rows whose file is
+gone are dropped and files the index does not know about are removed.
+
+Responsive derivatives of an image are recorded in its ``variants`` column and
+are evicted and reconciled together with the original.
+
+For ``stale_grace`` seconds past its TTL an image is still returned by
+``lookup``, flagged stale, to be served while a replacement is generated. Files
+replaced by a newer image are kept for ``RETIRED_GRACE_SECONDS`` before they
+are removed, so pages and proxies that still reference them do not break.
+"""
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+import time
+
+import config
+import metrics
+from logs import get_logger
+
+log = get_logger('image_store')
+
+# Leave unindexed files this young alone during reconcile; another worker
+# may be between renaming a file into place and indexing it
+ORPHAN_GRACE_SECONDS = 3600
+
+# Keep replaced image files this long; covers the page cache TTL plus the
+# max-age browsers and proxies may hold a page that references them
+RETIRED_GRACE_SECONDS = 3600
+
+
+class ImageStore:
+    def __init__(self, image_dir, index_path, url_prefix='/static/images',
+                 ttl=24 * 3600, max_count=100, max_bytes=512 * 1024 * 1024, stale_grace=0):
+        self.image_dir = image_dir
+        self.url_prefix = url_prefix.rstrip('/')
+        self.ttl = ttl
+        self.stale_grace = stale_grace
+        self.max_count = max_count
+        self.max_bytes = max_bytes
+        os.makedirs(image_dir, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(index_path, timeout=30, check_same_thread=False,
+                                   isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS images (
+                key TEXT PRIMARY KEY,
+                filename TEXT NOT NULL,
+                size INTEGER NOT NULL,
+                created REAL NOT NULL,
+                last_access REAL NOT NULL,
+                city TEXT,
+                weather TEXT
+            )
+        """)
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(images)")}
+        if 'variants' not in columns:
+            self._db.execute("ALTER TABLE images ADD COLUMN variants TEXT")
+        self._db.execute("CREATE INDEX IF NOT EXISTS images_last_access ON images (last_access)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS images_filename ON images (filename)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS images_city ON images (lower(trim(city)))")
+        self._db.execute("""
+            CREATE TABLE IF NOT EXISTS retired (
+                filename TEXT PRIMARY KEY,
+                retired_at REAL NOT NULL
+            )
+        """)
+
+    def url_for(self, filename):
+        return f"{self.url_prefix}/{filename}"
+
+    def _path(self, filename):
+        return os.path.join(self.image_dir, filename)
+
+    def get(self, key):
+        """Return the served path of a fresh image for ``key``, or None"""
+        image_path, stale = self._lookup(key)
+        if stale:
+            image_path = None
+        metrics.cache_requests.inc(cache='image', result='hit' if image_path else 'miss')
+        return image_path
+
+    def lookup(self, key):
+        """Return ``(served path, stale)`` for ``key``; the path is None on a miss.
+
+        A stale image is past its TTL but inside the grace window.
+        """
+        image_path, stale = self._lookup(key)
+        result = 'miss' if image_path is None else 'stale' if stale else 'hit'
+        metrics.cache_requests.inc(cache='image', result=result)
+        return image_path, stale
+
+    def peek(self, key, allow_stale=False):
+        """Like ``get`` (or, with ``allow_stale``, ``lookup``) but without counting a cache request"""
+        image_path, stale = self._lookup(key)
+        return None if stale and not allow_stale else image_path
+
+    def images_for_city(self, city):
+        """``(weather, served path)`` of every indexed image of a city whose file exists"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT weather, filename FROM images WHERE lower(trim(city)) = lower(trim(?))",
+                (city,)).fetchall()
+        return [(weather, self.url_for(filename)) for weather, filename in rows
+                if os.path.exists(self._path(filename))]
+
+    def _lookup(self, key):
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT filename, created FROM images WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None, False
+            filename, created = row
+            age = now - created
+            if age >= self.ttl + self.stale_grace or not os.path.exists(self._path(filename)):
+                return None, False
+            self._db.execute("UPDATE images SET last_access = ? WHERE key = ?", (now, key))
+        return self.url_for(filename), age >= self.ttl
+
+    @staticmethod
+    def _variant_files(variants):
+        """Filenames of the derivatives recorded in a ``variants`` column"""
+        if not variants:
+            return []
+        return [source['filename'] for source in json.loads(variants).get('files', [])]
+
+    def _remove_files(self, filenames):
+        for filename in filenames:
+            try:
+                os.remove(self._path(filename))
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                log.error("removing image file failed", filename=filename, error=str(e))
+
+    def put(self, key, data, filename, city=None, weather=None):
+        """Atomically write image bytes for ``key`` and return the served path"""
+        return self.write_stream(key, [data], filename, city=city, weather=weather)
+
+    def write_stream(self, key, chunks, filename, max_bytes=None, city=None, weather=None):
+        """Atomically write an iterable of byte chunks for ``key``.
+
+        Chunks go to a temp file in the image directory, which is fsynced and
+        renamed into place only once the stream completes. Raises ValueError if
+        the stream exceeds ``max_bytes``; the partial file is removed.
+        """
+        fd, tmp_path = self.temp_file()
+        try:
+            size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise ValueError(f"Image exceeds {max_bytes} bytes")
+                    f.write(chunk)
+                f.flush()
+                os.fsync(f.fileno())
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        return self.commit(key, tmp_path, filename, city=city, weather=weather)
+
+    def temp_file(self):
+        """Create a temp file in the image directory; returns ``(fd, path)``"""
+        return tempfile.mkstemp(dir=self.image_dir, suffix='.tmp')
+
+    def commit(self, key, tmp_path, filename, city=None, weather=None):
+        """Move a fully written temp file into place and index it under ``key``"""
+        os.replace(tmp_path, self._path(filename))
+        size = os.path.getsize(self._path(filename))
+        now = time.time()
+
+        with self._lock:
+            row = self._db.execute(
+                "SELECT filename, variants FROM images WHERE key = ?", (key,)).fetchone()
+            self._db.execute(
+                "INSERT OR REPLACE INTO images (key, filename, size, created, last_access, city, weather) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, filename, size, now, now, city, weather))
+            if row is not None and row[0] != filename:
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO retired (filename, retired_at) VALUES (?, ?)",
+                    [(old, now) for old in [row[0]] + self._variant_files(row[1])])
+
+        self.evict()
+        return self.url_for(filename)
+
+    def get_variants(self, image_path):
+        """Return the recorded derivatives for a served image path, or None"""
+        filename = os.path.basename(image_path)
+        with self._lock:
+            row = self._db.execute(
+                "SELECT variants FROM images WHERE filename = ?", (filename,)).fetchone()
+        if row is None or not row[0]:
+            return None
+        return json.loads(row[0])
+
+    def set_variants(self, filename, variants):
+        """Record derivatives for an image; False if the image is no longer indexed"""
+        with self._lock:
+            updated = self._db.execute(
+                "UPDATE images SET variants = ? WHERE filename = ?",
+                (json.dumps(variants), filename)).rowcount
+        return updated > 0
+
+    def path_for(self, image_path):
+        """Filesystem path of a served image path"""
+        return self._path(os.path.basename(image_path))
+
+    def _remove_retired(self):
+        """Remove replaced files once their grace period is over"""
+        cutoff = time.time() - RETIRED_GRACE_SECONDS
+        with self._lock:
+            expired = [filename for filename, in self._db.execute(
+                "SELECT filename FROM retired WHERE retired_at < ?", (cutoff,))]
+            self._db.execute("DELETE FROM retired WHERE retired_at < ?", (cutoff,))
+        self._remove_files(expired)
+
+    def evict(self):
+        """Drop least recently used images until both budgets are met"""
+        self._remove_retired()
+        with self._lock:
+            count, total = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM images").fetchone()
+            if count <= self.max_count and total <= self.max_bytes:
+                return
+
+            victims = []
+            for key, filename, size, variants in self._db.execute(
+                    "SELECT key, filename, size, variants FROM images ORDER BY last_access"):
+                if count <= self.max_count and total <= self.max_bytes:
+                    break
+                victims.append((key, [filename] + self._variant_files(variants)))
+                count -= 1
+                total -= size
+            self._db.executemany("DELETE FROM images WHERE key = ?",
+                                 [(key,) for key, _ in victims])
+        self._remove_files([filename for _, filenames in victims for filename in filenames])
+
+    def reconcile(self):
+        """Drop index rows without files and remove files without index rows"""
+        with self._lock:
+            rows = self._db.execute("SELECT key, filename, variants FROM images").fetchall()
+            missing = [(key,) for key, filename, _ in rows if not os.path.exists(self._path(filename))]
+            self._db.executemany("DELETE FROM images WHERE key = ?", missing)
+            retired = {filename for filename, in self._db.execute("SELECT filename FROM retired")}
+        missing_keys = {key for key, in missing}
+        known = set(retired)
+        for key, filename, variants in rows:
+            if key not in missing_keys:
+                known.add(filename)
+                known.update(self._variant_files(variants))
+
+        cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        orphans = []
+        for entry in os.scandir(self.image_dir):
+            if not entry.is_file() or entry.name.startswith('.') or entry.name in known:
+                continue
+            if entry.stat().st_mtime < cutoff:
+                orphans.append(entry.name)
+        self._remove_files(orphans)
+
+        if missing or orphans:
+            log.info("image store reconciled", missing=len(missing), orphans=len(orphans))
+        self.evict()
+
+
+_store = None
+_store_lock = threading.Lock()
+
+
+def get_image_store():
+    """Return the process-wide image store, reconciling it on first use"""
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                store = ImageStore(config.IMAGE_DIR, config.IMAGE_INDEX_PATH,
+                                   url_prefix=config.IMAGE_URL_PREFIX,
+                                   ttl=config.IMAGE_TTL,
+                                   max_count=config.IMAGE_MAX_COUNT,
+                                   max_bytes=config.IMAGE_MAX_BYTES,
+                                   stale_grace=config.IMAGE_STALE_GRACE)
+                store.reconcile()
+                _store = store
+    return _store
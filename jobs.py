@@ -0,0 +1,177 @@
+"""Background job queue for slow generations such as DALL-E images.
+
+Jobs run on a bounded worker pool and are identified by the caller's key, so
+submitting the same key while a job is pending returns the existing job.
+Finished jobs are kept for ``ttl`` seconds so pages can poll their status.
+"""
+import asyncio
+import contextvars
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from logs import get_logger
+
+log = get_logger('jobs')
+
+
+class Job:
+    def __init__(self, job_id):
+        self.id = job_id
+        self.status = 'pending'
+        self.result = None
+        self.error = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def add_done_callback(self, fn):
+        """Call ``fn(job)`` when the job finishes, or now if it already has"""
+        with self._lock:
+            if self.finished_at is None:
+                self._callbacks.append(fn)
+                return
+        fn(self)
+
+    def _finish(self):
+        with self._lock:
+            self.finished_at = time.time()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn(self)
+            except Exception as e:
+                log.error("job callback failed", job=self.id, error=str(e))
+
+    def wait_async(self):
+        """Future on the running loop that resolves to the job once it finishes"""
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+
+        def done(job):
+            loop.call_soon_threadsafe(lambda: future.done() or future.set_result(job))
+
+        self.add_done_callback(done)
+        return future
+
+    def to_dict(self):
+        return {'id': self.id, 'status': self.status, 'result': self.result, 'error': self.error}
+
+
+class JobQueue:
+    def __init__(self, max_workers, ttl=600, name='jobs'):
+        self.ttl = ttl
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._jobs = {}
+        self._tasks = set()
+
+    def _prune(self):
+        cutoff = time.time() - self.ttl
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+
+    def submit(self, job_id, fn, *args):
+        """Queue ``fn(*args)`` under ``job_id`` unless that job is already in flight"""
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+            if job is not None and job.status in ('pending', 'running'):
+                return job
+            job = self._jobs[job_id] = Job(job_id)
+        self._executor.submit(self._run, job, fn, args)
+        return job
+
+    @staticmethod
+    def _run(job, fn, args):
+        job.status = 'running'
+        try:
+            job.result = fn(*args)
+            job.status = 'done' if job.result else 'failed'
+        except Exception as e:
+            log.error("job failed", job=job.id, error=str(e))
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job._finish()
+
+    def submit_coroutine(self, job_id, fn, *args):
+        """Like ``submit`` but runs ``await fn(*args)`` as a task on the running loop"""
+        with self._lock:
+            self._prune()
+            job = self._jobs.get(job_id)
+            if job is not None and job.status in ('pending', 'running'):
+                return job
+            job = self._jobs[job_id] = Job(job_id)
+        # A fresh context, so the job outlives the deadline of the page that started it
+        task = contextvars.Context().run(asyncio.get_running_loop().create_task,
+                                         self._run_async(job, fn, args))
+        # The loop only keeps weak references to tasks
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+        return job
+
+    @staticmethod
+    async def _run_async(job, fn, args):
+        job.status = 'running'
+        try:
+            job.result = await fn(*args)
+            job.status = 'done' if job.result else 'failed'
+        except Exception as e:
+            log.error("job failed", job=job.id, error=str(e))
+            job.error = str(e)
+            job.status = 'failed'
+        finally:
+            job._finish()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def pending(self):
+        """Number of jobs waiting for a worker"""
+        with self._lock:
+            return sum(job.status == 'pending' for job in self._jobs.values())
+
+
+class StagePool:
+    """Thread pool for the stages of a page that counts the tasks still waiting
+    for a worker, for admission control"""
+
+    def __init__(self, max_workers, name='stage'):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._lock = threading.Lock()
+        self._queued = 0
+
+    def submit(self, fn, *args):
+        """Run ``fn(*args)`` on the pool in a copy of the caller's context; returns its future"""
+        context = contextvars.copy_context()
+        queued = True
+
+        def dequeue():
+            nonlocal queued
+            with self._lock:
+                if queued:
+                    queued = False
+                    self._queued -= 1
+
+        def run():
+            dequeue()
+            return context.run(fn, *args)
+
+        with self._lock:
+            self._queued += 1
+        try:
+            future = self._executor.submit(run)
+        except Exception:
+            dequeue()
+            raise
+        # A task cancelled before it started never runs
+        future.add_done_callback(lambda _future: dequeue())
+        return future
+
+    def pending(self):
+        """Number of tasks waiting for a worker"""
+        with self._lock:
+            return self._queued
@@ -0,0 +1,75 @@
+"""Leveled, sampled structured logging.
+
+Each record is written as one JSON line with an ``event`` name and keyword
+fields, e.g. ``log.info('image generated', city=city)``. Records below
+WARNING are sampled at ``config.LOG_SAMPLE_RATE`` and the level check runs
+before any formatting, so routine per-request logging costs little on the
+hot path. Warnings and errors are always written.
+"""
+import json
+import logging
+import random
+import sys
+
+import config
+
+_handler = None
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'ts': round(record.created, 3),
+            'level': record.levelname.lower(),
+            'logger': record.name,
+            'event': record.getMessage(),
+        }
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['traceback'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class Logger:
+    def __init__(self, name):
+        self._logger = logging.getLogger(f"sentient_weather.{name}")
+
+    def _log(self, level, event, fields, exc_info=False):
+        if not self._logger.isEnabledFor(level):
+            return
+        if level < logging.WARNING and random.random() >= config.LOG_SAMPLE_RATE:
+            return
+        self._logger.log(level, event, exc_info=exc_info, extra={'fields': fields})
+
+    def debug(self, event, **fields):
+        self._log(logging.DEBUG, event, fields)
+
+    def info(self, event, **fields):
+        self._log(logging.INFO, event, fields)
+
+    def warning(self, event, **fields):
+        self._log(logging.WARNING, event, fields)
+
+    def error(self, event, **fields):
+        self._log(logging.ERROR, event, fields)
+
+    def exception(self, event, **fields):
+        """Log an error with the current exception's traceback"""
+        self._log(logging.ERROR, event, fields, exc_info=True)
+
+
+def configure():
+    """Send the app's records to stderr as JSON lines at ``config.LOG_LEVEL``"""
+    global _handler
+    root = logging.getLogger('sentient_weather')
+    root.setLevel(getattr(logging, config.LOG_LEVEL, logging.INFO))
+    if _handler is None:
+        _handler = logging.StreamHandler(sys.stderr)
+        _handler.setFormatter(JsonFormatter())
+        root.addHandler(_handler)
+        root.propagate = False
+
+
+def get_logger(name):
+    configure()
+    return Logger(name)
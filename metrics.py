@@ -0,0 +1,198 @@
+"""Lightweight in-process metrics: counters and histograms with labels.
+
+``render_text`` exposes every registered metric in the Prometheus text format
+for the ``/metrics`` endpoint. Metrics are per process; scrape each worker.
+"""
+import asyncio
+import bisect
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+
+class Counter:
+    def __init__(self, name, documentation):
+        self.name = name
+        self.documentation = documentation
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def inc(self, amount=1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return dict(self._values)
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = sorted(buckets)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def observe(self, value, **labels):
+        key = tuple(sorted(labels.items()))
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            counts, total, count = self._values.get(key) or ([0] * len(self.buckets), 0.0, 0)
+            if index < len(counts):
+                counts[index] += 1
+            self._values[key] = (counts, total + value, count + 1)
+
+    def samples(self):
+        """Per label set: (non-cumulative bucket counts, sum, count)"""
+        with self._lock:
+            return {key: (list(counts), total, count)
+                    for key, (counts, total, count) in self._values.items()}
+
+
+_registry = {}
+_registry_lock = threading.Lock()
+
+
+def _register(name, factory):
+    with _registry_lock:
+        metric = _registry.get(name)
+        if metric is None:
+            metric = _registry[name] = factory()
+        return metric
+
+
+def counter(name, documentation):
+    """Return the counter called ``name``, creating it on first use"""
+    return _register(name, lambda: Counter(name, documentation))
+
+
+def histogram(name, documentation, buckets):
+    """Return the histogram called ``name``, creating it on first use"""
+    return _register(name, lambda: Histogram(name, documentation, buckets))
+
+
+def all_metrics():
+    with _registry_lock:
+        return list(_registry.values())
+
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+               for _name, value in labels)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _value), value in zip(labels, escaped)) + '}'
+
+
+def _format_value(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render_text():
+    """All metrics in the Prometheus text exposition format"""
+    lines = []
+    for metric in all_metrics():
+        kind = 'histogram' if isinstance(metric, Histogram) else 'counter'
+        lines.append(f"# HELP {metric.name} {metric.documentation}")
+        lines.append(f"# TYPE {metric.name} {kind}")
+        for key, value in sorted(metric.samples().items()):
+            if kind == 'counter':
+                lines.append(f"{metric.name}{_format_labels(key)} {_format_value(value)}")
+                continue
+            counts, total, count = value
+            cumulative = 0
+            for bound, bucket_count in zip(metric.buckets, counts):
+                cumulative += bucket_count
+                le = key + (('le', _format_value(float(bound))),)
+                lines.append(f"{metric.name}_bucket{_format_labels(le)} {cumulative}")
+            lines.append(f"{metric.name}_bucket{_format_labels(key + (('le', '+Inf'),))} {count}")
+            lines.append(f"{metric.name}_sum{_format_labels(key)} {_format_value(total)}")
+            lines.append(f"{metric.name}_count{_format_labels(key)} {count}")
+    return '\n'.join(lines) + '\n'
+
+
+@contextmanager
+def time_stage(stage):
+    """Record the duration of the enclosed block under ``stage_seconds``"""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - started, stage=stage)
+
+
+def timed(stage):
+    """Decorator timing every call of a function or coroutine function"""
+    def decorator(fn):
+        if asyncio.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with time_stage(stage):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with time_stage(stage):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+stage_seconds = histogram(
+    'stage_duration_seconds',
+    'Time spent in each page stage',
+    [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 45, 60],
+)
+cache_requests = counter(
+    'cache_requests_total',
+    'Cache lookups by cache and result (hit, stale or miss)',
+)
+cache_refreshes = counter(
+    'cache_refreshes_total',
+    'Background refreshes of stale cache entries (scheduled, dropped, done or failed)',
+)
+prewarm_requests = counter(
+    'prewarm_requests_total',
+    'Page requests for hot-set cities by whether their design and image were cached (warm or cold)',
+)
+prewarm_runs = counter(
+    'prewarm_runs_total',
+    'Prewarm work by kind (weather, design or image) and result (done, failed or over_budget)',
+)
+admission_decisions = counter(
+    'admission_decisions_total',
+    'Upstream generations pages asked to start, by upstream and result (admitted or shed)',
+)
+degraded_responses = counter(
+    'degraded_responses_total',
+    'Pages served with a stage shed under load, by stage (image or theme)',
+)
+circuit_transitions = counter(
+    'circuit_transitions_total',
+    'Circuit breaker state changes by upstream and new state (open, half_open or closed)',
+)
+upstream_rejections = counter(
+    'upstream_rejections_total',
+    'Upstream calls refused without being made, by reason (circuit_open or rate_limited)',
+)
+upstream_errors = counter(
+    'upstream_errors_total',
+    'Failed calls to upstream services',
+)
+upstream_retries = counter(
+    'upstream_retries_total',
+    'Retried calls to upstream services',
+)
+image_download_throughput = histogram(
+    'image_download_bytes_per_second',
+    'Throughput of generated image downloads',
+    [2 ** n * 1024 for n in range(6, 16)],
+)
+image_download_bytes = counter(
+    'image_download_bytes_total',
+    'Bytes of generated images downloaded',
+)
@@ -1,228 +1,337 @@
-from geopy.geocoders import Nominatim
-import openmeteo_requests
-import requests_cache
-import pandas as pd
-from retry_requests import retry
-from anthropic import Anthropic
-from openai import OpenAI
 import json
 import os
 import time
-import requests
-from datetime import datetime, timedelta
+from datetime import datetime, timezone
 from flask import url_for
 from werkzeug.utils import secure_filename
 from typing import Dict, Optional, Set
 
+import config
+import metrics
+from admission import admission
+from clients import (
+    get_anthropic,
+    get_geolocator,
+    get_http_session,
+    get_openai,
+    get_openmeteo,
+)
+from gazetteer import get_gazetteer
+from geocode_cache import get_geocode_cache
+from image_derivatives import schedule_derivatives
+from image_store import get_image_store
+from logs import get_logger
+from refresh import refresher
+from resilience import upstreams
+from singleflight import flights
+
+log = get_logger('pipeline')
+
+
+def _geocode_nominatim(city):
+    """Look up a city with Nominatim; None if it does not exist."""
+    nominatim = upstreams['nominatim']
+    location = nominatim.call(lambda: get_geolocator().geocode(city, timeout=nominatim.timeout()))
+    if location is None:
+        return None
+    return (location.latitude, location.longitude)
 
+@metrics.timed('geocode')
 def get_city_coordinates(city):
     """Get coordinates for a given city."""
     try:
-        geolocator = Nominatim(user_agent="sentient-weather-app")
-        location = geolocator.geocode(city)
-        return (location.latitude, location.longitude)
-    except:
+        if config.GEOCODER_BACKEND == 'offline':
+            return get_gazetteer().geocode(city)
+        return get_geocode_cache().lookup(city, _geocode_nominatim)
+    except Exception as e:
+        metrics.upstream_errors.inc(upstream='nominatim')
+        log.error("geocoding failed", city=city, error=str(e))
         return None
 
-def get_weather_data(latitude, longitude):
-    """Get current weather and forecast data from Open Meteo API."""
+OPEN_METEO_URL = config.OPEN_METEO_URL
+
+def weather_params(latitude, longitude):
+    """Open-Meteo query parameters for current weather and the daily forecast."""
+    return {
+        "latitude": latitude,
+        "longitude": longitude,
+        "current": ["temperature_2m", "is_day", "precipitation", 
+                   "weather_code", "cloud_cover", "wind_speed_10m"],
+        "daily": ["weather_code", "temperature_2m_max", "temperature_2m_min",
+                 "precipitation_sum", "precipitation_hours",
+                 "precipitation_probability_max", "wind_speed_10m_max"]
+    }
+
+# Daily variables, in the order weather_params requests them
+FORECAST_FIELDS = ('weather_code', 'temperature_max', 'temperature_min', 'precipitation_sum',
+                   'precipitation_hours', 'precipitation_probability', 'wind_speed_max')
+
+class ForecastDay:
+    """One day of the daily forecast; attributes match the template's ``day.*`` fields."""
+    __slots__ = ('date',) + FORECAST_FIELDS
+
+    def __init__(self, date, weather_code, temperature_max, temperature_min, precipitation_sum,
+                 precipitation_hours, precipitation_probability, wind_speed_max):
+        self.date = date
+        self.weather_code = weather_code
+        self.temperature_max = temperature_max
+        self.temperature_min = temperature_min
+        self.precipitation_sum = precipitation_sum
+        self.precipitation_hours = precipitation_hours
+        self.precipitation_probability = precipitation_probability
+        self.wind_speed_max = wind_speed_max
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def __repr__(self):
+        return f"ForecastDay({self.to_dict()!r})"
+
+def decode_weather_response(response):
+    """Turn one Open-Meteo WeatherApiResponse into our current/forecast dict."""
+    # Process current weather
+    current = response.Current()
+    current_data = {
+        'temperature': current.Variables(0).Value(),
+        'is_day': current.Variables(1).Value(),
+        'precipitation': current.Variables(2).Value(),
+        'weather_code': current.Variables(3).Value(),
+        'cloud_cover': current.Variables(4).Value(),
+        'wind_speed': current.Variables(5).Value(),
+    }
+
+    # Process forecast
+    daily = response.Daily()
+    start, interval = daily.Time(), daily.Interval()
+    days = (daily.TimeEnd() - start) // interval
+    columns = [daily.Variables(i).ValuesAsNumpy().tolist() for i in range(len(FORECAST_FIELDS))]
+    forecast_data = [
+        ForecastDay(datetime.fromtimestamp(start + day * interval, tz=timezone.utc),
+                    *(column[day] for column in columns))
+        for day in range(days)
+    ]
+
+    return {
+        'current': current_data,
+        'forecast': forecast_data
+    }
+
+def decode_weather_messages(content):
+    """Split a size-prefixed Open-Meteo FlatBuffers payload into WeatherApiResponses."""
+    from openmeteo_sdk.WeatherApiResponse import WeatherApiResponse
+
+    messages = []
+    pos = 0
+    while pos < len(content):
+        length = int.from_bytes(content[pos:pos + 4], byteorder="little")
+        messages.append(WeatherApiResponse.GetRootAs(content, pos + 4))
+        pos += length + 4
+    return messages
+
+@metrics.timed('weather')
+def get_weather_data(latitude, longitude, refresh=False):
+    """Get current weather and forecast data from Open Meteo API.
+
+    With ``refresh`` the cached response is bypassed and replaced.
+    """
     try:
-        # Setup the Open-Meteo API client with cache and retry
-        cache_session = requests_cache.CachedSession('.cache', expire_after=3600)
-        retry_session = retry(cache_session, retries=5, backoff_factor=0.2)
-        openmeteo = openmeteo_requests.Client(session=retry_session)
-
-        # API parameters
-        url = "https://api.open-meteo.com/v1/forecast"
-        params = {
-            "latitude": latitude,
-            "longitude": longitude,
-            "current": ["temperature_2m", "is_day", "precipitation", 
-                       "weather_code", "cloud_cover", "wind_speed_10m"],
-            "daily": ["weather_code", "temperature_2m_max", "temperature_2m_min",
-                     "precipitation_sum", "precipitation_hours",
-                     "precipitation_probability_max", "wind_speed_10m_max"]
-        }
+        # Shared Open-Meteo client with cache and retry
+        openmeteo = get_openmeteo()
 
         # Make the API request
-        response = openmeteo.weather_api(url, params=params)[0]
-        
-        # Process current weather
-        current = response.Current()
-        current_data = {
-            'temperature': current.Variables(0).Value(),
-            'is_day': current.Variables(1).Value(),
-            'precipitation': current.Variables(2).Value(),
-            'weather_code': current.Variables(3).Value(),
-            'cloud_cover': current.Variables(4).Value(),
-            'wind_speed': current.Variables(5).Value(),
-        }
-
-        # Process forecast
-        daily = response.Daily()
-        forecast_data = pd.DataFrame({
-            "date": pd.date_range(
-                start=pd.to_datetime(daily.Time(), unit="s", utc=True),
-                end=pd.to_datetime(daily.TimeEnd(), unit="s", utc=True),
-                freq=pd.Timedelta(seconds=daily.Interval()),
-                inclusive="left"
-            ),
-            "weather_code": daily.Variables(0).ValuesAsNumpy(),
-            "temperature_max": daily.Variables(1).ValuesAsNumpy(),
-            "temperature_min": daily.Variables(2).ValuesAsNumpy(),
-            "precipitation_sum": daily.Variables(3).ValuesAsNumpy(),
-            "precipitation_hours": daily.Variables(4).ValuesAsNumpy(),
-            "precipitation_probability": daily.Variables(5).ValuesAsNumpy(),
-            "wind_speed_max": daily.Variables(6).ValuesAsNumpy()
-        }).to_dict('records')
-
-        return {
-            'current': current_data,
-            'forecast': forecast_data
-        }
+        kwargs = {'force_refresh': True} if refresh else {}
+        response = openmeteo.weather_api(OPEN_METEO_URL, params=weather_params(latitude, longitude),
+                                         **kwargs)[0]
+        return decode_weather_response(response)
 
     except Exception as e:
-        print(f"Error fetching weather data: {str(e)}")
+        metrics.upstream_errors.inc(upstream='openmeteo')
+        log.error("weather fetch failed", latitude=latitude, longitude=longitude, error=str(e))
         return None
 
+@metrics.timed('weather_batch')
+def get_weather_data_batch(coordinates):
+    """Get weather for many ``(latitude, longitude)`` pairs with multi-location requests.
+
+    Open-Meteo takes comma-separated coordinate lists and answers with one
+    response per location, in order. Locations are sent in chunks of
+    WEATHER_BATCH_SIZE; entries of a chunk that fails are None.
+    """
+    results = []
+    for start in range(0, len(coordinates), config.WEATHER_BATCH_SIZE):
+        chunk = coordinates[start:start + config.WEATHER_BATCH_SIZE]
+        params = weather_params(','.join(str(lat) for lat, _lon in chunk),
+                                ','.join(str(lon) for _lat, lon in chunk))
+        try:
+            responses = get_openmeteo().weather_api(OPEN_METEO_URL, params=params)
+            if len(responses) != len(chunk):
+                raise ValueError(f"Expected {len(chunk)} locations, got {len(responses)}")
+            results.extend(decode_weather_response(response) for response in responses)
+        except Exception as e:
+            metrics.upstream_errors.inc(upstream='openmeteo')
+            log.error("batch weather fetch failed", locations=len(chunk), error=str(e))
+            results.extend([None] * len(chunk))
+    return results
+
+# WMO weather code -> description
+WEATHER_CODES = {
+    0: 'Clear sky',
+    1: 'Mainly clear',
+    2: 'Partly cloudy',
+    3: 'Overcast',
+    45: 'Fog',
+    48: 'Depositing rime fog',
+    51: 'Drizzle: Light intensity',
+    53: 'Drizzle: Moderate intensity',
+    55: 'Drizzle: Dense intensity',
+    56: 'Freezing Drizzle: Light intensity',
+    57: 'Freezing Drizzle: Dense intensity',
+    61: 'Rain: Slight intensity',
+    63: 'Rain: Moderate intensity',
+    65: 'Rain: Heavy intensity',
+    66: 'Freezing Rain: Light intensity',
+    67: 'Freezing Rain: Heavy intensity',
+    71: 'Snow fall: Slight intensity',
+    73: 'Snow fall: Moderate intensity',
+    75: 'Snow fall: Heavy intensity',
+    77: 'Snow grains',
+    80: 'Rain showers: Slight',
+    81: 'Rain showers: Moderate',
+    82: 'Rain showers: Violent',
+    85: 'Snow showers slight',
+    86: 'Snow showers Heavy',
+    95: 'Thunderstorm: Slight or moderate',
+    96: 'Thunderstorm with slight hail',
+    99: 'Thunderstorm with heavy hail'
+}
+
 def get_weather_description(weather_code):
     """Convert weather code to description."""
-    weather_codes = {
-        0: 'Clear sky',
-        1: 'Mainly clear',
-        2: 'Partly cloudy',
-        3: 'Overcast',
-        45: 'Fog',
-        48: 'Depositing rime fog',
-        51: 'Drizzle: Light intensity',
-        53: 'Drizzle: Moderate intensity',
-        55: 'Drizzle: Dense intensity',
-        56: 'Freezing Drizzle: Light intensity',
-        57: 'Freezing Drizzle: Dense intensity',
-        61: 'Rain: Slight intensity',
-        63: 'Rain: Moderate intensity',
-        65: 'Rain: Heavy intensity',
-        66: 'Freezing Rain: Light intensity',
-        67: 'Freezing Rain: Heavy intensity',
-        71: 'Snow fall: Slight intensity',
-        73: 'Snow fall: Moderate intensity',
-        75: 'Snow fall: Heavy intensity',
-        77: 'Snow grains',
-        80: 'Rain showers: Slight',
-        81: 'Rain showers: Moderate',
-        82: 'Rain showers: Violent',
-        85: 'Snow showers slight',
-        86: 'Snow showers Heavy',
-        95: 'Thunderstorm: Slight or moderate',
-        96: 'Thunderstorm with slight hail',
-        99: 'Thunderstorm with heavy hail'
+    return WEATHER_CODES.get(int(weather_code), 'Unknown')
+
+REQUIRED_COLORS = [
+    'color_page_background', 'color_tiles_container', 'color_tiles',
+    'color_tile_heading', 'color_tile_temp_high', 'color_tile_temp_low',
+    'color_tile_weather_details'
+]
+
+REQUIRED_FONT_CATEGORIES = ['primary_heading', 'secondary_heading', 'body_text', 'accent_text']
+REQUIRED_FONT_PROPERTIES = ['family', 'weight', 'style', 'fallback']
+
+def rgb_to_hex(rgb_str):
+    """Convert RGB string to hex format."""
+    if rgb_str.startswith('#'):
+        return rgb_str
+    try:
+        # Extract numbers from rgb(r, g, b) format
+        rgb_vals = [int(x.strip()) for x in rgb_str.strip('rgb()').split(',')]
+        return '#{:02x}{:02x}{:02x}'.format(*rgb_vals)
+    except:
+        raise ValueError(f"Invalid color format: {rgb_str}")
+
+def validate_color_palette(colors):
+    """Check a generated palette has every required color, converting RGB to hex."""
+    if not isinstance(colors, dict):
+        raise ValueError(f"Invalid palette: {colors}")
+
+    for color in REQUIRED_COLORS:
+        if color not in colors:
+            raise ValueError(f"Missing required color: {color}")
+        if not isinstance(colors[color], str):
+            raise ValueError(f"Invalid color format for {color}: {colors[color]}")
+        # Convert to hex if in RGB format
+        colors[color] = rgb_to_hex(colors[color])
+
+    return colors
+
+def validate_font_recommendations(font_data):
+    """Check generated fonts have every required category and property."""
+    if not isinstance(font_data, dict):
+        raise ValueError(f"Invalid font recommendations: {font_data}")
+
+    for category in REQUIRED_FONT_CATEGORIES:
+        if category not in font_data:
+            raise ValueError(f"Missing required category: {category}")
+        for prop in REQUIRED_FONT_PROPERTIES:
+            if prop not in font_data[category]:
+                raise ValueError(f"Missing property {prop} in {category}")
+
+    return font_data
+
+def color_palette_request(city, weather_data, weather_description):
+    """Build the Anthropic messages.create arguments for a color palette."""
+    # Check if we have all required weather data
+    if not weather_data or 'current' not in weather_data:
+        raise ValueError("Weather data is missing or incomplete")
+
+    # Extract current weather data
+    current_weather = weather_data['current']
+    required_fields = ['temperature', 'precipitation', 'cloud_cover', 'wind_speed', 'is_day']
+    for field in required_fields:
+        if field not in current_weather:
+            raise ValueError(f"Missing required weather field: {field}")
+    
+    prompt = f"""
+    You are an expert UI designer specializing in color theory. Your goal is to generate a well balanced color palette for a weather app webpage.
+    The color palette is inspired by the unique atmosphere of a city and the current weather conditions.
+    The city and current weather conditions are:
+    - location: {city}
+    - weather description: {weather_description}
+    - current temperature: {current_weather['temperature']}°C
+    - current precipitation: {current_weather['precipitation']}mm
+    - current cloud cover: {current_weather['cloud_cover']}%
+    - current wind speed: {current_weather['wind_speed']}km/h
+
+    Based on the unique atmosphere that the city is known for and the current weather, here are the colors that need to be in the color palette:
+       * color_page_background 
+       * color_tiles_container  
+       * color_tiles 
+    Then generate the following colors of the contents shown in the weather tiles, ensuring excellent readability: 
+       * color_tile_heading
+       * color_tile_temp_high
+       * color_tile_temp_low
+       * color_tile_weather_details
+
+    IMPORTANT! Ensure excellent readability and proper contrast when the colors are combined on a webpage. 
+    Be creative and remember to have it inspired by the unique atmosphere of the city and the current weather conditions.
+    Return colors in hexadecimal format (e.g., #RRGGBB).
+    """
+
+    messages = [{
+        "role": "user",
+        "content": f"""{prompt}
+        Requirements:
+        - The output must be valid JSON
+        - Use ONLY the following keys: color_page_background, color_tiles_container, color_tiles, color_tile_heading, color_tile_temp_high, color_tile_temp_low, color_tile_weather_details
+        - Each key should get a hexadecimal color code (e.g., #RRGGBB)
+        - Do not include any explanation or other text
+        - Each value should be of type string (str)
+        """
+    }]
+
+    return {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": 1024,
+        "temperature": 0.7,
+        "messages": messages,
     }
-    return weather_codes.get(int(weather_code), 'Unknown')
 
+@admission.tracked('anthropic')
 def generate_color_palette(city, weather_data, weather_description):
     """Generate color palette using Anthropic API."""
     try:
-        client = Anthropic()
-
-        # First, let's validate our input data
-        print(f"Generating palette for: {city}")
-        print(f"Weather data received: {weather_data}")
-        print(f"Weather description: {weather_description}")
-
-        # Check if we have all required weather data
-        if not weather_data or 'current' not in weather_data:
-            raise ValueError("Weather data is missing or incomplete")
-
-        # Extract current weather data
-        current_weather = weather_data['current']
-        required_fields = ['temperature', 'precipitation', 'cloud_cover', 'wind_speed', 'is_day']
-        for field in required_fields:
-            if field not in current_weather:
-                raise ValueError(f"Missing required weather field: {field}")
-        
-        prompt = f"""
-        You are an expert UI designer specializing in color theory. Your goal is to generate a well balanced color palette for a weather app webpage.
-        The color palette is inspired by the unique atmosphere of a city and the current weather conditions.
-        The city and current weather conditions are:
-        - location: {city}
-        - weather description: {weather_description}
-        - current temperature: {current_weather['temperature']}°C
-        - current precipitation: {current_weather['precipitation']}mm
-        - current cloud cover: {current_weather['cloud_cover']}%
-        - current wind speed: {current_weather['wind_speed']}km/h
-
-        Based on the unique atmosphere that the city is known for and the current weather, here are the colors that need to be in the color palette:
-           * color_page_background 
-           * color_tiles_container  
-           * color_tiles 
-        Then generate the following colors of the contents shown in the weather tiles, ensuring excellent readability: 
-           * color_tile_heading
-           * color_tile_temp_high
-           * color_tile_temp_low
-           * color_tile_weather_details
-
-        IMPORTANT! Ensure excellent readability and proper contrast when the colors are combined on a webpage. 
-        Be creative and remember to have it inspired by the unique atmosphere of the city and the current weather conditions.
-        Return colors in hexadecimal format (e.g., #RRGGBB).
-        """
+        client = get_anthropic()
 
-        messages = [{
-            "role": "user",
-            "content": f"""{prompt}
-            Requirements:
-            - The output must be valid JSON
-            - Use ONLY the following keys: color_page_background, color_tiles_container, color_tiles, color_tile_heading, color_tile_temp_high, color_tile_temp_low, color_tile_weather_details
-            - Each key should get a hexadecimal color code (e.g., #RRGGBB)
-            - Do not include any explanation or other text
-            - Each value should be of type string (str)
-            """
-        }]
-
-        print("Sending request to Anthropic API...")
-        response = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1024,
-            temperature=0.7,
-            messages=messages
-        )
-
-        print(f"Received response: {response.content}")
+        log.debug("requesting palette", city=city, weather=weather_description)
+        upstream = upstreams['anthropic']
+        response = upstream.call(lambda: client.messages.create(
+            **color_palette_request(city, weather_data, weather_description), timeout=upstream.timeout()))
         colors = json.loads(response.content[0].text)
-        
-        # Validate the response format
-        required_colors = [
-            'color_page_background', 'color_tiles_container', 'color_tiles',
-            'color_tile_heading', 'color_tile_temp_high', 'color_tile_temp_low',
-            'color_tile_weather_details'
-        ]
-
-        def rgb_to_hex(rgb_str):
-            """Convert RGB string to hex format."""
-            if rgb_str.startswith('#'):
-                return rgb_str
-            try:
-                # Extract numbers from rgb(r, g, b) format
-                rgb_vals = [int(x.strip()) for x in rgb_str.strip('rgb()').split(',')]
-                return '#{:02x}{:02x}{:02x}'.format(*rgb_vals)
-            except:
-                raise ValueError(f"Invalid color format: {rgb_str}")
-
-        # Convert any RGB colors to hex and validate
-        for color in required_colors:
-            if color not in colors:
-                raise ValueError(f"Missing required color: {color}")
-            if not isinstance(colors[color], str):
-                raise ValueError(f"Invalid color format for {color}: {colors[color]}")
-            # Convert to hex if in RGB format
-            colors[color] = rgb_to_hex(colors[color])
-
-        return colors
+        return validate_color_palette(colors)
 
     except Exception as e:
-        print(f"Error generating color palette: {str(e)}")
-        print(f"Error type: {type(e)}")
-        import traceback
-        print(f"Full traceback: {traceback.format_exc()}")
+        metrics.upstream_errors.inc(upstream='anthropic')
+        log.error("palette generation failed", city=city, error=str(e))
         return None
 
 def get_default_fonts():
@@ -320,11 +429,10 @@ def process_fonts(generated_fonts):
         # Generate Google Fonts URL
         processed_fonts['google_fonts_url'] = generate_google_fonts_url(processed_fonts)
         
-        print("Successfully processed fonts:", json.dumps(processed_fonts, indent=2))
         return processed_fonts
         
     except Exception as e:
-        print(f"Error processing fonts: {str(e)}")
+        log.error("font processing failed", error=str(e))
         return get_default_fonts()
 
 
@@ -347,186 +455,315 @@ def get_css_variables(fonts):
                 css_vars[f"{var_name}-weight"] = font['weight']
                 css_vars[f"{var_name}-style"] = font['style']
                 
-        print("Generated CSS variables:", css_vars)
         return css_vars
         
     except Exception as e:
-        print(f"Error generating CSS variables: {str(e)}")
+        log.error("CSS variable generation failed", error=str(e))
         return get_css_variables(get_default_fonts())
 
+def font_recommendations_request(city, weather_data):
+    """Build the Anthropic messages.create arguments for font recommendations."""
+    # Extract relevant weather data
+    current_weather = weather_data['current']
+    weather_description = get_weather_description(current_weather['weather_code'])
+    
+    prompt = f"""
+    You are an expert typography designer specializing in creating unique digital experiences. 
+    Generate font recommendations for {city} that reflect its unique character and current weather conditions:
+    - Weather: {weather_description}
+    - Temperature: {current_weather['temperature']}°C
+    - Cloud Cover: {current_weather['cloud_cover']}%
+    
+    Consider these aspects of the city:
+    1. Historical significance and age
+    2. Cultural characteristics
+    3. Primary industries/identity (tech hub, cultural center, financial district, etc.)
+    4. Geographic location and regional influences
+    
+    For each font category, recommend a specific Google Font that best matches the city's character:
+
+    The response must include these exact categories:
+    1. primary_heading: For the main city name and temperature (should be distinctive)
+    2. secondary_heading: For weather condition descriptions and daily forecasts
+    3. body_text: For detailed weather information
+    4. accent_text: For small labels and secondary information
+    """
+
+    messages = [{
+        "role": "user",
+        "content": f"""{prompt}
+        Requirements for response format:
+        - Must be valid JSON
+        - Use ONLY these keys: primary_heading, secondary_heading, body_text, accent_text
+        - Each value should be an object with these exact keys:
+          * family: string (font family name)
+          * weight: string (font weight, e.g. "400", "700")
+          * style: string (e.g. "normal", "italic")
+          * fallback: string (fallback font category)
+        - Do not include any explanation or other text
+        """
+    }]
+
+    return {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": 1024,
+        "temperature": 0.7,
+        "messages": messages,
+    }
+
+@admission.tracked('anthropic')
 def generate_font_recommendations(city: str, weather_data: Dict) -> Optional[Dict]:
     """
     Generate font recommendations for a city based on its unique characteristics and current weather.
     Returns a dictionary with font families and their weights/styles.
     """
     try:
-        client = Anthropic()
+        client = get_anthropic()
         
-        # Extract relevant weather data
-        current_weather = weather_data['current']
-        weather_description = get_weather_description(current_weather['weather_code'])
-        
-        prompt = f"""
-        You are an expert typography designer specializing in creating unique digital experiences. 
-        Generate font recommendations for {city} that reflect its unique character and current weather conditions:
-        - Weather: {weather_description}
-        - Temperature: {current_weather['temperature']}°C
-        - Cloud Cover: {current_weather['cloud_cover']}%
-        
-        Consider these aspects of the city:
-        1. Historical significance and age
-        2. Cultural characteristics
-        3. Primary industries/identity (tech hub, cultural center, financial district, etc.)
-        4. Geographic location and regional influences
-        
-        For each font category, recommend a specific Google Font that best matches the city's character:
-
-        The response must include these exact categories:
-        1. primary_heading: For the main city name and temperature (should be distinctive)
-        2. secondary_heading: For weather condition descriptions and daily forecasts
-        3. body_text: For detailed weather information
-        4. accent_text: For small labels and secondary information
-        """
-
-        messages = [{
-            "role": "user",
-            "content": f"""{prompt}
-            Requirements for response format:
-            - Must be valid JSON
-            - Use ONLY these keys: primary_heading, secondary_heading, body_text, accent_text
-            - Each value should be an object with these exact keys:
-              * family: string (font family name)
-              * weight: string (font weight, e.g. "400", "700")
-              * style: string (e.g. "normal", "italic")
-              * fallback: string (fallback font category)
-            - Do not include any explanation or other text
-            """
-        }]
-
-        response = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1024,
-            temperature=0.7,
-            messages=messages
-        )
+        upstream = upstreams['anthropic']
+        response = upstream.call(lambda: client.messages.create(
+            **font_recommendations_request(city, weather_data), timeout=upstream.timeout()))
 
         # Parse and validate the response
         font_data = json.loads(response.content[0].text)
-        print("Font API Response:", font_data)
-        
-        # Validate required keys
-        required_categories = ['primary_heading', 'secondary_heading', 'body_text', 'accent_text']
-        required_properties = ['family', 'weight', 'style', 'fallback']
+        log.debug("font recommendations received", city=city)
         
-        for category in required_categories:
-            if category not in font_data:
-                raise ValueError(f"Missing required category: {category}")
-            for prop in required_properties:
-                if prop not in font_data[category]:
-                    raise ValueError(f"Missing property {prop} in {category}")
-
-        # Removed the following lines:
-        # font_families = {data['family'] for data in font_data.values()}
-        # font_data['google_fonts_url'] = generate_google_fonts_url(font_families)
-        
-        return font_data
+        return validate_font_recommendations(font_data)
 
     except Exception as e:
-        print(f"Error generating font recommendations: {str(e)}")
+        metrics.upstream_errors.inc(upstream='anthropic')
+        log.error("font recommendation failed", city=city, error=str(e))
         return None
 
 
+def theme_request(city, weather_data, weather_description):
+    """Build the Anthropic messages.create arguments for a combined theme."""
+    if not weather_data or 'current' not in weather_data:
+        raise ValueError("Weather data is missing or incomplete")
+    current_weather = weather_data['current']
+
+    prompt = f"""
+    You are an expert UI designer specializing in color theory and typography. Your goal is to design
+    the theme of a weather app webpage, inspired by the unique atmosphere and character of a city and
+    its current weather conditions:
+    - location: {city}
+    - weather description: {weather_description}
+    - current temperature: {current_weather['temperature']}°C
+    - current precipitation: {current_weather['precipitation']}mm
+    - current cloud cover: {current_weather['cloud_cover']}%
+    - current wind speed: {current_weather['wind_speed']}km/h
+
+    Colors: generate a well balanced palette with these colors:
+       * color_page_background
+       * color_tiles_container
+       * color_tiles
+    and these colors for the contents of the weather tiles, ensuring excellent readability:
+       * color_tile_heading
+       * color_tile_temp_high
+       * color_tile_temp_low
+       * color_tile_weather_details
+    IMPORTANT! Ensure proper contrast when the colors are combined on a webpage.
+
+    Fonts: recommend a specific Google Font for each category, reflecting the city's history, culture,
+    identity and regional influences:
+    1. primary_heading: For the main city name and temperature (should be distinctive)
+    2. secondary_heading: For weather condition descriptions and daily forecasts
+    3. body_text: For detailed weather information
+    4. accent_text: For small labels and secondary information
+    """
+
+    messages = [{
+        "role": "user",
+        "content": f"""{prompt}
+        Requirements for response format:
+        - Must be valid JSON with exactly two top-level keys: colors, fonts
+        - colors: an object using ONLY these keys: {', '.join(REQUIRED_COLORS)}
+          Each value is a hexadecimal color string (e.g., #RRGGBB)
+        - fonts: an object using ONLY these keys: {', '.join(REQUIRED_FONT_CATEGORIES)}
+          Each value is an object with these exact keys:
+          * family: string (font family name)
+          * weight: string (font weight, e.g. "400", "700")
+          * style: string (e.g. "normal", "italic")
+          * fallback: string (fallback font category)
+        - Do not include any explanation or other text
+        """
+    }]
+
+    return {
+        "model": "claude-3-5-sonnet-20241022",
+        "max_tokens": 1536,
+        "temperature": 0.7,
+        "messages": messages,
+    }
+
+def parse_theme(data):
+    """Validate each section of a combined theme response, None for invalid sections."""
+    theme = {'colors': None, 'fonts': None}
+    try:
+        theme['colors'] = validate_color_palette(data.get('colors'))
+    except Exception as e:
+        log.warning("invalid colors in theme", error=str(e))
+    try:
+        theme['fonts'] = validate_font_recommendations(data.get('fonts'))
+    except Exception as e:
+        log.warning("invalid fonts in theme", error=str(e))
+    return theme
+
+@admission.tracked('anthropic')
+def generate_theme(city, weather_data, weather_description):
+    """
+    Generate a color palette and font recommendations in a single Anthropic call.
+    Returns a dict with 'colors' and 'fonts'; a section that is missing or fails
+    validation is None so callers can fall back per section.
+    """
+    try:
+        client = get_anthropic()
+
+        upstream = upstreams['anthropic']
+        response = upstream.call(lambda: client.messages.create(
+            **theme_request(city, weather_data, weather_description), timeout=upstream.timeout()))
+
+        data = json.loads(response.content[0].text)
+        log.debug("theme received", city=city)
+    except Exception as e:
+        metrics.upstream_errors.inc(upstream='anthropic')
+        log.error("theme generation failed", city=city, error=str(e))
+        return {'colors': None, 'fonts': None}
+
+    return parse_theme(data)
+
+
+def _open_image(image_url):
+    """Start an image download; 429s and 5xx raise so they can be retried."""
+    upstream = upstreams['image_download']
+    timeout = (upstream.timeout(config.DOWNLOAD_CONNECT_TIMEOUT), upstream.timeout())
+    response = get_http_session().get(image_url, stream=True, timeout=timeout)
+    if response.status_code == 429 or response.status_code >= 500:
+        response.close()
+        response.raise_for_status()
+    return response
+
+@metrics.timed('image_download')
+def download_image(image_url, cache_key, filename, city=None, weather=None):
+    """Stream an image into the image store without buffering it in memory."""
+    started = time.monotonic()
+    with upstreams['image_download'].call(_open_image, image_url) as img_response:
+        if img_response.status_code != 200:
+            metrics.upstream_errors.inc(upstream='image_download')
+            log.error("image download failed", status=img_response.status_code)
+            return None
+
+        declared_size = int(img_response.headers.get('Content-Length') or 0)
+        if declared_size > config.DOWNLOAD_MAX_BYTES:
+            raise ValueError(f"Image too large: {declared_size} bytes")
+
+        downloaded = 0
+
+        def chunks():
+            nonlocal downloaded
+            for chunk in img_response.iter_content(chunk_size=config.DOWNLOAD_CHUNK_SIZE):
+                downloaded += len(chunk)
+                yield chunk
+
+        relative_path = get_image_store().write_stream(
+            cache_key, chunks(), filename,
+            max_bytes=config.DOWNLOAD_MAX_BYTES, city=city, weather=weather)
+
+    elapsed = max(time.monotonic() - started, 1e-6)
+    metrics.image_download_bytes.inc(downloaded)
+    metrics.image_download_throughput.observe(downloaded / elapsed)
+    return relative_path
+
+def city_image_request(city, weather_description):
+    """Build the OpenAI images.generate arguments for a city image."""
+    prompt = f"An oil painting of the most iconic scenery from {city} where the weather is {weather_description}."
+    return {
+        "model": "dall-e-3",
+        "prompt": prompt,
+        "size": "1792x1024",
+        "quality": "standard",
+        "n": 1,
+    }
+
+def image_cache_key(city, weather_description):
+    """Cache key of the image for a city and weather description."""
+    safe_city_name = secure_filename(city.lower())
+    safe_weather = secure_filename(weather_description.lower())
+    return f"{safe_city_name}_{safe_weather}"
+
+def cached_city_image(city, weather_description):
+    """Path of the cached image for a city and weather, or None.
+
+    A stale image is returned too, and one background refresh is scheduled
+    to replace it.
+    """
+    cache_key = image_cache_key(city, weather_description)
+    image_path, stale = get_image_store().lookup(cache_key)
+    if stale:
+        refresher.schedule('image', f"image:{cache_key}", _generate_city_image_once,
+                           city, weather_description, cache_key)
+    return image_path
+
+def _generate_city_image_once(city, weather_description, cache_key):
+    """Generate the image for ``cache_key`` unless another caller, in this
+    process or another worker, has just done so"""
+    store = get_image_store()
+    return flights.do(
+        f"image:{cache_key}",
+        lambda: _generate_city_image(city, weather_description, cache_key),
+        recheck=lambda: store.get(cache_key),
+        shared=True,
+    )
+
+def warm_city_image(city, weather_description):
+    """Generate the image for a city unless a fresh one is cached; stale images are replaced"""
+    return _generate_city_image_once(city, weather_description,
+                                     image_cache_key(city, weather_description))
+
 def generate_city_image(city, weather_description):
     """Generate or retrieve a cached city image based on city and weather description."""
     try:
-        # Define directories for static images and cache
-        project_root = os.path.abspath(os.path.dirname(__file__))
-        static_dir = os.path.join(project_root, 'static', 'images')
-        os.makedirs(static_dir, exist_ok=True)
-
-        # Create a cache key based on the city and weather description
-        safe_city_name = secure_filename(city.lower())
-        safe_weather = secure_filename(weather_description.lower())
-        cache_key = f"{safe_city_name}_{safe_weather}"
-        
-        # Path for the cached JSON data
-        cache_file = os.path.join(static_dir, f"{cache_key}.json")
-
         # Check if a valid cached image exists
-        if os.path.exists(cache_file):
-            with open(cache_file, 'r') as f:
-                cache_data = json.load(f)
-                
-            cache_timestamp = datetime.fromtimestamp(cache_data['timestamp'])
-            if datetime.now() - cache_timestamp < timedelta(hours=24):
-                image_path = cache_data['image_path']
-                static_image_path = os.path.join(project_root, 'static', image_path.lstrip('/static/'))
-                if os.path.exists(static_image_path):
-                    print(f"Using cached image for {city} with {weather_description}")
-                    return image_path
+        image_path = cached_city_image(city, weather_description)
+        if image_path:
+            log.debug("using cached image", city=city, weather=weather_description)
+            return image_path
+
+        # Only one caller per cache key generates; concurrent callers share its result
+        cache_key = image_cache_key(city, weather_description)
+        return _generate_city_image_once(city, weather_description, cache_key)
 
-        # Initialize the OpenAI client for image generation
-        client = OpenAI()
+    except Exception as e:
+        log.error("city image failed", city=city, error=str(e))
+        return None
+
+@metrics.timed('image')
+@admission.tracked('openai')
+def _generate_city_image(city, weather_description, cache_key):
+    """Generate a new city image with DALL-E and add it to the image store."""
+    try:
+        # Shared OpenAI client for image generation
+        client = get_openai()
 
         # Generate a unique filename for the image
         timestamp = int(time.time())
         filename = f"{cache_key}_{timestamp}.png"
-        image_path = os.path.join(static_dir, filename)
-
-        # Clean up older images (keeping only the 20 most recent images)
-        existing_images = sorted(
-            ((os.path.join(static_dir, f), os.path.getctime(os.path.join(static_dir, f)))
-             for f in os.listdir(static_dir) if f.endswith('.png')),
-            key=lambda x: x[1],
-            reverse=True
-        )
-        if len(existing_images) > 20:
-            for old_image, _ in existing_images[20:]:
-                try:
-                    os.remove(old_image)
-                    # Remove corresponding cache file if it exists
-                    old_cache = os.path.join(static_dir, f"{os.path.splitext(os.path.basename(old_image))[0]}.json")
-                    if os.path.exists(old_cache):
-                        os.remove(old_cache)
-                except Exception as e:
-                    print(f"Error removing old file {old_image}: {str(e)}")
 
         # Generate the image using OpenAI's DALL-E API
-        prompt = f"An oil painting of the most iconic scenery from {city} where the weather is {weather_description}."
-        response = client.images.generate(
-            model="dall-e-3",
-            prompt=prompt,
-            size="1792x1024",
-            quality="standard",
-            n=1,
-        )
+        upstream = upstreams['openai']
+        response = upstream.call(lambda: client.images.generate(
+            **city_image_request(city, weather_description), timeout=upstream.timeout()))
 
         # Check the response and download the image
         image_url = response.data[0].url
-        img_response = requests.get(image_url)
-        if img_response.status_code == 200:
-            with open(image_path, 'wb') as f:
-                f.write(img_response.content)
-
-            # Create relative path for serving the image
-            relative_path = f'/static/images/{filename}'
-            
-            # Save cache data
-            cache_data = {
-                'timestamp': timestamp,
-                'image_path': relative_path,
-                'city': city,
-                'weather': weather_description
-            }
-            with open(cache_file, 'w') as f:
-                json.dump(cache_data, f)
-
-            print(f"Generated new image for {city} with {weather_description}")
-            return relative_path
-        else:
-            print(f"Failed to download image: Status code {img_response.status_code}")
-            return None
+        relative_path = download_image(image_url, cache_key, filename,
+                                       city=city, weather=weather_description)
+        if relative_path:
+            log.info("generated image", city=city, weather=weather_description)
+            schedule_derivatives(relative_path)
+        return relative_path
 
     except Exception as e:
-        print(f"Error generating city image: {str(e)}")
-        return None
\ No newline at end of file
+        metrics.upstream_errors.inc(upstream='openai')
+        log.error("image generation failed", city=city, error=str(e))
+        return None
@@ -0,0 +1,93 @@
+"""Cache for rendered HTML pages, each with a strong ETag.
+
+City pages are keyed on the city name as displayed plus the quantized weather
+signature the design cache uses, so a city is rendered once per weather
+bucket rather than once per request; the landing page has a single entry.
+The ETag is a hash of the body, so identical renders share an ETag across
+worker processes and conditional GETs can be answered with 304. Pages live in
+a cache backend (per-process memory by default, see cache_backends).
+"""
+import hashlib
+import json
+import threading
+
+import config
+import metrics
+from cache_backends import LazyBackend
+from design_cache import design_cache, weather_signature
+from image_derivatives import derivatives_enabled
+
+LANDING_KEY = ('landing',)
+
+
+def make_etag(body):
+    """Strong ETag (unquoted) for a page body"""
+    return hashlib.sha256(body.encode('utf-8')).hexdigest()[:32]
+
+
+class CachedPage:
+    __slots__ = ('body', 'etag')
+
+    def __init__(self, body, etag=None):
+        self.body = body
+        self.etag = etag or make_etag(body)
+
+
+class PageCache:
+    """TTL + LRU cache of rendered pages over a cache backend"""
+
+    def __init__(self, store, ttl=900):
+        self.store = store
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def city_key(city, weather_data):
+        return ('city', city.strip(), weather_signature(weather_data))
+
+    def get(self, key):
+        """Return the cached CachedPage for ``key`` or None, counting the hit or miss"""
+        stored = self.store.get(json.dumps(key))
+        with self._lock:
+            if stored is None:
+                self._misses += 1
+            else:
+                self._hits += 1
+        metrics.cache_requests.inc(cache='page', result='miss' if stored is None else 'hit')
+        if stored is None:
+            return None
+        etag, body = json.loads(stored)
+        return CachedPage(body, etag)
+
+    def set(self, key, body):
+        """Store a rendered body and return it as a CachedPage"""
+        page = CachedPage(body)
+        self.store.set(json.dumps(key), json.dumps([page.etag, page.body]).encode('utf-8'), self.ttl)
+        return page
+
+    def clear(self):
+        self.store.clear()
+
+    def stats(self):
+        with self._lock:
+            return {'entries': len(self.store), 'hits': self._hits, 'misses': self._misses}
+
+
+def is_cacheable(city, weather_data, design):
+    """Only pages built entirely from generated designs are worth caching.
+
+    A page with a stage fallback or shed stage, a default palette or font set, a missing
+    image, an image job still running or an image whose WebP/AVIF derivatives
+    are not ready would otherwise be served long after the real design is ready.
+    """
+    return (not design['fallbacks'] and not design['degraded'] and not design['image_job']
+            and design['image_path']
+            and (design['image_variants'] or not derivatives_enabled())
+            and design_cache.peek('palette', city, weather_data) is not None
+            and design_cache.peek('fonts', city, weather_data) is not None)
+
+
+page_cache = PageCache(LazyBackend('page', 'memory', config.PAGE_CACHE_SIZE),
+                       ttl=config.PAGE_CACHE_TTL)
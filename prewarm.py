@@ -0,0 +1,203 @@
+"""Background pre-warming of the caches for popular cities.
+
+Every page request records its city in a ``PopularityTracker``: one counter
+per normalized city that halves every PREWARM_HALF_LIFE seconds, so the hot
+set follows current traffic. Every PREWARM_INTERVAL seconds the prewarmer
+refetches the weather for the hot set and, when a city's weather has moved to
+a new signature or description (or its entries expired), generates the
+theme and image for it before a visitor asks.
+
+Generations draw from a token bucket of PREWARM_MAX_GENERATIONS_PER_HOUR and
+run PREWARM_CONCURRENCY at a time. Only one worker per host runs the cycle
+(it holds a file lock in LOCK_DIR); it ranks cities by the traffic it sees
+itself. Designs warmed in one worker reach the others only through a shared
+cache backend (SW_CACHE_BACKEND=sqlite or redis); images and weather are
+always shared on the host.
+
+``prewarm_requests_total`` counts page requests for cities in the last
+cycle's hot set by whether their design and image were already cached
+(``warm``) or not (``cold``); its warm share is the warm-hit rate.
+"""
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; every worker prewarms
+    fcntl = None
+
+import config
+import metrics
+from design_cache import design_cache
+from geocode_cache import normalize_city
+from image_store import get_image_store
+from logs import get_logger
+from resilience import TokenBucket
+
+log = get_logger('prewarm')
+
+
+class PopularityTracker:
+    """Exponentially decaying request counters per normalized city"""
+
+    def __init__(self, half_life=3600, max_entries=5000):
+        self.half_life = half_life
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        # normalized city -> [score, updated_at, display name]
+        self._entries = {}
+
+    def _decayed(self, entry, now):
+        return entry[0] * 0.5 ** ((now - entry[1]) / self.half_life)
+
+    def record(self, city):
+        key = normalize_city(city)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._entries[key] = [1.0, now, city]
+                if len(self._entries) > self.max_entries:
+                    self._prune(now)
+            else:
+                entry[:] = [self._decayed(entry, now) + 1.0, now, city]
+
+    def _prune(self, now):
+        """Keep the higher-scoring half of the tracked cities"""
+        ranked = sorted(self._entries.items(), key=lambda item: self._decayed(item[1], now))
+        for key, _entry in ranked[:len(ranked) // 2]:
+            del self._entries[key]
+
+    def hot(self, count, min_score=0.0):
+        """The ``count`` top cities as ``(display name, score)``, best first"""
+        now = time.time()
+        with self._lock:
+            scored = [(self._decayed(entry, now), entry[2]) for entry in self._entries.values()]
+        scored = [(score, city) for score, city in scored if score >= min_score]
+        scored.sort(reverse=True)
+        return [(city, score) for score, city in scored[:count]]
+
+
+def image_key(city, weather_description):
+    from notebook_functions import image_cache_key
+    return image_cache_key(city, weather_description)
+
+
+def is_warm(city, weather_data, weather_description):
+    """Whether the design and image for this city and weather are cached and fresh"""
+    return (design_cache.peek('palette', city, weather_data) is not None
+            and design_cache.peek('fonts', city, weather_data) is not None
+            and get_image_store().peek(image_key(city, weather_description)) is not None)
+
+
+class Prewarmer:
+    """Periodically warms the hot set; ``warm_design`` and ``warm_image`` generate
+    the theme and image for ``(city, weather_data, weather_description)``, and
+    ``palette_source(city, weather_description)`` says whether the palette
+    comes from the 'llm' or is extracted from the 'image'"""
+
+    def __init__(self, warm_design, warm_image, tracker=None, palette_source=None):
+        self.warm_design = warm_design
+        self.warm_image = warm_image
+        self.palette_source = palette_source or (lambda city, weather_description: 'llm')
+        self.tracker = tracker or PopularityTracker(half_life=config.PREWARM_HALF_LIFE,
+                                                    max_entries=config.PREWARM_TRACK_MAX)
+        self.budget = TokenBucket(config.PREWARM_MAX_GENERATIONS_PER_HOUR / 3600.0,
+                                  config.PREWARM_MAX_GENERATIONS_PER_HOUR)
+        self._executor = ThreadPoolExecutor(max_workers=config.PREWARM_CONCURRENCY,
+                                            thread_name_prefix='prewarm')
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock_file = None
+        # Normalized cities warmed in the last cycle
+        self._warmed = frozenset()
+
+    def note_request(self, city, weather_data, weather_description):
+        """Record a page request and, for a city in the last cycle's hot set,
+        count whether prewarming had it covered"""
+        self.tracker.record(city)
+        if normalize_city(city) in self._warmed:
+            warm = is_warm(city, weather_data, weather_description)
+            metrics.prewarm_requests.inc(result='warm' if warm else 'cold')
+
+    def warm_city(self, city):
+        """Refetch a city's weather and generate whatever its cache is missing"""
+        from notebook_functions import get_city_coordinates, get_weather_data, get_weather_description
+
+        coordinates = get_city_coordinates(city)
+        if not coordinates:
+            return
+        weather_data = get_weather_data(*coordinates, refresh=True)
+        metrics.prewarm_runs.inc(kind='weather', result='done' if weather_data else 'failed')
+        if not weather_data:
+            return
+        weather_description = get_weather_description(weather_data['current']['weather_code'])
+
+        # The image first: an image palette is extracted from it
+        if get_image_store().peek(image_key(city, weather_description)) is None:
+            if self.budget.take():
+                result = 'done' if self.warm_image(city, weather_description) else 'failed'
+                metrics.prewarm_runs.inc(kind='image', result=result)
+            else:
+                metrics.prewarm_runs.inc(kind='image', result='over_budget')
+
+        missing = [kind for kind in ('palette', 'fonts')
+                   if design_cache.peek(kind, city, weather_data) is None]
+        if missing:
+            if self.palette_source(city, weather_description) == 'image':
+                # Extracting the palette needs no LLM call; the fonts take one
+                generations = int('fonts' in missing)
+            else:
+                # One combined call, or one call per missing section
+                generations = 1 if config.THEME_MODE == 'combined' else len(missing)
+            if not generations or self.budget.take(generations):
+                self.warm_design(city, weather_data, weather_description)
+                metrics.prewarm_runs.inc(kind='design', result='done')
+            else:
+                metrics.prewarm_runs.inc(kind='design', result='over_budget')
+
+    def run_once(self):
+        """Warm every city in the hot set; returns how many were visited"""
+        hot = self.tracker.hot(config.PREWARM_TOP_N, config.PREWARM_MIN_SCORE)
+        self._warmed = frozenset(normalize_city(city) for city, _score in hot)
+        futures = [self._executor.submit(self.warm_city, city) for city, _score in hot]
+        for (city, _score), future in zip(hot, futures):
+            try:
+                future.result()
+            except Exception as e:
+                log.error("prewarming city failed", city=city, error=str(e))
+        log.info("prewarm cycle finished", cities=len(hot))
+        return len(hot)
+
+    def _is_leader(self):
+        """Take the host-wide prewarm lock without blocking; True while we hold it"""
+        if fcntl is None or self._lock_file is not None:
+            return True
+        os.makedirs(config.LOCK_DIR, exist_ok=True)
+        lock_file = open(os.path.join(config.LOCK_DIR, 'prewarm.lock'), 'a')
+        try:
+            fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def _loop(self):
+        while not self._stop.wait(config.PREWARM_INTERVAL):
+            try:
+                if self._is_leader():
+                    self.run_once()
+            except Exception as e:
+                log.error("prewarm cycle failed", error=str(e))
+
+    def start(self):
+        """Start the background cycle in this process (idempotent)"""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._loop, name='prewarm', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,59 @@
+"""Background refreshes for stale-while-revalidate caches.
+
+A cache that finds an entry past its TTL but still inside its grace window
+serves it and hands a refresh to ``refresher.schedule``. Only the first
+caller per key queues the refresh; later callers find it in flight and just
+serve the stale entry. Refreshes run on a small bounded pool and are dropped,
+to be retried by the next stale hit, when the backlog is full, so a wave of
+expiries cannot pile up upstream calls.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import config
+import metrics
+from logs import get_logger
+
+log = get_logger('refresh')
+
+
+class Refresher:
+    def __init__(self, max_workers=4, max_pending=64):
+        self.max_pending = max_pending
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='refresh')
+        self._lock = threading.Lock()
+        self._in_flight = set()
+
+    def schedule(self, cache, key, fn, *args, **kwargs):
+        """Queue ``fn(*args, **kwargs)`` to refresh ``key`` unless it is already queued.
+
+        Returns True if this call queued the refresh.
+        """
+        with self._lock:
+            if key in self._in_flight:
+                return False
+            if len(self._in_flight) >= self.max_pending:
+                metrics.cache_refreshes.inc(cache=cache, result='dropped')
+                return False
+            self._in_flight.add(key)
+        metrics.cache_refreshes.inc(cache=cache, result='scheduled')
+        self._executor.submit(self._run, cache, key, fn, args, kwargs)
+        return True
+
+    def _run(self, cache, key, fn, args, kwargs):
+        try:
+            fn(*args, **kwargs)
+            metrics.cache_refreshes.inc(cache=cache, result='done')
+        except Exception as e:
+            metrics.cache_refreshes.inc(cache=cache, result='failed')
+            log.error("cache refresh failed", cache=cache, key=key, error=str(e))
+        finally:
+            with self._lock:
+                self._in_flight.discard(key)
+
+    def pending(self):
+        with self._lock:
+            return len(self._in_flight)
+
+
+refresher = Refresher(max_workers=config.REFRESH_WORKERS, max_pending=config.REFRESH_MAX_PENDING)
@@ -0,0 +1,360 @@
+"""Circuit breakers, rate limits and deadline-aware retries per upstream.
+
+Every call to Nominatim, Open-Meteo, Anthropic, OpenAI and the image host goes
+through ``upstreams[name].call`` (or ``call_async``), which:
+
+- waits for a token from the upstream's bucket, sized from
+  UPSTREAM_RATE_LIMITS to stay inside the provider's quota;
+- fails fast with ``UpstreamUnavailable`` while the upstream's circuit is
+  open: after CIRCUIT_FAILURE_THRESHOLD consecutive failures the circuit
+  opens for CIRCUIT_RESET_TIMEOUT seconds, then lets one probe call through
+  (half-open) and closes again if it succeeds;
+- retries connection and timeout errors, 429s and 5xx up to UPSTREAM_RETRIES
+  times with exponential backoff, but never sleeps or waits for a token past
+  the current request's deadline. Other errors are not retried and do not
+  count against the circuit.
+
+Page handlers set the deadline with ``deadline(seconds)``; it lives in a
+context variable, so asyncio tasks inherit it, and stage threads do when
+submitted through ``contextvars.copy_context().run``. Background work
+(image jobs, refreshes, prewarming) has no deadline and gets the full retry
+budget.
+"""
+import asyncio
+import contextvars
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+import config
+import metrics
+from logs import get_logger
+
+log = get_logger('resilience')
+
+_deadline = contextvars.ContextVar('deadline', default=None)
+
+
+class UpstreamUnavailable(Exception):
+    """Raised without calling the upstream: its circuit is open, or no token
+    could be had before the deadline"""
+
+    def __init__(self, upstream, reason):
+        super().__init__(f"{upstream} unavailable: {reason}")
+        self.upstream = upstream
+        self.reason = reason
+
+
+@contextmanager
+def deadline(seconds):
+    """Bound the upstream calls made in the enclosed block to ``seconds`` from now"""
+    token = _deadline.set(time.monotonic() + seconds)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+
+def iter_with_deadline(iterable, seconds):
+    """Iterate ``iterable`` under a deadline that starts with the first item"""
+    with deadline(seconds):
+        yield from iterable
+
+
+def remaining():
+    """Seconds left before the current deadline, or None without one"""
+    expires_at = _deadline.get()
+    return None if expires_at is None else expires_at - time.monotonic()
+
+
+def status_code(exc):
+    """HTTP status behind an exception from requests, httpx or an SDK, if any"""
+    while exc is not None:
+        status = getattr(exc, 'status_code', None)
+        if status is None:
+            status = getattr(getattr(exc, 'response', None), 'status_code', None)
+        if isinstance(status, int):
+            return status
+        exc = exc.__cause__ or exc.__context__
+    return None
+
+
+# Connection and timeout errors of the HTTP stacks and SDKs, by top-level
+# module and class name so none of them has to be imported here
+TRANSIENT_ERRORS = {
+    ('requests', 'ConnectionError'),
+    ('requests', 'Timeout'),
+    ('httpx', 'TransportError'),
+    ('anthropic', 'APIConnectionError'),
+    ('openai', 'APIConnectionError'),
+    ('geopy', 'GeocoderTimedOut'),
+    ('geopy', 'GeocoderUnavailable'),
+    ('geopy', 'GeocoderRateLimited'),
+}
+
+
+def is_transient(exc):
+    """Whether ``exc`` or an exception it was raised from is a connection or timeout error"""
+    while exc is not None:
+        if isinstance(exc, (ConnectionError, TimeoutError)):
+            return True
+        for cls in type(exc).__mro__:
+            if (cls.__module__.split('.')[0], cls.__name__) in TRANSIENT_ERRORS:
+                return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+
+def is_retryable(exc):
+    """429s, 5xx and connection or timeout errors are worth retrying; other
+    4xx and errors that never reached the upstream (bad arguments, bad JSON)
+    are not"""
+    status = status_code(exc)
+    if status is not None:
+        return status == 429 or status >= 500
+    return is_transient(exc)
+
+
+class TokenBucket:
+    """``rate`` tokens per second, up to ``capacity`` saved for bursts"""
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = float(capacity)
+        self._lock = threading.Lock()
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+
+    def _refill(self, now):
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def take(self, tokens=1):
+        """Take ``tokens`` if they are available now"""
+        return self.wait_time(tokens) == 0
+
+    def wait_time(self, tokens=1):
+        """Take ``tokens`` and return 0, or return how long until they are available"""
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._tokens >= tokens:
+                self._tokens -= tokens
+                return 0
+            return (tokens - self._tokens) / self.rate
+
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probing = False
+
+    def _set_state(self, state):
+        if state != self.state:
+            self.state = state
+            metrics.circuit_transitions.inc(upstream=self.name, state=state)
+            log.warning("circuit state changed", upstream=self.name, state=state)
+
+    def available(self):
+        """Whether a call could go through now, without claiming the probe"""
+        with self._lock:
+            if self.state == self.OPEN:
+                return time.monotonic() - self._opened_at >= self.reset_timeout
+            return not (self.state == self.HALF_OPEN and self._probing)
+
+    def allow(self):
+        """Whether to make a call now; in half-open state only one probe at a time"""
+        with self._lock:
+            if self.state == self.OPEN:
+                if time.monotonic() - self._opened_at < self.reset_timeout:
+                    return False
+                self._set_state(self.HALF_OPEN)
+            if self.state == self.HALF_OPEN:
+                if self._probing:
+                    return False
+                self._probing = True
+            return True
+
+    def release(self):
+        """Give up a call without a verdict, freeing the half-open probe"""
+        with self._lock:
+            self._probing = False
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._probing = False
+            self._set_state(self.CLOSED)
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._probing = False
+            if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+                self._opened_at = time.monotonic()
+                self._set_state(self.OPEN)
+
+
+class Upstream:
+    def __init__(self, name, bucket=None, breaker=None, retries=2, backoff=0.2, timeout=None):
+        self.name = name
+        self.bucket = bucket
+        self.breaker = breaker or CircuitBreaker(name)
+        self.retries = retries
+        self.backoff = backoff
+        self.default_timeout = timeout
+
+    def timeout(self, default=None):
+        """Timeout for one call: the upstream's own, cut short by the deadline"""
+        timeout = default if default is not None else self.default_timeout
+        left = remaining()
+        if left is None:
+            return timeout
+        left = max(left, 0.001)
+        return left if timeout is None else min(timeout, left)
+
+    def _token_wait(self):
+        """Seconds to sleep for a token; raises if that would pass the deadline"""
+        if self.bucket is None:
+            return 0
+        wait = self.bucket.wait_time()
+        left = remaining()
+        if wait and left is not None and wait > left:
+            metrics.upstream_rejections.inc(upstream=self.name, reason='rate_limited')
+            raise UpstreamUnavailable(self.name, 'rate limited')
+        return wait
+
+    def _admit(self):
+        if not self.breaker.allow():
+            metrics.upstream_rejections.inc(upstream=self.name, reason='circuit_open')
+            raise UpstreamUnavailable(self.name, 'circuit open')
+
+    def _retry_delay(self, attempt, exc):
+        """Backoff before the next attempt, or None if the failure is final"""
+        if attempt >= self.retries or not is_retryable(exc) or not self.breaker.available():
+            return None
+        delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.0)
+        left = remaining()
+        if left is not None and delay >= left:
+            return None
+        metrics.upstream_retries.inc(upstream=self.name)
+        return delay
+
+    def _record(self, exc):
+        if is_retryable(exc):
+            self.breaker.record_failure()
+        elif status_code(exc) is not None:
+            # A rejected request (4xx other than 429): the upstream is up and answering
+            self.breaker.record_success()
+        else:
+            # Our own error, not the upstream's; it counts neither way
+            self.breaker.release()
+
+    def call(self, fn, *args, **kwargs):
+        """``fn(*args, **kwargs)`` under the upstream's rate limit, breaker and retries"""
+        attempt = 0
+        while True:
+            # The breaker first: a call it rejects should not use up a token
+            self._admit()
+            try:
+                wait = self._token_wait()
+                while wait:
+                    time.sleep(wait)
+                    wait = self._token_wait()
+            except UpstreamUnavailable:
+                self.breaker.release()
+                raise
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self._record(e)
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                log.debug("retrying upstream call", upstream=self.name, attempt=attempt + 1, error=str(e))
+                time.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    async def call_async(self, fn, *args, **kwargs):
+        """Like ``call`` for a coroutine function, sleeping on the event loop"""
+        attempt = 0
+        while True:
+            self._admit()
+            try:
+                wait = self._token_wait()
+                while wait:
+                    await asyncio.sleep(wait)
+                    wait = self._token_wait()
+            except (UpstreamUnavailable, asyncio.CancelledError):
+                self.breaker.release()
+                raise
+            try:
+                result = await fn(*args, **kwargs)
+            except asyncio.CancelledError:
+                # Cancelled by a stage timeout or a closed stream, not failed
+                self.breaker.release()
+                raise
+            except Exception as e:
+                self._record(e)
+                delay = self._retry_delay(attempt, e)
+                if delay is None:
+                    raise
+                log.debug("retrying upstream call", upstream=self.name, attempt=attempt + 1, error=str(e))
+                await asyncio.sleep(delay)
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return result
+
+    def stats(self):
+        return {'state': self.breaker.state, 'retries': self.retries}
+
+
+def parse_rate_limits(spec):
+    """Turn ``'anthropic=50/10,openai=5'`` (calls per minute, optional burst)
+    into ``{'anthropic': TokenBucket(50/60, 10), 'openai': TokenBucket(5/60, 1)}``;
+    the burst defaults to ten seconds' worth of calls, at least one"""
+    buckets = {}
+    for item in spec.split(','):
+        name, _, value = item.strip().partition('=')
+        if not name or not value:
+            continue
+        per_minute, _, burst = value.partition('/')
+        per_minute = float(per_minute)
+        if per_minute <= 0:
+            continue
+        buckets[name] = TokenBucket(per_minute / 60.0, float(burst) if burst else max(1.0, per_minute / 6))
+    return buckets
+
+
+def _build_upstreams():
+    buckets = parse_rate_limits(config.UPSTREAM_RATE_LIMITS)
+    timeouts = {
+        'nominatim': config.GEOCODE_TIMEOUT,
+        'openmeteo': config.WEATHER_TIMEOUT,
+        'anthropic': config.ANTHROPIC_TIMEOUT,
+        'openai': config.OPENAI_TIMEOUT,
+        'image_download': config.DOWNLOAD_TIMEOUT,
+    }
+    return {
+        name: Upstream(name, bucket=buckets.get(name),
+                       breaker=CircuitBreaker(name, config.CIRCUIT_FAILURE_THRESHOLD,
+                                              config.CIRCUIT_RESET_TIMEOUT),
+                       retries=config.UPSTREAM_RETRIES, backoff=config.UPSTREAM_RETRY_BACKOFF,
+                       timeout=timeout)
+        for name, timeout in timeouts.items()
+    }
+
+
+upstreams = _build_upstreams()
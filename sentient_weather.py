@@ -1,29 +1,42 @@
 import os
 import json
-from flask import Flask, render_template, request, jsonify
+import queue
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 from dotenv import find_dotenv, load_dotenv
 from notebook_functions import (
     get_city_coordinates,
     get_weather_data,
+    get_weather_data_batch,
     get_weather_description,
     generate_color_palette,
     generate_city_image,
+    cached_city_image,
     generate_font_recommendations,
-    get_css_variables
+    generate_theme,
+    get_css_variables,
+    image_cache_key,
+    warm_city_image
 )
+import config
+import metrics
+from admission import admission, degraded, nearest_image
+from design_cache import design_cache
+from gazetteer import get_gazetteer
+from geocode_cache import get_geocode_cache
+from image_derivatives import image_variants
+from image_store import get_image_store
+from jobs import JobQueue, StagePool
+from logs import get_logger
+from page_cache import LANDING_KEY, CachedPage, is_cacheable, page_cache
+from prewarm import Prewarmer
+from refresh import refresher
+from resilience import deadline, iter_with_deadline, upstreams
+from singleflight import flights
+from sse import section_events, sse_event
 
-# Load environment variables
-dotenv_path = find_dotenv()
-if dotenv_path:
-    load_dotenv(dotenv_path)
-else:
-    print("Warning: .env file not found")
-
-# Verify the environment variables are loaded
-if not os.getenv('ANTHROPIC_API_KEY') or not os.getenv('OPENAI_API_KEY'):
-    print("Error: Required API keys not found in environment variables")
-    print("Please ensure your .env file contains ANTHROPIC_API_KEY and OPENAI_API_KEY")
-    exit(1)
+log = get_logger('app')
 
 app = Flask(__name__)
 
@@ -86,14 +99,14 @@ def process_colors(color_response):
             
         return get_default_colors()
     except Exception as e:
-        print(f"Error processing colors: {str(e)}")
+        log.error("color processing failed", error=str(e))
         return get_default_colors()
 
 def process_fonts(generated_fonts):
     """Process the generated fonts and ensure they have all required fields"""
     try:
         if not generated_fonts:
-            print("No fonts generated, using defaults")
+            log.info("no fonts generated, using defaults")
             return get_default_fonts()
 
         # If generated_fonts is a string (JSON), parse it
@@ -101,7 +114,7 @@ def process_fonts(generated_fonts):
             try:
                 generated_fonts = json.loads(generated_fonts)
             except json.JSONDecodeError as e:
-                print(f"Error decoding font JSON: {e}")
+                log.error("font JSON decoding failed", error=str(e))
                 return get_default_fonts()
             
         # Create a copy of the generated fonts to avoid modifying the original
@@ -131,105 +144,730 @@ def process_fonts(generated_fonts):
         
         processed_fonts['google_fonts_url'] = f"https://fonts.googleapis.com/css2?{'&'.join(fonts_for_url)}"
         
-        print(f"Successfully processed fonts: {processed_fonts}")
         return processed_fonts
         
     except Exception as e:
-        print(f"Error in process_fonts: {str(e)}")
+        log.error("font processing failed", error=str(e))
         return get_default_fonts()
 
-@app.route('/', methods=['GET', 'POST'])
-def index():
-    if request.method == 'POST':
+# Shared pool for the palette, font and image stages of a page
+stage_executor = StagePool(config.STAGE_WORKERS, name='stage')
+
+def _generate_palette(city, weather_data, weather_description):
+    log.debug("generating palette", city=city)
+    color_response = generate_color_palette(city, weather_data, weather_description)
+    colors = process_colors(color_response)
+    if color_response:
+        design_cache.set('palette', city, weather_data, colors)
+    return colors
+
+@metrics.timed('palette')
+def build_palette(city, weather_data, weather_description):
+    """Generate and process the color palette for a city, using the design cache"""
+    key = design_cache.make_key('palette', city, weather_data)
+    colors, stale = design_cache.lookup('palette', city, weather_data)
+    if colors is not None:
+        log.debug("using cached palette", city=city, stale=stale)
+        if stale:
+            refresher.schedule('design', repr(key), _generate_palette,
+                               city, weather_data, weather_description)
+        return colors
+
+    return flights.do(repr(key),
+                      lambda: _generate_palette(city, weather_data, weather_description),
+                      recheck=lambda: design_cache.peek('palette', city, weather_data))
+
+def _generate_fonts(city, weather_data):
+    raw_fonts = generate_font_recommendations(city, weather_data)
+
+    if not raw_fonts:
+        log.info("no font recommendations received", city=city)
+        return get_default_fonts()
+    fonts = process_fonts(raw_fonts)
+    design_cache.set('fonts', city, weather_data, fonts)
+    return fonts
+
+@metrics.timed('fonts')
+def build_fonts(city, weather_data):
+    """Generate and process font recommendations for a city, using the design cache"""
+    key = design_cache.make_key('fonts', city, weather_data)
+    fonts, stale = design_cache.lookup('fonts', city, weather_data)
+    if fonts is not None:
+        log.debug("using cached fonts", city=city, stale=stale)
+        if stale:
+            refresher.schedule('design', repr(key), _generate_fonts, city, weather_data)
+        return fonts
+
+    return flights.do(repr(key),
+                      lambda: _generate_fonts(city, weather_data),
+                      recheck=lambda: design_cache.peek('fonts', city, weather_data))
+
+def _generate_theme(city, weather_data, weather_description):
+    colors = design_cache.peek('palette', city, weather_data)
+    fonts = design_cache.peek('fonts', city, weather_data)
+
+    log.debug("generating theme", city=city)
+    theme = generate_theme(city, weather_data, weather_description)
+
+    if colors is None:
+        if theme['colors']:
+            colors = process_colors(theme['colors'])
+            design_cache.set('palette', city, weather_data, colors)
+        else:
+            colors = get_default_colors()
+
+    if fonts is None:
+        if theme['fonts']:
+            fonts = process_fonts(theme['fonts'])
+            design_cache.set('fonts', city, weather_data, fonts)
+        else:
+            fonts = get_default_fonts()
+
+    return colors, fonts
+
+@metrics.timed('theme')
+def build_theme(city, weather_data, weather_description):
+    """Generate palette and fonts with one combined call, falling back per section.
+
+    Stale sections are served while one background call regenerates them.
+    """
+    key = design_cache.make_key('theme', city, weather_data)
+    colors, colors_stale = design_cache.lookup('palette', city, weather_data)
+    fonts, fonts_stale = design_cache.lookup('fonts', city, weather_data)
+    if colors is not None and fonts is not None:
+        log.debug("using cached theme", city=city, stale=colors_stale or fonts_stale)
+        if colors_stale or fonts_stale:
+            refresher.schedule('design', repr(key), _generate_theme,
+                               city, weather_data, weather_description)
+        return colors, fonts
+
+    return flights.do(repr(key),
+                      lambda: _generate_theme(city, weather_data, weather_description),
+                      recheck=lambda: design_cache.peek_theme(city, weather_data))
+
+# Background image generation, polled by the page through /api/image/<job_id>
+image_jobs = JobQueue(max_workers=config.IMAGE_JOB_WORKERS, ttl=config.IMAGE_JOB_TTL,
+                      name='image-job')
+
+def start_image_job(city, weather_description):
+    """Return a cached (possibly stale) image path, or queue generation and return its job id"""
+    image_path = cached_city_image(city, weather_description)
+    if image_path:
+        return image_path, None
+    cache_key = image_cache_key(city, weather_description)
+    job = image_jobs.submit(cache_key, generate_city_image, city, weather_description)
+    return None, job.id
+
+def build_image(city, weather_description):
+    """Generate or fetch the cached city image"""
+    return generate_city_image(city, weather_description)
+
+def palette_source(city, weather_description):
+    """Where a page's palette comes from under PALETTE_MODE: 'image' or 'llm'"""
+    if config.PALETTE_MODE not in ('image', 'hybrid'):
+        return 'llm'
+    # Imported here so the default 'llm' mode never loads NumPy
+    from image_palette import image_palettes_available
+    if not image_palettes_available():
+        return 'llm'
+    if config.PALETTE_MODE == 'image' or image_on_hand(city, weather_description):
+        return 'image'
+    return 'llm'
+
+def build_image_palette(city, weather_data, weather_description, wait=True):
+    """Extract the palette from the city image.
+
+    In 'image' mode a missing image is generated first, sharing the call with
+    the image stage, unless ``wait`` is false. Without an image the palette
+    comes from the LLM in 'hybrid' mode and is the default otherwise.
+
+    Extracted palettes go into the design cache like generated ones, so page
+    caching, prewarming and the last known theme see them.
+    """
+    from image_palette import image_palette
+
+    image_path = cached_city_image(city, weather_description)
+    if image_path is None and wait and config.PALETTE_MODE == 'image':
+        image_path = generate_city_image(city, weather_description)
+    colors = image_palette(image_path) if image_path else None
+    if colors is not None:
+        store_image_palette(city, weather_data, colors)
+        return colors
+    if config.PALETTE_MODE == 'hybrid':
+        return build_palette(city, weather_data, weather_description)
+    return get_default_colors()
+
+def store_image_palette(city, weather_data, colors):
+    """Cache an extracted palette unless the same one is already cached and fresh"""
+    if design_cache.peek('palette', city, weather_data) != colors:
+        design_cache.set('palette', city, weather_data, colors)
+
+# Queued stage and image work counts towards admission control
+admission.watch_queue('stages', stage_executor.pending)
+admission.watch_queue('image_jobs', image_jobs.pending)
+
+def theme_on_hand(city, weather_data, kinds=('palette', 'fonts')):
+    """Whether the palette and fonts are cached, fresh or stale, so no LLM call is needed"""
+    return all(design_cache.peek(kind, city, weather_data, allow_stale=True) is not None
+               for kind in kinds)
+
+def image_on_hand(city, weather_description):
+    """Whether an image is cached, fresh or stale, so no DALL-E call is needed"""
+    key = image_cache_key(city, weather_description)
+    return get_image_store().peek(key, allow_stale=True) is not None
+
+def shed_stages(city, weather_data, weather_description, source='llm'):
+    """The stages admission control sheds for a page, 'theme' and/or 'image'.
+
+    Only stages that would call an upstream are considered; cached designs
+    and images are always served. With an image ``source`` the palette needs
+    no LLM call, so only the fonts count towards the theme.
+    """
+    kinds = ('fonts',) if source == 'image' else ('palette', 'fonts')
+    shed = []
+    if not theme_on_hand(city, weather_data, kinds) and not admission.admit('anthropic'):
+        shed.append('theme')
+    if not image_on_hand(city, weather_description) and not admission.admit('openai'):
+        shed.append('image')
+    for stage in shed:
+        degraded(stage)
+    return shed
+
+def last_known_theme(city):
+    """The city's last generated palette and fonts under any weather, else the defaults"""
+    return (design_cache.last_known('palette', city) or get_default_colors(),
+            design_cache.last_known('fonts', city) or get_default_fonts())
+
+def warm_design(city, weather_data, weather_description):
+    """Generate the palette and fonts for a city ahead of demand"""
+    if palette_source(city, weather_description) == 'image':
+        # The image is warmed first, so this only extracts its palette
+        build_image_palette(city, weather_data, weather_description, wait=False)
+        build_fonts(city, weather_data)
+    elif config.THEME_MODE == 'combined':
+        build_theme(city, weather_data, weather_description)
+    else:
+        build_palette(city, weather_data, weather_description)
+        build_fonts(city, weather_data)
+
+prewarmer = Prewarmer(warm_design, warm_city_image, palette_source=palette_source)
+
+def _run_stages_sequentially(stages):
+    """Run each stage in turn, falling back to its default on error.
+
+    Returns the results and the names of the stages that fell back.
+    """
+    results, fallbacks = {}, []
+    for name, (func, args, _timeout, fallback) in stages.items():
         try:
-            city = request.form['city']
-            
-            # Get coordinates
-            coordinates = get_city_coordinates(city)
-            if not coordinates:
-                return render_template('index.html', 
-                                     error="City not found",
-                                     fonts=get_default_fonts(),
-                                     font_css_vars=get_css_variables(get_default_fonts()),
-                                     colors=get_default_colors())
-            
-            # Get weather data
-            weather_data = get_weather_data(*coordinates)
-            if not weather_data:
-                return render_template('index.html', 
-                                     error="Could not fetch weather data",
-                                     fonts=get_default_fonts(),
-                                     font_css_vars=get_css_variables(get_default_fonts()),
-                                     colors=get_default_colors())
-            
-            print(f"Weather data received: {weather_data}")
-            
-            # Get weather description
-            weather_description = get_weather_description(weather_data['current']['weather_code'])
-            print(f"Weather description: {weather_description}")
+            results[name] = func(*args)
+        except Exception as e:
+            log.error("stage failed", stage=name, error=str(e))
+            results[name] = fallback()
+            fallbacks.append(name)
+    return results, fallbacks
 
-            # Generate and process color palette
-            try:
-                print(f"Generating palette for: {city}")
-                color_response = generate_color_palette(city, weather_data, weather_description)
-                print(f"Color API Response: {color_response}")
-                colors = process_colors(color_response)
-                print(f"Processed colors: {colors}")
-            except Exception as e:
-                print(f"Error generating/processing colors: {str(e)}")
-                colors = get_default_colors()
-            
-            # Generate and process font recommendations
-            try:
-                raw_fonts = generate_font_recommendations(city, weather_data)
-                print(f"Font API Response: {json.dumps(raw_fonts, indent=4)}")
-                
-                if not raw_fonts:
-                    print("No font recommendations received")
-                    processed_fonts = get_default_fonts()
-                else:
-                    processed_fonts = process_fonts(raw_fonts)
-                    
-                font_css_vars = get_css_variables(processed_fonts)
-                print(f"Generated CSS variables: {font_css_vars}")
-                
-            except Exception as e:
-                print(f"Error in font generation/processing: {str(e)}")
-                processed_fonts = get_default_fonts()
-                font_css_vars = get_css_variables(processed_fonts)
-            
-            # Generate image
-            try:
-                image_path = generate_city_image(city, weather_description)
-                print(f"Generated new image for {city} with {weather_description}")
-            except Exception as e:
-                print(f"Error generating image: {str(e)}")
-                image_path = None
-            
-            return render_template('index.html',
-                                 city=city,
-                                 weather_data=weather_data,
-                                 weather_description=weather_description,
-                                 colors=colors,
-                                 fonts=processed_fonts,
-                                 font_css_vars=font_css_vars,
-                                 image_path=image_path)
-            
+def _run_stages_concurrently(stages):
+    """Fan the stages out on the stage pool and gather them before the page deadline"""
+    page_deadline = time.monotonic() + config.PAGE_DEADLINE
+    # Stages run in the page's context, so under its deadline (see resilience)
+    futures = {name: stage_executor.submit(func, *args)
+               for name, (func, args, _timeout, _fallback) in stages.items()}
+    started = time.monotonic()
+
+    results, fallbacks = {}, []
+    for name, future in futures.items():
+        _func, _args, timeout, fallback = stages[name]
+        remaining = min(started + timeout, page_deadline) - time.monotonic()
+        try:
+            results[name] = future.result(timeout=max(remaining, 0))
+        except FutureTimeoutError:
+            log.warning("stage timed out, using fallback", stage=name)
+            future.cancel()
+            results[name] = fallback()
+            fallbacks.append(name)
         except Exception as e:
-            print(f"Error in main route handler: {str(e)}")
-            default_fonts = get_default_fonts()
-            return render_template('index.html', 
-                                 error=str(e),
-                                 fonts=default_fonts,
-                                 font_css_vars=get_css_variables(default_fonts),
-                                 colors=get_default_colors())
-    
-    # GET request - return initial page with default styling
+            log.error("stage failed", stage=name, error=str(e))
+            results[name] = fallback()
+            fallbacks.append(name)
+    return results, fallbacks
+
+def design_stages(city, weather_data, weather_description, source, shed):
+    """The palette and font stages of a page as ``{name: (func, args, timeout, fallback)}``.
+
+    With an image ``source`` the palette is extracted from the city image and
+    the fonts come from their own call; otherwise both follow THEME_MODE. A
+    shed theme leaves only the image palette stage, which then does not wait
+    for a new image.
+    """
+    stages = {}
+    if source == 'image':
+        stages['palette'] = (build_image_palette,
+                             (city, weather_data, weather_description, 'image' not in shed),
+                             config.PALETTE_TIMEOUT, get_default_colors)
+    if 'theme' in shed:
+        return stages
+    if source == 'image':
+        stages['fonts'] = (build_fonts, (city, weather_data), config.FONTS_TIMEOUT, get_default_fonts)
+    elif config.THEME_MODE == 'combined':
+        stages['theme'] = (build_theme, (city, weather_data, weather_description),
+                           max(config.PALETTE_TIMEOUT, config.FONTS_TIMEOUT),
+                           lambda: (get_default_colors(), get_default_fonts()))
+    else:
+        stages['palette'] = (build_palette, (city, weather_data, weather_description),
+                             config.PALETTE_TIMEOUT, get_default_colors)
+        stages['fonts'] = (build_fonts, (city, weather_data), config.FONTS_TIMEOUT, get_default_fonts)
+    return stages
+
+def run_design_stages(city, weather_data, weather_description):
+    """Run the palette, font and image stages and return the template variables.
+
+    Stages run on the shared pool when CONCURRENT_STAGES is enabled, each
+    bounded by its own timeout and by the overall page deadline. A stage that
+    fails or times out falls back to its default. With THEME_MODE 'combined'
+    the palette and fonts come from a single LLM call; with PALETTE_MODE
+    'image' or 'hybrid' the palette may instead be extracted from the city
+    image (see ``palette_source``). With ASYNC_IMAGES an
+    uncached image is queued as a background job instead of awaited, and
+    ``image_job`` names the job for the page to poll. ``fallbacks`` lists the
+    stages that fell back to their defaults.
+
+    A stage that would call an upstream the admission controller sheds is not
+    run; the page gets the nearest cached image and the last known theme, and
+    ``degraded`` lists the shed stages.
+    """
+    source = palette_source(city, weather_description)
+    shed = shed_stages(city, weather_data, weather_description, source)
+    stages = design_stages(city, weather_data, weather_description, source, shed)
+    image_job = None
+    if 'image' in shed:
+        image_path = nearest_image(city, weather_description)
+    elif config.ASYNC_IMAGES:
+        image_path, image_job = start_image_job(city, weather_description)
+    else:
+        stages['image'] = (build_image, (city, weather_description),
+                           config.IMAGE_TIMEOUT, lambda: None)
+
+    if config.CONCURRENT_STAGES:
+        results, fallbacks = _run_stages_concurrently(stages)
+    else:
+        results, fallbacks = _run_stages_sequentially(stages)
+
+    if 'theme' in shed:
+        colors, processed_fonts = last_known_theme(city)
+        colors = results.get('palette', colors)
+    elif 'theme' in results:
+        colors, processed_fonts = results['theme']
+    else:
+        colors, processed_fonts = results['palette'], results['fonts']
+    font_css_vars = get_css_variables(processed_fonts)
+    if 'image' in results:
+        image_path = results['image']
+    return {
+        'colors': colors,
+        'fonts': processed_fonts,
+        'font_css_vars': font_css_vars,
+        'image_path': image_path,
+        'image_variants': image_variants(image_path),
+        'image_job': image_job,
+        'fallbacks': fallbacks,
+        'degraded': shed,
+    }
+
+# Design generation for /api/weather/batch gets its own bounded pool, so a
+# large batch cannot crowd interactive pages out of the stage pool
+batch_design_executor = ThreadPoolExecutor(max_workers=config.BATCH_DESIGN_WORKERS,
+                                           thread_name_prefix='batch-design')
+
+def build_design(city, weather_data, weather_description):
+    """Palette and fonts for a city as a ``(colors, fonts)`` pair, following THEME_MODE
+    and PALETTE_MODE; batches never wait for an image"""
+    if palette_source(city, weather_description) == 'image':
+        return (build_image_palette(city, weather_data, weather_description, wait=False),
+                build_fonts(city, weather_data))
+    if config.THEME_MODE == 'combined':
+        return build_theme(city, weather_data, weather_description)
+    return (build_palette(city, weather_data, weather_description),
+            build_fonts(city, weather_data))
+
+def weather_json(weather_data):
+    """JSON-ready copy of ``get_weather_data`` output, with ISO forecast dates"""
+    return {
+        'current': weather_data['current'],
+        'forecast': [dict(day.to_dict(), date=day.date.isoformat()) for day in weather_data['forecast']],
+    }
+
+def weather_batch(cities, with_design=True):
+    """Weather, and optionally palette and fonts, for each city in order.
+
+    Cities are geocoded through the cache, their weather is fetched with
+    multi-location Open-Meteo requests, and design generation fans out on
+    the bounded batch pool until the page deadline; cities still pending
+    then get the default design.
+    """
+    coordinates = [get_city_coordinates(city) for city in cities]
+    found = [i for i, coords in enumerate(coordinates) if coords]
+    weather = get_weather_data_batch([coordinates[i] for i in found])
+
+    results = [{'city': city, 'error': "City not found"} for city in cities]
+    designs = {}
+    for i, weather_data in zip(found, weather):
+        city = cities[i]
+        if not weather_data:
+            results[i]['error'] = "Could not fetch weather data"
+            continue
+        weather_description = get_weather_description(weather_data['current']['weather_code'])
+        results[i] = dict(weather_json(weather_data), city=city,
+                          latitude=coordinates[i][0], longitude=coordinates[i][1],
+                          weather_description=weather_description)
+        if with_design:
+            designs[i] = batch_design_executor.submit(build_design, city, weather_data,
+                                                      weather_description)
+
+    page_deadline = time.monotonic() + config.PAGE_DEADLINE
+    for i, future in designs.items():
+        try:
+            colors, fonts = future.result(timeout=max(page_deadline - time.monotonic(), 0))
+        except FutureTimeoutError:
+            log.warning("batch design timed out, using fallback", city=cities[i])
+            colors, fonts = get_default_colors(), get_default_fonts()
+        except Exception as e:
+            log.error("batch design failed", city=cities[i], error=str(e))
+            colors, fonts = get_default_colors(), get_default_fonts()
+        results[i]['colors'] = colors
+        results[i]['fonts'] = fonts
+    return results
+
+@app.context_processor
+def inject_stream_flag():
+    return {'stream_pages': config.STREAM_PAGES}
+
+def stream_page(city):
+    """Yield SSE events for a city page, each section as soon as it is ready.
+
+    Weather is sent first as a rendered fragment, then the palette, fonts and
+    image in whatever order their stages finish. Comment lines are sent as
+    heartbeats while waiting, and stages still running at the stream deadline
+    are sent with their fallbacks.
+    """
+    coordinates = get_city_coordinates(city)
+    if not coordinates:
+        yield sse_event('error', {'error': "City not found"})
+        return
+
+    weather_data = get_weather_data(*coordinates)
+    if not weather_data:
+        yield sse_event('error', {'error': "Could not fetch weather data"})
+        return
+
+    weather_description = get_weather_description(weather_data['current']['weather_code'])
+    prewarmer.note_request(city, weather_data, weather_description)
+    yield sse_event('weather', {
+        'city': city,
+        'weather_description': weather_description,
+        'html': render_template('_weather.html', city=city, weather_data=weather_data,
+                                weather_description=weather_description, image_pending=True),
+    })
+
+    events = queue.Queue()
+    source = palette_source(city, weather_description)
+    shed = shed_stages(city, weather_data, weather_description, source)
+    stages = design_stages(city, weather_data, weather_description, source, shed)
+    fallbacks = {name: fallback for name, (_func, _args, _timeout, fallback) in stages.items()}
+    fallbacks['image'] = lambda: None
+
+    for name, (func, args, _timeout, _fallback) in stages.items():
+        future = stage_executor.submit(func, *args)
+        future.add_done_callback(lambda f, name=name: events.put((name, f.result, f.exception)))
+    if 'theme' in shed:
+        # An image palette stage still runs; only the fonts come from the last known theme
+        if 'palette' in stages:
+            fallbacks['fonts'] = lambda: last_known_theme(city)[1]
+            events.put(('fonts', fallbacks['fonts'], lambda: None))
+        else:
+            fallbacks['theme'] = lambda: last_known_theme(city)
+            events.put(('theme', fallbacks['theme'], lambda: None))
+
+    if 'image' in shed:
+        image_path, image_job = nearest_image(city, weather_description), None
+    else:
+        image_path, image_job = start_image_job(city, weather_description)
+    if image_job:
+        image_jobs.get(image_job).add_done_callback(
+            lambda job: events.put(('image', lambda: job.result, lambda: None)))
+    else:
+        events.put(('image', lambda: image_path, lambda: None))
+
+    pending = set(fallbacks)
+    stream_deadline = time.monotonic() + config.STREAM_DEADLINE
+    while pending:
+        remaining = stream_deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        try:
+            name, result, exception = events.get(timeout=min(config.STREAM_HEARTBEAT, remaining))
+        except queue.Empty:
+            yield ": keep-alive\n\n"
+            continue
+
+        pending.discard(name)
+        if exception() is not None:
+            log.error("stage failed", stage=name, error=str(exception()))
+            yield from section_events(name, fallbacks[name]())
+        else:
+            yield from section_events(name, result())
+
+    for name in pending:
+        log.warning("stage timed out, using fallback", stage=name)
+        yield from section_events(name, fallbacks[name]())
+    yield sse_event('done', {'degraded': shed})
+
+def render_error_page(error):
     default_fonts = get_default_fonts()
     return render_template('index.html',
+                         error=error,
                          fonts=default_fonts,
                          font_css_vars=get_css_variables(default_fonts),
                          colors=get_default_colors())
 
+
+def render_city_page(city):
+    """Render the page for a city, reusing a cached render for its weather bucket.
+
+    Returns the page and its HTTP status, whether the page may be cached
+    downstream (error pages and degraded renders are not) and the stages shed
+    by admission control.
+    """
+    coordinates = get_city_coordinates(city)
+    if not coordinates:
+        return CachedPage(render_error_page("City not found")), 404, False, []
+
+    weather_data = get_weather_data(*coordinates)
+    if not weather_data:
+        return CachedPage(render_error_page("Could not fetch weather data")), 502, False, []
+
+    weather_description = get_weather_description(weather_data['current']['weather_code'])
+    log.debug("weather received", city=city, weather=weather_description)
+    prewarmer.note_request(city, weather_data, weather_description)
+
+    key = page_cache.city_key(city, weather_data)
+    if config.PAGE_CACHE:
+        page = page_cache.get(key)
+        if page is not None:
+            return page, 200, True, []
+
+    design = run_design_stages(city, weather_data, weather_description)
+
+    with metrics.time_stage('render'):
+        body = render_template('index.html',
+                             city=city,
+                             weather_data=weather_data,
+                             weather_description=weather_description,
+                             **design)
+    if config.PAGE_CACHE and is_cacheable(city, weather_data, design):
+        return page_cache.set(key, body), 200, True, []
+    return CachedPage(body), 200, False, design['degraded']
+
+def degraded_headers(shed):
+    """``X-Degraded`` header listing the stages shed by admission control"""
+    return {'X-Degraded': ','.join(shed)} if shed else {}
+
+def page_response(page, status=200, cacheable=True, shed=()):
+    """HTML response with a strong ETag, answering If-None-Match with 304"""
+    response = Response(page.body, status=status, mimetype='text/html',
+                        headers=degraded_headers(shed))
+    if not cacheable:
+        response.cache_control.no_store = True
+        return response
+    response.set_etag(page.etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = config.PAGE_MAX_AGE
+    return response.make_conditional(request)
+
+@app.route('/', methods=['GET', 'POST'])
+def index():
+    if request.method == 'POST':
+        try:
+            with deadline(config.PAGE_DEADLINE):
+                page, _status, _cacheable, shed = render_city_page(request.form['city'])
+            return page.body, degraded_headers(shed)
+        except Exception as e:
+            log.exception("main route handler failed", error=str(e))
+            return render_error_page(str(e))
+
+    # GET request - the initial page with default styling, rendered once
+    page = page_cache.get(LANDING_KEY) if config.PAGE_CACHE else None
+    if page is None:
+        default_fonts = get_default_fonts()
+        body = render_template('index.html',
+                             fonts=default_fonts,
+                             font_css_vars=get_css_variables(default_fonts),
+                             colors=get_default_colors())
+        page = page_cache.set(LANDING_KEY, body) if config.PAGE_CACHE else CachedPage(body)
+    return page_response(page)
+
+@app.route('/city/<path:name>')
+def city_page(name):
+    """A city's page by GET, so browsers and reverse proxies can cache it"""
+    city = name.strip()
+    try:
+        with deadline(config.PAGE_DEADLINE):
+            page, status, cacheable, shed = render_city_page(city)
+    except Exception as e:
+        log.exception("city page handler failed", city=city, error=str(e))
+        page, status, cacheable, shed = CachedPage(render_error_page(str(e))), 500, False, []
+    return page_response(page, status, cacheable, shed)
+
+@app.route('/stream')
+def stream():
+    """Stream a city page as Server-Sent Events.
+
+    Each open stream spends most of its time waiting on upstream calls; run it
+    under a cooperative worker (e.g. gunicorn -k gevent) so idle streams do
+    not each pin a worker thread. Served only with SW_STREAM_PAGES on.
+    """
+    if not config.STREAM_PAGES:
+        return jsonify({'error': "Streaming is disabled"}), 404
+    city = request.args.get('city', '').strip()
+    if not city:
+        return jsonify({'error': "Missing city"}), 400
+    return Response(stream_with_context(iter_with_deadline(stream_page(city), config.STREAM_DEADLINE)),
+                    mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@app.route('/api/cities')
+def api_cities():
+    """Autocomplete city names from the local gazetteer"""
+    prefix = request.args.get('prefix', '')
+    limit = request.args.get('limit', 10, type=int)
+    return jsonify(get_gazetteer().suggest(prefix, max(limit, 1)))
+
+@app.route('/api/weather/batch', methods=['GET', 'POST'])
+def api_weather_batch():
+    """Weather for many cities in one call.
+
+    POST a JSON body ``{"cities": [...], "design": true}`` or GET
+    ``?cities=Paris,Berlin&design=0``. With ``design`` (the default) each
+    result also carries its palette and fonts.
+    """
+    if request.method == 'POST':
+        payload = request.get_json(silent=True) or {}
+        cities = payload.get('cities') or []
+        with_design = bool(payload.get('design', True))
+    else:
+        cities = request.args.get('cities', '').split(',')
+        with_design = request.args.get('design', '1').lower() not in ('0', 'false', 'no')
+
+    if not isinstance(cities, list):
+        return jsonify({'error': "cities must be a list"}), 400
+    cities = [str(city).strip() for city in cities if str(city).strip()]
+    if not cities:
+        return jsonify({'error': "Missing cities"}), 400
+    if len(cities) > config.BATCH_MAX_CITIES:
+        return jsonify({'error': f"At most {config.BATCH_MAX_CITIES} cities per batch"}), 400
+
+    return jsonify({'results': weather_batch(cities, with_design)})
+
+@app.route('/api/image/<job_id>')
+def api_image(job_id):
+    """Status of a background image job; includes the image path once done"""
+    job = image_jobs.get(job_id)
+    if job is None:
+        # The job may have run in another worker process; check the store
+        image_path = get_image_store().get(job_id)
+        if not image_path:
+            return jsonify({'id': job_id, 'status': 'unknown'}), 404
+        status = 'done'
+    else:
+        status, image_path = job.status, job.result
+
+    payload = {'id': job_id, 'status': status}
+    if status == 'done':
+        payload['image_path'] = image_path
+        payload['image_variants'] = image_variants(image_path)
+    return jsonify(payload)
+
+@app.route('/metrics')
+def prometheus_metrics():
+    """Stage latencies, cache and upstream counters in the Prometheus text format"""
+    return Response(metrics.render_text(), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/stats')
+def api_stats():
+    """Cache hit/miss counters"""
+    return jsonify({'design_cache': design_cache.stats(), 'page_cache': page_cache.stats(),
+                    'admission': admission.stats(),
+                    'upstreams': {name: upstream.stats() for name, upstream in upstreams.items()},
+                    'prewarm_hot_set': [{'city': city, 'score': round(score, 2)}
+                                        for city, score in prewarmer.tracker.hot(config.PREWARM_TOP_N)]})
+
+def load_environment():
+    """Load .env and check the API keys are set; False if they are missing"""
+    dotenv_path = find_dotenv()
+    if dotenv_path:
+        load_dotenv(dotenv_path)
+    else:
+        log.warning(".env file not found")
+
+    if not os.getenv('ANTHROPIC_API_KEY') or not os.getenv('OPENAI_API_KEY'):
+        log.error("required API keys not found in environment variables",
+                  hint="ensure your .env file contains ANTHROPIC_API_KEY and OPENAI_API_KEY")
+        return False
+    return True
+
+# SDK modules the clients import on first use
+HEAVY_MODULES = ['requests', 'geopy.geocoders', 'openmeteo_requests', 'requests_cache',
+                 'anthropic', 'openai', 'PIL.Image']
+
+def preload_modules():
+    """Import the SDK modules up front; safe before fork (e.g. gunicorn --preload)"""
+    import importlib
+    names = list(HEAVY_MODULES)
+    if config.PALETTE_MODE in ('image', 'hybrid'):
+        names.append('image_palette')
+    for name in names:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+
+def warm_up():
+    """Build this process's clients and open its caches before the first request.
+
+    Clients hold sockets and database handles, so call this in each worker,
+    never in a parent process before fork.
+    """
+    from clients import get_client
+    names = ['openmeteo', 'anthropic', 'openai', 'http']
+    if config.GEOCODER_BACKEND == 'offline':
+        get_gazetteer()
+    else:
+        names.append('geolocator')
+        get_geocode_cache()
+    for name in names:
+        try:
+            get_client(name)
+        except Exception as e:
+            log.error("warming up client failed", client=name, error=str(e))
+    get_image_store()
+
+def create_app():
+    """App factory for WSGI servers, e.g. ``gunicorn 'sentient_weather:create_app()'``.
+
+    Importing this module only defines the app; SDKs load on first use. The
+    factory loads .env, checks the API keys (exiting if they are missing) and
+    then, per SW_PRELOAD_MODULES and SW_WARM_UP, imports the SDKs and builds
+    the clients ahead of the first request.
+    """
+    if not load_environment():
+        raise SystemExit(1)
+    if config.PRELOAD_MODULES:
+        preload_modules()
+    if config.WARM_UP:
+        warm_up()
+    if config.PREWARM:
+        prewarmer.start()
+    return app
+
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
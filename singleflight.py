@@ -0,0 +1,162 @@
+"""Request coalescing for expensive generations.
+
+``SingleFlight.do`` makes sure only one caller per key does the work at a
+time: concurrent callers in the same process wait for the leader and share
+its result (or exception). With ``shared=True`` the leader also takes an
+exclusive file lock, so leaders in other worker processes on the host queue
+behind it and can find the result through ``recheck`` instead of repeating
+the work.
+"""
+import asyncio
+import hashlib
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Not available on Windows; fall back to in-process only
+    fcntl = None
+
+import config
+
+
+def _lock_path(lock_dir, key):
+    os.makedirs(lock_dir, exist_ok=True)
+    name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+    return os.path.join(lock_dir, f"{name}.lock")
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    @contextmanager
+    def _process_lock(self, key):
+        """Hold an exclusive file lock for ``key`` shared by all worker processes"""
+        if fcntl is None or not self.lock_dir:
+            yield
+            return
+
+        with open(_lock_path(self.lock_dir, key), 'a') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    def _lead(self, key, fn, recheck, shared):
+        if shared:
+            with self._process_lock(key):
+                return self._run(fn, recheck)
+        return self._run(fn, recheck)
+
+    @staticmethod
+    def _run(fn, recheck):
+        # The result may have landed between the caller's cache miss and now
+        if recheck is not None:
+            result = recheck()
+            if result is not None:
+                return result
+        return fn()
+
+    def do(self, key, fn, recheck=None, shared=False):
+        """Run ``fn()`` once for concurrent callers with the same key.
+
+        ``recheck()`` is called by the leader before doing the work and
+        should return the cached result, or None if there is none yet.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = self._lead(key, fn, recheck, shared)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+
+class AsyncSingleFlight:
+    """``SingleFlight`` for coroutines sharing one event loop.
+
+    The work runs in its own task, so the leader being cancelled (by its
+    stage timeout, say) does not cancel it for the callers waiting on it;
+    the cross-process file lock is acquired in a worker thread.
+    """
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir
+        self._calls = {}
+
+    async def _lead(self, key, fn, recheck, shared):
+        if not shared or fcntl is None or not self.lock_dir:
+            return await self._run(fn, recheck)
+
+        with open(_lock_path(self.lock_dir, key), 'a') as f:
+            await asyncio.to_thread(fcntl.flock, f.fileno(), fcntl.LOCK_EX)
+            try:
+                return await self._run(fn, recheck)
+            finally:
+                fcntl.flock(f.fileno(), fcntl.LOCK_UN)
+
+    @staticmethod
+    async def _run(fn, recheck):
+        if recheck is not None:
+            # Rechecks read cache backends, which may block
+            result = await asyncio.to_thread(recheck)
+            if result is not None:
+                return result
+        return await fn()
+
+    def _forget(self, key, task):
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    def _done(self, key, task):
+        self._forget(key, task)
+        # Mark the outcome retrieved even when nobody was left waiting
+        task.cancelled() or task.exception()
+
+    async def do(self, key, fn, recheck=None, shared=False):
+        """Await ``fn()`` once for concurrent callers with the same key"""
+        while True:
+            task = self._calls.get(key)
+            if task is None:
+                task = self._calls[key] = asyncio.get_running_loop().create_task(
+                    self._lead(key, fn, recheck, shared))
+                task.add_done_callback(lambda task: self._done(key, task))
+            try:
+                return await asyncio.shield(task)
+            except asyncio.CancelledError:
+                if not task.cancelled():
+                    # This caller was cancelled; the work goes on for the others
+                    raise
+            # The work itself was cancelled: run it again, this caller leading
+            self._forget(key, task)
+
+
+flights = SingleFlight(lock_dir=config.LOCK_DIR)
+async_flights = AsyncSingleFlight(lock_dir=config.LOCK_DIR)
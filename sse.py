@@ -0,0 +1,58 @@
+"""Server-Sent Events for streamed city pages.
+
+Shared by ``sentient_weather.stream_page`` and the asyncio pipeline, so both
+serving modes send the same events for a finished stage.
+"""
+import json
+
+from image_derivatives import image_variants
+from notebook_functions import get_css_variables
+
+# CSS custom properties the stylesheet reads for each palette color
+COLOR_CSS_VARIABLES = {
+    'color_page_background': '--weather-background',
+    'color_tiles_container': '--weather-tiles-container',
+    'color_tiles': '--weather-tiles',
+    'color_tile_heading': '--weather-tile-heading',
+    'color_tile_temp_high': '--weather-tile-temp-high',
+    'color_tile_temp_low': '--weather-tile-temp-low',
+    'color_tile_weather_details': '--weather-tile-details',
+}
+
+
+def color_css_variables(colors):
+    """CSS variables for a palette, as set in the page's :root block"""
+    return {var: colors[key] for key, var in COLOR_CSS_VARIABLES.items() if key in colors}
+
+
+def font_css_variables(fonts):
+    """CSS variables for a font set, under both naming schemes the stylesheet uses"""
+    css_vars = get_css_variables(fonts)
+    for category in ('primary_heading', 'secondary_heading', 'body_text', 'accent_text'):
+        name = category.replace('_', '-')
+        css_vars[f"--font-weight-{name}"] = fonts[category]['weight']
+        css_vars[f"--font-style-{name}"] = fonts[category]['style']
+    return css_vars
+
+
+def sse_event(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+def section_events(name, result):
+    """SSE events for a finished stage result"""
+    if name == 'theme':
+        colors, fonts = result
+        yield from section_events('palette', colors)
+        yield from section_events('fonts', fonts)
+    elif name == 'palette':
+        yield sse_event('palette', {'colors': result, 'css': color_css_variables(result)})
+    elif name == 'fonts':
+        yield sse_event('fonts', {'google_fonts_url': result.get('google_fonts_url'),
+                                  'css': font_css_variables(result)})
+    elif name == 'image':
+        if result:
+            yield sse_event('image', {'image_path': result, 'image_variants': image_variants(result)})
+        else:
+            yield sse_event('image', {'image_path': None})
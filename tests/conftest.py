@@ -0,0 +1,18 @@
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+# Keep the app's caches and images out of the working tree
+_state_dir = tempfile.mkdtemp(prefix='sw-tests-')
+for name, path in {
+    'SW_CACHE_PATH': 'cache.sqlite',
+    'SW_GEOCODE_CACHE_PATH': 'geocode.sqlite',
+    'SW_WEATHER_CACHE_PATH': 'weather_cache',
+    'SW_IMAGE_DIR': 'images',
+    'SW_IMAGE_INDEX_PATH': 'images.sqlite',
+    'SW_LOCK_DIR': 'locks',
+}.items():
+    os.environ.setdefault(name, os.path.join(_state_dir, path))
+os.makedirs(os.environ['SW_IMAGE_DIR'], exist_ok=True)
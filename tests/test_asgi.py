@@ -0,0 +1,67 @@
+import asyncio
+import os
+
+import pytest
+
+pytest.importorskip('asgiref')
+# create_app exits without the API keys; no upstream is called here
+os.environ.setdefault('ANTHROPIC_API_KEY', 'test')
+os.environ.setdefault('OPENAI_API_KEY', 'test')
+
+import asgi  # noqa: E402
+import async_pipeline  # noqa: E402
+import config  # noqa: E402
+
+
+def post(body):
+    messages = [{'type': 'http.request', 'body': body}]
+    sent = []
+
+    async def receive():
+        return messages.pop(0)
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'path': '/', 'method': 'POST'}
+    asyncio.run(asgi.application(scope, receive, send))
+    return sent[0]['status'], sent[1]['body'].decode('utf-8')
+
+
+def test_city_page_failure_renders_the_error_page(monkeypatch):
+    async def fail(city):
+        raise RuntimeError("geocoder exploded")
+
+    monkeypatch.setattr(async_pipeline, 'render_city_page', fail)
+    status, body = post(b'city=Oslo')
+    assert status == 200
+    assert 'geocoder exploded' in body
+
+
+def test_missing_city_is_a_bad_request():
+    status, body = post(b'')
+    assert status == 400
+    assert 'Missing city' in body
+
+
+def get(path, query=b''):
+    sent = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': b''}
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {'type': 'http', 'path': path, 'method': 'GET', 'query_string': query}
+    asyncio.run(asgi.application(scope, receive, send))
+    return sent[0]['status'], sent[1]['body'].decode('utf-8')
+
+
+def test_stream_is_not_found_when_streaming_is_off(monkeypatch):
+    monkeypatch.setattr(config, 'STREAM_PAGES', False)
+    status, body = get('/stream', b'city=Oslo')
+    assert status == 404
+    assert 'disabled' in body
+    client = async_pipeline.app.test_client()
+    assert client.get('/stream?city=Oslo').status_code == 404
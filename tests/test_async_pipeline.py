@@ -0,0 +1,67 @@
+import asyncio
+
+import async_pipeline
+import config
+
+
+async def cancelled():
+    raise asyncio.CancelledError()
+
+
+async def fonts():
+    return {'body_text': 'Lora'}
+
+
+def test_cancelled_stage_falls_back(monkeypatch):
+    monkeypatch.setattr(config, 'ASYNC_IMAGES', False)
+    monkeypatch.setattr(async_pipeline, 'palette_source', lambda city, desc: 'llm')
+    monkeypatch.setattr(async_pipeline, 'shed_stages', lambda *args: [])
+    monkeypatch.setattr(async_pipeline, 'get_css_variables', lambda fonts: {})
+    monkeypatch.setattr(async_pipeline, 'image_variants', lambda path: None)
+    monkeypatch.setattr(async_pipeline, '_design_stages', lambda *args: {
+        'palette': (cancelled(), 5, lambda: 'default palette'),
+        'fonts': (fonts(), 5, lambda: 'default fonts'),
+    })
+    monkeypatch.setattr(async_pipeline, 'generate_city_image_async', lambda *args: cancelled())
+
+    design = asyncio.run(async_pipeline.run_design_stages_async('Oslo', {}, 'Clear sky'))
+    assert design['colors'] == 'default palette'
+    assert design['fonts'] == {'body_text': 'Lora'}
+    assert design['image_path'] is None
+
+
+def test_cancelled_lookup_renders_the_error_page(monkeypatch):
+    monkeypatch.setattr(async_pipeline, 'get_city_coordinates_async', lambda city: cancelled())
+    monkeypatch.setattr(async_pipeline, 'render_error', lambda error: f"error: {error}")
+
+    body, shed = asyncio.run(async_pipeline.render_city_page('Oslo'))
+    assert body.startswith('error:')
+    assert shed == []
+
+
+def test_city_page_is_served_from_the_page_cache(monkeypatch):
+    weather = {'current': {'temperature': 3.0, 'precipitation': 0.0, 'cloud_cover': 10,
+                           'wind_speed': 2.0, 'is_day': 1, 'weather_code': 0}}
+    renders = []
+
+    async def coordinates(city):
+        return 59.9, 10.7
+
+    async def weather_data(latitude, longitude):
+        return weather
+
+    async def design(city, weather_data, weather_description):
+        renders.append(city)
+        return {'degraded': []}
+
+    monkeypatch.setattr(config, 'PAGE_CACHE', True)
+    monkeypatch.setattr(async_pipeline, 'get_city_coordinates_async', coordinates)
+    monkeypatch.setattr(async_pipeline, 'get_weather_data_async', weather_data)
+    monkeypatch.setattr(async_pipeline, 'run_design_stages_async', design)
+    monkeypatch.setattr(async_pipeline, 'render', lambda template, **context: f"page for {context['city']}")
+    monkeypatch.setattr(async_pipeline, 'is_cacheable', lambda city, weather_data, design: True)
+
+    first = asyncio.run(async_pipeline.render_city_page('Bergen'))
+    second = asyncio.run(async_pipeline.render_city_page('Bergen'))
+    assert first == second == ('page for Bergen', [])
+    assert renders == ['Bergen']
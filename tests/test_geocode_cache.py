@@ -0,0 +1,85 @@
+import asyncio
+import threading
+import time
+
+import pytest
+
+from cache_backends import MemoryBackend
+from geocode_cache import GeocodeCache, RateLimiter
+from resilience import UpstreamUnavailable, deadline
+
+COORDINATES = {
+    'los angeles': (34.05, -118.24),
+    'new york': (40.71, -74.01),
+    # What a geocoder may return for the bare abbreviation
+    'la': (-22.0, 17.0),
+}
+
+
+def fake_geocode(queries):
+    def geocode(city):
+        queries.append(city)
+        return COORDINATES.get(city.lower())
+    return geocode
+
+
+def new_cache():
+    return GeocodeCache(MemoryBackend(max_entries=100), min_interval=0)
+
+
+def test_alias_and_canonical_name_resolve_to_the_same_coordinates():
+    queries = []
+    cache = new_cache()
+    assert cache.lookup('LA', fake_geocode(queries)) == COORDINATES['los angeles']
+    assert cache.lookup('Los Angeles', fake_geocode(queries)) == COORDINATES['los angeles']
+    assert queries == ['los angeles']
+
+
+def test_canonical_name_first_then_alias_hits_the_cache():
+    queries = []
+    cache = new_cache()
+    assert cache.lookup('New York', fake_geocode(queries)) == COORDINATES['new york']
+    assert cache.lookup('NYC', fake_geocode(queries)) == COORDINATES['new york']
+    assert queries == ['New York']
+
+
+def test_async_lookup_geocodes_the_canonical_name():
+    queries = []
+    cache = new_cache()
+    geocode = fake_geocode(queries)
+
+    async def geocode_async(city):
+        return geocode(city)
+
+    assert asyncio.run(cache.lookup_async('la', geocode_async)) == COORDINATES['los angeles']
+    assert queries == ['los angeles']
+
+
+def test_rate_limit_slot_past_the_deadline_fails_fast_and_is_not_taken():
+    limiter = RateLimiter(min_interval=5)
+    assert limiter.wait_time() == 0
+    started = time.monotonic()
+    with deadline(0.5), pytest.raises(UpstreamUnavailable, match='rate limited'):
+        limiter.wait_time()
+    assert time.monotonic() - started < 0.5
+    # Nothing was taken: the next slot is still the one about 5s out
+    assert 4 < limiter.wait_time() <= 5
+
+
+def test_rate_limit_is_shared_through_the_slot_file(tmp_path):
+    path = str(tmp_path / 'nominatim.slot')
+    # Two limiters on one file stand in for two worker processes
+    first, second = RateLimiter(5, path), RateLimiter(5, path)
+    assert first.wait_time() == 0
+    assert 4 < second.wait_time() <= 5
+
+
+def test_lookup_found_on_recheck_does_not_take_a_slot():
+    queries = []
+    cache = GeocodeCache(MemoryBackend(max_entries=100), min_interval=0.2)
+    assert cache.rate_limiter.wait_time() == 0
+    # Another worker resolves the city while this lookup waits for the slot
+    threading.Timer(0.05, cache.set, ('los angeles', COORDINATES['los angeles'])).start()
+    assert cache.lookup('Los Angeles', fake_geocode(queries)) == COORDINATES['los angeles']
+    assert queries == []
+    assert cache.rate_limiter.wait_time() == 0
@@ -0,0 +1,83 @@
+import io
+
+import pytest
+
+pytest.importorskip('numpy')
+Image = pytest.importorskip('PIL.Image')
+
+import config  # noqa: E402
+import notebook_functions  # noqa: E402
+import prewarm  # noqa: E402
+import sentient_weather as app  # noqa: E402
+from image_derivatives import create_derivatives  # noqa: E402
+from page_cache import is_cacheable  # noqa: E402
+
+WEATHER = {'current': {'temperature': 12.0, 'precipitation': 0.0, 'cloud_cover': 40,
+                       'wind_speed': 8.0, 'is_day': 1, 'weather_code': 2}}
+DESCRIPTION = 'Partly cloudy'
+
+
+def png(color):
+    image = Image.new('RGB', (160, 90), color)
+    image.paste((240, 235, 220), (0, 0, 80, 45))
+    image.paste((200, 30, 40), (80, 45, 160, 90))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+@pytest.fixture
+def image_mode(monkeypatch):
+    monkeypatch.setattr(config, 'PALETTE_MODE', 'image')
+
+
+def store_image(city):
+    key = notebook_functions.image_cache_key(city, DESCRIPTION)
+    return app.get_image_store().put(key, png((40, 70, 140)), f"{key}.png",
+                                     city=city, weather=DESCRIPTION)
+
+
+def test_image_palette_makes_the_page_cacheable_and_the_city_warm(image_mode):
+    city = 'Palette Town'
+    image_path = store_image(city)
+    app.design_cache.set('fonts', city, WEATHER, app.get_default_fonts())
+
+    colors = app.build_image_palette(city, WEATHER, DESCRIPTION)
+
+    assert app.design_cache.peek('palette', city, WEATHER) == colors
+    assert prewarm.is_warm(city, WEATHER, DESCRIPTION)
+    design = {'fallbacks': [], 'degraded': [], 'image_job': None, 'image_path': image_path,
+              'image_variants': create_derivatives(image_path)}
+    assert is_cacheable(city, WEATHER, design)
+
+
+def test_page_waits_for_image_derivatives_before_caching(image_mode):
+    city = 'Pending Falls'
+    image_path = store_image(city)
+    app.design_cache.set('palette', city, WEATHER, app.get_default_colors())
+    app.design_cache.set('fonts', city, WEATHER, app.get_default_fonts())
+
+    design = {'fallbacks': [], 'degraded': [], 'image_job': None, 'image_path': image_path,
+              'image_variants': None}
+    assert not is_cacheable(city, WEATHER, design)
+
+
+def test_prewarm_spends_no_budget_on_an_image_palette(image_mode, monkeypatch):
+    city = 'Prewarm Falls'
+    store_image(city)
+    app.design_cache.set('fonts', city, WEATHER, app.get_default_fonts())
+    monkeypatch.setattr(notebook_functions, 'get_city_coordinates', lambda city: (1.0, 2.0))
+    monkeypatch.setattr(notebook_functions, 'get_weather_data', lambda *args, **kwargs: WEATHER)
+
+    warmed = []
+    prewarmer = prewarm.Prewarmer(lambda *args: warmed.append('design') or app.warm_design(*args),
+                                  lambda *args: warmed.append('image'),
+                                  palette_source=app.palette_source)
+    prewarmer.budget = prewarm.TokenBucket(0, 0)
+
+    prewarmer.warm_city(city)
+    assert warmed == ['design']
+    assert prewarm.is_warm(city, WEATHER, DESCRIPTION)
+
+    prewarmer.warm_city(city)
+    assert warmed == ['design']
@@ -0,0 +1,36 @@
+import contextvars
+import threading
+
+from jobs import StagePool
+
+city = contextvars.ContextVar('city', default=None)
+
+
+def test_stage_pool_counts_tasks_waiting_for_a_worker():
+    pool = StagePool(1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def block():
+        started.set()
+        release.wait(5)
+
+    running = pool.submit(block)
+    started.wait(5)
+    queued = [pool.submit(lambda: None) for _ in range(3)]
+    assert pool.pending() == 3
+
+    queued[0].cancel()
+    assert pool.pending() == 2
+
+    release.set()
+    running.result(5)
+    for future in queued[1:]:
+        future.result(5)
+    assert pool.pending() == 0
+
+
+def test_stage_pool_runs_in_the_callers_context():
+    pool = StagePool(1)
+    city.set('Oslo')
+    assert pool.submit(city.get).result(5) == 'Oslo'
@@ -0,0 +1,93 @@
+import pytest
+
+import resilience
+from resilience import CircuitBreaker, Upstream, is_retryable
+
+
+class StatusError(Exception):
+    def __init__(self, status):
+        super().__init__(f"HTTP {status}")
+        self.status_code = status
+
+
+def upstream(**kwargs):
+    return Upstream('test', breaker=CircuitBreaker('test', failure_threshold=2, reset_timeout=60),
+                    retries=2, backoff=0, **kwargs)
+
+
+def failing(exc, calls):
+    def fn():
+        calls.append(1)
+        raise exc
+    return fn
+
+
+@pytest.mark.parametrize('exc, retryable', [
+    (StatusError(503), True),
+    (StatusError(429), True),
+    (StatusError(404), False),
+    (ConnectionResetError(), True),
+    (TimeoutError(), True),
+    (TypeError("unexpected keyword argument"), False),
+    (ValueError("Expecting value"), False),
+])
+def test_is_retryable(exc, retryable):
+    assert is_retryable(exc) is retryable
+
+
+def test_transient_cause_is_retryable():
+    try:
+        try:
+            raise ConnectionRefusedError()
+        except ConnectionRefusedError as e:
+            raise RuntimeError("request failed") from e
+    except RuntimeError as e:
+        assert is_retryable(e)
+
+
+def test_programming_errors_are_not_retried_and_keep_the_circuit_closed():
+    up, calls = upstream(), []
+    for _ in range(5):
+        with pytest.raises(TypeError):
+            up.call(failing(TypeError("bad argument"), calls))
+    assert len(calls) == 5
+    assert up.breaker.state == CircuitBreaker.CLOSED
+
+
+def test_server_errors_are_retried_and_open_the_circuit():
+    up, calls = upstream(), []
+    with pytest.raises(StatusError):
+        up.call(failing(StatusError(503), calls))
+    assert up.breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(resilience.UpstreamUnavailable):
+        up.call(failing(StatusError(503), calls))
+    assert len(calls) == 2
+
+
+def test_open_circuit_does_not_use_up_rate_limit_tokens():
+    up, calls = upstream(bucket=resilience.TokenBucket(0.001, 1)), []
+    up.breaker.record_failure()
+    up.breaker.record_failure()
+    with pytest.raises(resilience.UpstreamUnavailable, match='circuit open'):
+        up.call(failing(StatusError(503), calls))
+    assert not calls
+    assert up.bucket.take()
+
+
+def test_rate_limit_rejection_frees_the_half_open_probe():
+    up, calls = upstream(bucket=resilience.TokenBucket(0.001, 0)), []
+    up.breaker.reset_timeout = 0
+    up.breaker.record_failure()
+    up.breaker.record_failure()
+    with resilience.deadline(0.01), pytest.raises(resilience.UpstreamUnavailable, match='rate limited'):
+        up.call(lambda: calls.append(1))
+    assert not calls
+    assert up.breaker.available()
+
+
+def test_parse_rate_limits():
+    buckets = resilience.parse_rate_limits('anthropic=50/10, openai=5, openmeteo=600, off=0')
+    assert sorted(buckets) == ['anthropic', 'openai', 'openmeteo']
+    assert (buckets['anthropic'].rate, buckets['anthropic'].capacity) == (50 / 60, 10)
+    assert (buckets['openai'].rate, buckets['openai'].capacity) == (5 / 60, 1)
+    assert buckets['openmeteo'].capacity == 100
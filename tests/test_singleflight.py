@@ -0,0 +1,41 @@
+import asyncio
+
+from singleflight import AsyncSingleFlight
+
+
+def test_leader_timeout_does_not_cancel_the_followers():
+    flights, calls = AsyncSingleFlight(), []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'palette'
+
+    async def main():
+        leader = asyncio.wait_for(flights.do('key', generate), timeout=0.01)
+        follower = flights.do('key', generate)
+        return await asyncio.gather(leader, follower, return_exceptions=True)
+
+    leader, follower = asyncio.run(main())
+    assert isinstance(leader, asyncio.TimeoutError)
+    assert follower == 'palette'
+    assert calls == [1]
+
+
+def test_cancelled_work_is_rerun_by_a_follower():
+    flights, calls = AsyncSingleFlight(), []
+
+    async def generate():
+        calls.append(1)
+        if len(calls) == 1:
+            asyncio.current_task().cancel()
+        await asyncio.sleep(0.01)
+        return 'palette'
+
+    async def main():
+        return await asyncio.gather(flights.do('key', generate), flights.do('key', generate),
+                                    return_exceptions=True)
+
+    results = asyncio.run(main())
+    assert results == ['palette', 'palette']
+    assert calls == [1, 1]